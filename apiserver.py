@@ -19,9 +19,11 @@ from handlers import ResponseHandler, WebHandler
 from serverlib import ServerManager
 
 from interfaces import get_db_interface
+from interfaces.executor import DatabaseExecutor, run_blocking
 
 from tornado.options import define, options, parse_command_line
 from tornado.ioloop import PeriodicCallback
+from tornado import gen
 
 # allow command line overriding of these options
 define("ip", default = settings.listen_ip, help = "The IP to listen on", type = str)
@@ -82,7 +84,7 @@ class UserContainer(object):
 
 
 class Application(tornado.web.Application):
-    def __init__(self, db):
+    def __init__(self, db, executor = None):
         # init tornado specific settings first
         handlers = [
             # pug creation and management
@@ -105,18 +107,24 @@ class Application(tornado.web.Application):
             (r"/ITF2Pug/Ban/Remove/", WebHandler.BanRemoveHandler),
             (r"/ITF2Pug/Ban/List/", WebHandler.BanListHandler),
 
+            # servers
+            (r"/ITF2Pug/Server/Reload/", WebHandler.ServerReloadHandler),
+
             # stats
             (r"/ITF2Pug/Stat/(.*)/", WebHandler.StatHandler),
         ]
 
-        settings = {
+        app_settings = {
             "debug": True,
         }
 
-        tornado.web.Application.__init__(self, handlers, **settings)
+        tornado.web.Application.__init__(self, handlers, **app_settings)
 
         # -----------------
         self.db = db
+
+        # blocking database calls are run on the executor, if there is one
+        self.executor = executor
         
         self.response_handler = ResponseHandler.ResponseHandler()
         
@@ -128,6 +136,12 @@ class Application(tornado.web.Application):
         # multiple pug managers attached to it
         self._server_managers = {}
 
+        # the player index (player id -> pug) shared by all pug managers in
+        # each pug group
+        self._player_indexes = {}
+
+        # the ban manager expires bans itself, using a timer for the next ban
+        # to expire
         self.ban_manager = bans.BanManager(db) 
 
         self._auth_cache = UserContainer()
@@ -144,11 +158,24 @@ class Application(tornado.web.Application):
                                                  10000)
         self._periodic_flush_timer.start()
 
-        # check ban expirations every 10 mins
-        self._ban_expiration_timer = PeriodicCallback(
-                                        self.ban_manager.check_bans,
-                                        10*60*1000)
-        self._ban_expiration_timer.start()
+        # log the database executor metrics every minute
+        if self.executor is not None:
+            self._executor_stats_timer = PeriodicCallback(
+                                            self.executor.log_stats, 60000)
+            self._executor_stats_timer.start()
+
+        # servers are allocated from memory, so periodically reload them to
+        # pick up any servers added to or removed from the database. servers
+        # coming out of quarantine are checked at the same time
+        self._server_reload_timer = PeriodicCallback(self._reload_servers,
+                                    settings.server_reload_interval * 1000)
+        self._server_reload_timer.start()
+
+        # player ranks are refreshed periodically, rather than whenever stats
+        # are flushed
+        self._rank_refresh_timer = PeriodicCallback(self._refresh_player_ranks,
+                                    settings.player_rank_refresh_interval * 1000)
+        self._rank_refresh_timer.start()
 
         # loading the pug managers will also load all server managers
         self.__load_pug_managers()
@@ -162,7 +189,8 @@ class Application(tornado.web.Application):
         else:
             logging.debug("Getting server manager for group %d", server_group)
 
-            new_manager = ServerManager.ServerManager(server_group, self.db)
+            new_manager = ServerManager.ServerManager(server_group, self.db,
+                                                      self.executor)
 
             self._server_managers[server_group] = new_manager
 
@@ -179,10 +207,14 @@ class Application(tornado.web.Application):
 
             user = self._auth_cache.get_user_by_priv_key(private_key)
 
+            player_index = self._player_indexes.setdefault(user.pug_group, {})
+
             new_manager = PugManager.PugManager(user.pug_group, private_key, 
                             self.db, 
                             self.get_server_manager(user.server_group),
-                            self.ban_manager)
+                            self.ban_manager,
+                            player_index,
+                            self.executor)
 
             self._pug_managers[private_key] = new_manager
 
@@ -190,10 +222,26 @@ class Application(tornado.web.Application):
 
     def _periodic_flush(self):
         for manager in self._pug_managers.values():
-            manager.flush_all()
+            manager.flush_all(async = True)
 
         for manager in self._server_managers.values():
-            manager.flush_all()
+            manager.flush_all(async = True)
+
+    @gen.coroutine
+    def _reload_servers(self):
+        for manager in self._server_managers.values():
+            try:
+                yield manager.reload_servers()
+
+            except:
+                logging.exception("Exception reloading servers for group %d",
+                                  manager.group)
+
+            manager.check_health()
+
+    @gen.coroutine
+    def _refresh_player_ranks(self):
+        yield run_blocking(self.executor, self.db.refresh_player_ranks)
 
     def _pug_status_check(self):
         curr_ctime = time.time()
@@ -232,16 +280,6 @@ class Application(tornado.web.Application):
                 user = self._auth_cache.add_user(key_tuple)
                 self.get_pug_manager(user.private_key)
 
-        # Build each pug's group_managers list using a simple n*n iteration
-        logging.info("- Building lists of managers in the same groups")
-        for pm in self._pug_managers.values():
-            pm.group_managers = [ x 
-                    for x in self._pug_managers.values()
-                        if (x.api_key != pm.api_key) and (x.group == pm.group)
-                ]
-
-            logging.debug("'%s' group managers: %s", pm.api_key, pm.group_managers)
-
         logging.info("All users loaded")
 
     def __late_load_servers(self):
@@ -256,19 +294,32 @@ class Application(tornado.web.Application):
 
     def close(self):
         self._pug_status_timer.stop()
+        self._rank_refresh_timer.stop()
+        self._server_reload_timer.stop()
+        self.ban_manager.close()
 
         # flush the managers to the database
+        # a failed flush is logged by the database interface, and must not
+        # stop the other managers being flushed
         logging.info("Flushing pug managers")
         for manager in self._pug_managers.values():
-            manager.flush_all()
-
+            try:
+                manager.flush_all()
+            except:
+                pass
 
         logging.info("Flushing server managers")
         for manager in self._server_managers.values():
-            manager.flush_all()
+            try:
+                manager.flush_all()
+            except:
+                pass
 
         logging.info("Managers successfully flushed")
 
+        if self.executor is not None:
+            self.executor.shutdown()
+
 if __name__ == "__main__":
     parse_command_line()
 
@@ -277,10 +328,13 @@ if __name__ == "__main__":
                 settings.db_host, settings.db_port
             )
 
-    # a synchronous pool for database queries that should be performed 
-    # synchronously
-    db = psycopg2.pool.SimpleConnectionPool(minconn = 1, maxconn = 1, 
-        dsn = dsn)
+    # a thread pool for running blocking database queries off the IOLoop
+    executor = DatabaseExecutor(settings.db_executor_workers)
+
+    # a pool for database queries that are performed synchronously, either
+    # on the IOLoop or on the executor. one connection is kept for the IOLoop
+    db = psycopg2.pool.ThreadedConnectionPool(minconn = 1, 
+        maxconn = settings.db_executor_workers + 1, dsn = dsn)
 
     # asynchronous connection pool for async queries. momoko utilizes gen to
     # perform queries asynchronously using tornado
@@ -289,12 +343,19 @@ if __name__ == "__main__":
 
     dbinterface_cls = get_db_interface("PGSQL")
 
-    dbinterface = dbinterface_cls(db, async_db)
+    dbinterface = dbinterface_cls(db, async_db, 
+                        stats_cache_size = settings.player_stats_cache_size,
+                        stats_cache_ttl = settings.player_stats_cache_ttl,
+                        pug_compact_events = settings.pug_compact_events)
 
     for statcol in settings.indexed_stats:
         dbinterface.add_stat_index(statcol)
 
-    api_server = Application(dbinterface)
+    # rank any players who were not ranked while the daemon was down, before
+    # their stats are looked up
+    dbinterface.refresh_player_ranks()
+
+    api_server = Application(dbinterface, executor)
 
     api_server.listen(options.port, options.ip)
 
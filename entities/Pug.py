@@ -4,7 +4,7 @@ import random
 import logging
 import collections
 
-from puglib import rating
+from puglib import rating, ratingsystems
 
 states = {
     "GATHERING_PLAYERS": 0,
@@ -41,8 +41,9 @@ class PlayerStats(dict):
     """
 
     # special stats are stats that are not incremented in update_end_stats,
-    # they are set to whatever value is in the game stats dict
-    SPECIAL_STATS = ("rating", "winstreak")
+    # they are set to whatever value is in the game stats dict. this includes
+    # the stats kept by the rating systems (i.e. rating deviation)
+    SPECIAL_STATS = ("winstreak",) + ratingsystems.STATE_STATS
 
     def __init__(self, *args, **kwargs):
         # Set the base stats, and then super to restore any stats from the
@@ -101,6 +102,15 @@ class Pug(object):
         self.server = None
         self.server_id = -1
 
+        # A dict in the form { cid: Pug, ... }, shared by every pug in the
+        # same pug group. Set by the PugManager, and kept up to date as players
+        # are added and removed. This is not serialized.
+        self.player_index = None
+
+        # incremented every time the pug is changed, so that we know when it
+        # needs to be written to the database (or sent to clients) again
+        self.version = 0
+
         self.game_start_time = 0
         self.game_over_time = 0
 
@@ -134,11 +144,16 @@ class Pug(object):
         if self.full:
             return
 
+        self.mark_changed()
+
         if self.player_count == 0:
             self.admin = player_id
 
         self._players[player_id] = player_name
 
+        if self.player_index is not None:
+            self.player_index[player_id] = self
+
         self.player_stats[player_id] = pstats
         self._get_game_stats(player_id)
 
@@ -197,6 +212,9 @@ class Pug(object):
                 self.state = self._previous_state
 
     def remove_player(self, player_id):
+        if player_id in self._players or player_id in self.player_votes:
+            self.mark_changed()
+
         if player_id in self._players:
             # if the game is in progress, we need to change the state to 
             # replacement needed. we store the previous state so we can go
@@ -226,6 +244,10 @@ class Pug(object):
 
             del self._players[player_id]
 
+            if (self.player_index is not None and 
+                    self.player_index.get(player_id) is self):
+                del self.player_index[player_id]
+
             # update the admin to the next person in the pug
             if player_id == self.admin and self.player_count > 0:
                 self.admin = self._players.keys()[0]
@@ -237,6 +259,23 @@ class Pug(object):
         if player_id in self.player_votes:
             del self.player_votes[player_id]
 
+    def set_player_index(self, player_index):
+        """
+        Sets the player index this pug should maintain, and adds all players
+        currently in the pug to it. If player_index is None, all players are
+        removed from the current index instead.
+        """
+        if self.player_index is not None:
+            for player_id in self._players:
+                if self.player_index.get(player_id) is self:
+                    del self.player_index[player_id]
+
+        self.player_index = player_index
+
+        if player_index is not None:
+            for player_id in self._players:
+                player_index[player_id] = self
+
     def _add_to_team(self, team, player):
         """
         Add a player to the specified team list. Player can also be a list, as
@@ -275,6 +314,8 @@ class Pug(object):
                                       "time": time.time() 
                                     })
 
+            self.mark_changed()
+
     def remove_disconnect(self, player_id):
         """
         Remove a disconnection in the case that a player has rejoined the
@@ -285,6 +326,8 @@ class Pug(object):
                 if disc["id"] == player_id:
                     self.disconnects.remove(disc)
 
+                    self.mark_changed()
+
     def check_disconnects(self):
         """
         Check the disconnects list. If anyone has been disconnected for longer
@@ -303,11 +346,15 @@ class Pug(object):
                 self.disconnects.remove(disc)
                 self.disconnect_record.append(disc)
 
+                self.mark_changed()
+
 
     def begin_map_vote(self):
         if self.state >= states["MAP_VOTING"]:
             return
 
+        self.mark_changed()
+
         if self.map_forced:
             self.state = states["MAPVOTE_COMPLETED"]
 
@@ -320,6 +367,8 @@ class Pug(object):
             self.state = states["MAP_VOTING"]
 
     def end_map_vote(self):
+        self.mark_changed()
+
         if self.map_forced:
             self.state = states["MAPVOTE_COMPLETED"]
             return
@@ -346,14 +395,20 @@ class Pug(object):
         else:
             self.player_votes[player_id] = map_name
 
+        self.mark_changed()
+
     def force_map(self, map_name):
         self.map_forced = True
         self.map = map_name
 
+        self.mark_changed()
+
     def shuffle_teams(self):
         if not self.full or self.teams_done:
             return
 
+        self.mark_changed()
+
         stat_data = self.player_stats
 
         # To select teams, we have to first select a medic for each team. 
@@ -494,6 +549,8 @@ class Pug(object):
             self.state = states["GAME_STARTED"]
             self.game_start_time = time.time()
 
+            self.mark_changed()
+
         else:
             pass
 
@@ -504,6 +561,8 @@ class Pug(object):
         try:
             score = int(score)
             self.game_scores[team] = score
+
+            self.mark_changed()
         except:
             pass
 
@@ -512,10 +571,14 @@ class Pug(object):
 
         self.game_over_time = time.time()
 
+        self.mark_changed()
+
     def update_end_stats(self):
         if self.stats_done:
             return
 
+        self.mark_changed()
+
         # merge the game stats with the pre-game stats to get player's new
         # total stats
 
@@ -665,6 +728,8 @@ class Pug(object):
         if not self.game_started:
             return
 
+        self.mark_changed()
+
         ps = self._get_game_stats(player_id)
 
         if (not increment) or (statkey not in ps):
@@ -685,14 +750,29 @@ class Pug(object):
 
             return new
 
-    def set_player_rating(self, player_id, rating):
+    def set_player_rating(self, player_id, rating, state = None):
         """
         Used by pug manager when updating ratings to set the player's new
         rating after the game.
+
+        :param state (optional) A dict of any other stats kept by the rating
+                     system, which are set along with the rating
         """
         if player_id in self.game_stats:
             self.game_stats[player_id]["rating"] = rating
 
+            if state:
+                self.game_stats[player_id].update(state)
+
+            self.mark_changed()
+
+    def mark_changed(self):
+        """
+        Marks the pug as changed. Called by every method that modifies the
+        pug, and must be called by anything modifying the pug directly.
+        """
+        self.version += 1
+
     @property
     def replacement_timed_out(self):
         if self.state == states["REPLACEMENT_REQUIRED"]:
@@ -4,11 +4,14 @@ import string
 import random
 import re
 
-from serverlib import RconStream as Rcon, UDPServer
+from serverlib import RconPool, UDPServer, LogListener
+from serverlib.health import ServerHealth
 from interfaces import get_log_interface
 
 import settings
 
+from tornado import gen
+
 def random_string(len=24, chars=string.ascii_lowercase + string.ascii_uppercase + string.digits):
     #generates a random string of length len
     return ''.join(random.choice(chars) for x in range(len))
@@ -39,36 +42,74 @@ class Server(object):
         self.anticheat = "VAC"
 
         self.rcon_connection = None
+        self.health = ServerHealth()
+
         self._listener = None
+        self._shared_listener = None
 
+        # incremented every time the server's stored details are changed, so
+        # that we know when it needs to be written to the database again
+        self.version = 0
+
+    @gen.coroutine
     def get_tv_port(self):
-        def cb(data):
-            # data = (4, 0, '"tv_port" = "27056" ( def. "27020" )\n - Host SourceTV port\n')
-            logging.debug("TV_PORT callback: %s", data)
+        """
+        Gets the server's SourceTV port. This is a coroutine.
+        """
+        try:
+            data = yield self.execute("tv_port")
+
+        except Exception as e:
+            logging.warning("Unable to get tv_port of server %d: %s", self.id, 
+                            e)
+            return
 
-            match = tv_port_re.search(data[2])
-            if match:
-                self.tv_port = match.group(1)
+        # data = (4, 0, '"tv_port" = "27056" ( def. "27020" )\n - Host SourceTV port\n')
+        logging.debug("TV_PORT response: %s", data)
 
-        self.rcon("tv_port", callback = cb)        
+        match = tv_port_re.search(data[2])
+        if match:
+            self.tv_port = match.group(1)
 
-    def rcon(self, msg, *args, **kwargs):
+    def _connection(self):
         if (not self.rcon_connection or 
           (self.rcon_connection and self.rcon_connection.closed)):
 
-            self.rcon_connection = Rcon.RconConnection(self.ip, self.port, self.rcon_password)
+            self.rcon_connection = RconPool.get_pool().get(self.ip, 
+                                                       self.port, 
+                                                       self.rcon_password,
+                                                       health = self.health)
 
-        command = msg
-        callback = kwargs["callback"] if "callback" in kwargs else None
+        return self.rcon_connection
 
+    def _format_command(self, msg, args):
         if args:
             # support parsing of a dict as args for string substitution
             if len(args) == 1 and isinstance(args[0], dict) and args[0]:
                 args = args[0]
 
-            command = command % args
+            return msg % args
+
+        return msg
 
-        self.rcon_connection.send_cmd(command, callback)
+    def rcon(self, msg, *args, **kwargs):
+        command = self._format_command(msg, args)
+        callback = kwargs["callback"] if "callback" in kwargs else None
+
+        self._connection().send_cmd(command, callback)
+
+    def execute(self, msg, *args, **kwargs):
+        """
+        Sends an RCON command to the server. Takes the same arguments as
+        `rcon`, along with an optional timeout.
+
+        :return Future A Future resolving to the response, a tuple in the form
+                       (id, code, message)
+        """
+        command = self._format_command(msg, args)
+
+        return self._connection().execute(command, 
+                                          timeout = kwargs.get("timeout"))
 
     # reserves a server for a pug
     def reserve(self, pug):
@@ -90,6 +131,7 @@ class Server(object):
         self.pug_id = self.pug.id
 
         self.password = random_string(10)
+        self.mark_changed()
 
         self.rcon("sv_password \"\"; say This server has been reserved for pug %d; kickall", 
                     self.pug_id)
@@ -110,6 +152,7 @@ class Server(object):
     def reset(self):
         self.pug = None
         self.pug_id = -1
+        self.mark_changed()
 
         self.rcon("say The pug is over!; sv_password %s; kickall", random_string(8))
 
@@ -133,21 +176,50 @@ class Server(object):
         if log_port is None:
             log_port = 0
 
-        # make an instance of udp server, log interface, and start the listener
-        server_address = (settings.logging_listen_ip, log_port) # bind to set ip?
         log_iface_cls = get_log_interface(self.game)
 
         self._log_interface = log_iface_cls(self)
 
-        self._listener = UDPServer.UDPServer(server_address, self._log_interface.parse)
+        if settings.logging_listen_port is not None:
+            # all servers share a single listener, which routes logs to this
+            # server's log interface based on the secret/source address
+            self._shared_listener = LogListener.get_shared_listener()
+
+            secret = self._shared_listener.register(self, self._log_interface)
+            self._log_interface.use_secret(secret)
+
+            listener_address = self._shared_listener.server_address
+            self.log_port = listener_address[1]
+            self.mark_changed()
+
+            self.rcon("sv_logsecret %s", secret)
+            self.rcon("logaddress_add %s:%s" % listener_address)
+
+            return
+
+        # make an instance of udp server, log interface, and start the listener
+        server_address = (settings.logging_listen_ip, log_port) # bind to set ip?
+
+        self._listener = UDPServer.UDPServer(server_address, 
+                            self._log_interface.parse,
+                            batch_callback = self._log_interface.parse_batch,
+                            read_budget = settings.logging_read_budget)
         self._listener.start()
 
         listener_ip, self.log_port = self._listener.server_address
+        self.mark_changed()
 
         self.rcon("logaddress_add %s:%s" % self._listener.server_address)
 
     def _end_listener(self):
-        if self._listener is not None:
+        if self._shared_listener is not None:
+            self.rcon("logaddress_del %s:%s" % 
+                        self._shared_listener.server_address)
+
+            self._shared_listener.unregister(self)
+            self._shared_listener = None
+
+        elif self._listener is not None:
             self.rcon("logaddress_del %s:%s" % self._listener.server_address)
             
             self._listener.close()
@@ -157,6 +229,7 @@ class Server(object):
 
         self._log_interface = None
         self.log_port = 0
+        self.mark_changed()
 
     def late_loaded(self):
         # if there was last a pug in progress on this server, re-establish
@@ -168,6 +241,9 @@ class Server(object):
             # get the tv_port again
             self.get_tv_port()
 
+    def mark_changed(self):
+        self.version += 1
+
     @property
     def in_use(self):
         return self.pug is not None or self.pug_id > 0
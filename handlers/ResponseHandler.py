@@ -1,6 +1,14 @@
 # The ResponseHandler handles all responses to API calls. Response codes
 # are the code sent along with packets to indicate what the packet is for.
 
+import logging
+
+try:
+    import ujson as json
+except:
+    logging.info("Using inbuilt json module")
+    import json
+
 from collections import OrderedDict
 
 Response_None = 0 # for when shit goes completely wrong
@@ -29,6 +37,7 @@ Response_InvalidMap = 1204
 
 Response_NoAvailableServers = 1300
 Response_ServerConnectionError = 1301
+Response_ServersReloaded = 1302
 
 Response_BanAdded = 1400
 Response_InvalidBanData = 1401
@@ -40,8 +49,16 @@ Response_PlayerStats = 1500
 Response_TopPlayerStats = 1501
 
 class ResponseHandler(object):
-    def __init__(self):
-        pass
+    def __init__(self, status_cache_size = 1000):
+        """
+        :param status_cache_size (optional) The max number of pugs to keep
+                                 encoded status packets for
+        """
+        # pug status packets are polled far more often than pugs change, so
+        # the encoded packet for the latest version of each pug is kept. in
+        # the form { pug id: (cache key, encoded packet) }, in LRU order
+        self._status_cache = OrderedDict()
+        self.status_cache_size = status_cache_size
 
     def change_response_code(self, packet, new_code):
         packet["response"] = new_code
@@ -99,6 +116,9 @@ class ResponseHandler(object):
     def server_connection_error(self):
         return { "response": Response_ServerConnectionError }
 
+    def servers_reloaded(self):
+        return { "response": Response_ServersReloaded }
+
     def pug_vote_added(self, player_id, pug):
         response = self.pug_status(pug)
         response["voter_id"] = player_id
@@ -189,6 +209,14 @@ class ResponseHandler(object):
 
         return response
 
+    def pug_listing_encoded(self, pugs):
+        """
+        The same as pug_listing, but JSON encoded, using the cached packet of
+        each pug
+        """
+        return '{"response":%d,"pugs":[%s]}' % (Response_PugListing,
+                    ",".join([ self._encoded_status_packet(x) for x in pugs ]))
+
     def pug_map_forced(self, pug):
         response = self.pug_status(pug)
 
@@ -244,6 +272,53 @@ class ResponseHandler(object):
 
         return response
 
+    def pug_status_encoded(self, pug):
+        """
+        The same as pug_status, but JSON encoded, using the cached packet of
+        the pug
+        """
+        if pug is None:
+            return json.dumps(self.pug_status(pug))
+
+        return '{"response":%d,"pug":%s}' % (Response_PugStatus,
+                                             self._encoded_status_packet(pug))
+
+    def _encoded_status_packet(self, pug):
+        """
+        Gets the JSON encoded status packet of the pug. The packet is only
+        encoded again if the pug (or its server) has changed since it was
+        last encoded
+        """
+        if pug.id is None:
+            # new pugs can't be told apart until they have an id
+            return json.dumps(self._pug_status_packet(pug))
+
+        key = self.status_version(pug)
+
+        cached = self._status_cache.pop(pug.id, None)
+        if cached is None or cached[0] != key:
+            cached = (key, json.dumps(self._pug_status_packet(pug)))
+
+        self._status_cache[pug.id] = cached
+
+        if len(self._status_cache) > self.status_cache_size:
+            self._status_cache.popitem(last = False)
+
+        return cached[1]
+
+    def status_version(self, pug):
+        """
+        Gets the version of the pug's status packet, which changes whenever
+        the packet would. The pug's version changes whenever the pug does,
+        but the server details aren't part of the pug.
+        """
+        server = pug.server
+        if server is None:
+            return (pug.version, None)
+
+        return (pug.version, server.id, server.anticheat, server.ip, 
+                server.port, server.tv_port, server.password)
+
     def _pug_status_packet(self, pug):
         packet = pug.__dict__.copy()
 
@@ -261,6 +336,8 @@ class ResponseHandler(object):
             del packet["server"]
 
         del packet["_players"]
+        del packet["player_index"]
+        del packet["version"]
 
         # only stats we send are the game stats
         del packet["player_stats"]
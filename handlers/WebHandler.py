@@ -3,6 +3,7 @@ import time
 import hmac
 import hashlib
 import sys
+import os
 
 try:
     import ujson as json
@@ -18,6 +19,12 @@ from tornado import gen
 from puglib import Exceptions as PugManagerExceptions, bans
 from serverlib import Rcon, Exceptions as ServerManagerExceptions
 
+import settings
+
+# versions start again when the daemon is restarted, so ETags derived from
+# them are salted with a value unique to this process
+ETAG_SEED = os.urandom(8).encode("hex")
+
 def compare_digest(a, b):
     if int(''.join([ str(x) for x in sys.version_info[:3] ])) < 277:
         return a == b
@@ -52,6 +59,33 @@ class BaseHandler(tornado.web.RequestHandler):
         # chunk is encoded using our encoder, pass back to normal write method
         super(BaseHandler, self).write(chunk)
 
+    def write_json(self, chunk):
+        """
+        Writes a response which has already been JSON encoded (i.e. a cached
+        pug status)
+        """
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+
+        super(BaseHandler, self).write(chunk)
+
+    def check_version_etag(self, *version):
+        """
+        Sets a strong ETag derived from the given version information (i.e. a
+        pug's version), which must change whenever the response would. If the
+        client's If-None-Match has the current ETag, the status is set to 304
+        and the response does not need to be built.
+
+        :return bool True if the client's copy is current (304)
+        """
+        etag = hashlib.sha1(repr((ETAG_SEED,) + version)).hexdigest()
+        self.set_header("Etag", '"%s"' % etag)
+
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+
+        return False
+
     @property
     def manager(self):
         return self.application.get_pug_manager(self.current_user.private_key)
@@ -192,7 +226,13 @@ class PugListHandler(BaseHandler):
     def get(self):
         #self.validate_request()
 
-        self.write(self.response_handler.pug_listing(self.manager.get_pugs()))
+        pugs = self.manager.get_pugs()
+
+        if self.check_version_etag("list", [ (x.id,
+                        self.response_handler.status_version(x)) for x in pugs ]):
+            return
+
+        self.write_json(self.response_handler.pug_listing_encoded(pugs))
 
 class PugStatusHandler(BaseHandler):
     # A GET which retrieves the status of the given pug id
@@ -201,9 +241,15 @@ class PugStatusHandler(BaseHandler):
     def get(self):
         self.validate_request()
 
+        pug = self.manager.get_pug_by_id(self.pugid)
+
+        if pug is not None and self.check_version_etag("status", pug.id,
+                                    self.response_handler.status_version(pug)):
+            return
+
         # the response handler will automatically handle invalid pug ids by
         # sending an invalidpug response code
-        self.write(self.response_handler.pug_status(self.manager.get_pug_by_id(self.pugid)))
+        self.write_json(self.response_handler.pug_status_encoded(pug))
 
 # adds a player to a pug
 class PugAddHandler(BaseHandler):
@@ -213,6 +259,7 @@ class PugAddHandler(BaseHandler):
     # @steamid The SteamID to add
     # @name The name of the player being added
     # @pugid The pug ID to add the player to
+    @gen.coroutine
     def post(self):
         self.validate_request()
 
@@ -220,7 +267,8 @@ class PugAddHandler(BaseHandler):
 
         # the add_player method returns the pug the player was added to
         try:
-            pug = self.manager.add_player(self.player_id, self.player_name, pug_id)
+            pug = yield self.manager.add_player(self.player_id, 
+                                                self.player_name, pug_id)
             # send the updated status of this pug (i.e which players are in it now)
 
             self.write(self.response_handler.player_added(pug))
@@ -300,6 +348,7 @@ class PugCreateHandler(BaseHandler):
                             who can join the pug. +100 means >= 100 rating,
                             -100 means < 100 rating.
     """
+    @gen.coroutine
     def post(self):
         self.validate_request()
 
@@ -314,10 +363,11 @@ class PugCreateHandler(BaseHandler):
                 raise HTTPError(401)
 
         try:
-            pug = self.manager.create_pug(self.player_id, self.player_name,
-                                          size = size, pug_map = pug_map, 
-                                          custom_id = custom_id, 
-                                          restriction = restriction)
+            pug = yield self.manager.create_pug(self.player_id, 
+                                                self.player_name,
+                                                size = size, pug_map = pug_map, 
+                                                custom_id = custom_id, 
+                                                restriction = restriction)
 
             # send the status of the new pug
             self.write(self.response_handler.pug_created(pug))
@@ -351,13 +401,14 @@ class PugEndHandler(BaseHandler):
     # The only parameter required is the pug id
     # @pugid The ID of the pug to end
     # @steamid The user trying to end the pug?
+    @gen.coroutine
     def post(self):
         self.validate_request()
 
         pug_id = self.pugid
 
         try:
-            self.manager.end_pug(pug_id)
+            yield self.manager.end_pug(pug_id)
 
             self.write(self.response_handler.pug_ended(pug_id))
 
@@ -377,9 +428,13 @@ class PugPlayerListHandler(BaseHandler):
     def get(self):
         self.validate_request()
 
-        pug_id = self.pugid
+        pug = self.manager.get_pug_by_id(self.pugid)
+
+        if pug is not None and self.check_version_etag("players", pug.id,
+                                                       pug.version):
+            return
 
-        self.write(self.response_handler.player_list(self.manager.get_pug_by_id(pug_id)))
+        self.write(self.response_handler.player_list(pug))
 
 class PugMapVoteHandler(BaseHandler):
     # A POST is used to set a player's map vote
@@ -452,6 +507,7 @@ class BanAddHandler(BaseHandler):
     :param data This should be the only argument (aside from key). It should be
                 a JSON encoded string with the format dicated in bans.md
     """
+    @gen.coroutine
     def post(self):
         self.validate_request()
 
@@ -464,7 +520,7 @@ class BanAddHandler(BaseHandler):
             raise HTTPError(400)
 
         try:
-            ban = self.application.ban_manager.add_ban(data)
+            ban = yield self.application.ban_manager.add_ban(data)
             self.write(self.response_handler.ban_added(ban))
 
         except (bans.BanAddException, AssertionError):
@@ -482,11 +538,12 @@ class BanRemoveHandler(BaseHandler):
 
     :param steamid The 64bit SteamID to remove the ban for
     """
+    @gen.coroutine
     def post(self):
         self.validate_request()
 
         try:
-            self.application.ban_manager.remove_ban(self.player_id)
+            yield self.application.ban_manager.remove_ban(self.player_id)
 
             self.write(self.response_handler.ban_removed())
 
@@ -508,6 +565,7 @@ class BanListHandler(BaseHandler):
     :param expired (optional) Whether or not to include expired bans. 
                               A bool (1/0 or 'true'/'false').
     """
+    @gen.coroutine
     def get(self):
         self.validate_request()
 
@@ -533,20 +591,43 @@ class BanListHandler(BaseHandler):
 
         try:
             if cids is None:
-                self.write(self.response_handler.ban_list(
-                        self.application.db.get_bans(include_expired = expired)
-                    ))
+                ban_list = yield self.application.db.get_bans(
+                                        include_expired = expired, 
+                                        async = True)
             else:
-                self.write(self.response_handler.ban_list(
-                        self.application.db.get_bans(cids = cids, 
-                                                     include_expired = expired)
-                    ))
+                ban_list = yield self.application.db.get_bans(cids = cids, 
+                                        include_expired = expired,
+                                        async = True)
+
+            self.write(self.response_handler.ban_list(ban_list))
 
         except:
             logging.exception("Exception getting ban list")
             raise HTTPError(500)
 
 
+class ServerReloadHandler(BaseHandler):
+    """
+    A POST request to reload the requesting user's server group from the
+    database, so that added or removed servers are picked up immediately
+    rather than at the next periodic reload.
+    """
+    @gen.coroutine
+    def post(self):
+        self.validate_request()
+
+        manager = self.application.get_server_manager(
+                                            self.current_user.server_group)
+
+        try:
+            yield manager.reload_servers()
+
+            self.write(self.response_handler.servers_reloaded())
+
+        except:
+            logging.exception("Exception occurred reloading servers")
+            raise HTTPError(500)
+
 
 class StatHandler(BaseHandler):
     """
@@ -564,6 +645,15 @@ class StatHandler(BaseHandler):
         if slug not in routes:
             raise HTTPError(404)
 
+        # stats written elsewhere are picked up when the stats cache expires,
+        # so the ETag changes at least that often. the response depends on
+        # the slug and arguments too, so they are part of the tag
+        if self.check_version_etag("stats", self.request.path,
+                    sorted(self.request.query_arguments.items()),
+                    self.application.db.stats_version,
+                    int(time.time() // settings.player_stats_cache_ttl)):
+            return
+
         cids = None
         if slug == "Select":
             cids = self.get_argument("ids")
@@ -599,15 +689,10 @@ class StatHandler(BaseHandler):
                 return
 
         # now get the stats based on the obtained parameters
-        serialized_stats = yield self.application.db.get_player_stats(
+        deserialized_stats = yield self.application.db.get_player_stats(
                                                 ids = cids,
                                                 async = True)
 
-        # deserialize the stats
-        deserialized_stats = self.application.db.deserialize_player_stats(
-                                    serialized_stats
-                                )
-
 
         if slug == "Top":
             # if top, we need to sort based on the given stat column
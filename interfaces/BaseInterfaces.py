@@ -1,4 +1,7 @@
 import json
+
+from tornado import gen
+
 class BaseJsonInterface(object):
     """ 
     Takes a Pug object and converts it into a JSON object
@@ -19,6 +22,44 @@ class BaseJsonInterface(object):
     def loads(self, data):
         return json.loads(data)
 
+    """
+    Encodes each section of a Pug object separately, so that only the
+    sections which have changed need to be written
+
+    :param obj The pug object
+    :param written (optional) A dict which is filled with what has been
+                   written, to be passed to dumps_delta
+
+    :return dict A dict of section name -> encoded section
+    """
+    def dump_sections(self, obj, written = None):
+        raise NotImplementedError("This must be implemented")
+
+    """
+    Joins sections from dump_sections into a single JSON object string
+    """
+    def join_sections(self, sections):
+        raise NotImplementedError("This must be implemented")
+
+    """
+    Encodes the parts of a Pug object which have changed since they were
+    last written
+
+    :param obj The pug object
+    :param written A dict of what was last written (see dump_sections),
+                   which is updated with the changes
+
+    :return JSON A JSON (string) object, or None if nothing has changed
+    """
+    def dumps_delta(self, obj, written):
+        raise NotImplementedError("This must be implemented")
+
+    """
+    Applies the changes from dumps_delta to a Pug object
+    """
+    def apply_delta(self, obj, data):
+        raise NotImplementedError("This must be implemented")
+
 class BaseDatabaseInterface(object):
     """
     A base database interface class. This class is used to interface with your
@@ -30,6 +71,10 @@ class BaseDatabaseInterface(object):
     def __init__(self, db):
         self.db = db
 
+        # incremented whenever player stats are written, so that anything
+        # derived from the stats (i.e. HTTP ETags) knows when it is stale
+        self.stats_version = 0
+
     def get_user_info(self, api_key = None):
         """
         Gets all user info from the auth table. If an api key is specified, 
@@ -48,8 +93,8 @@ class BaseDatabaseInterface(object):
         list is given, gets all stat data in the database.
 
         :param ids (optional) The list of 64bit IDs to get data for
-        :param async (optional) Whether to return a `tornado.gen.YieldPoint` or
-                                equivalent Future to run in a coroutine, or to 
+        :param async (optional) Whether to return a Future resolving to the
+                                stats dict to run in a coroutine, or to 
                                 perform the query synchronously
 
         :return A dictionary of stats with respect to each individual ID
@@ -73,13 +118,47 @@ class BaseDatabaseInterface(object):
     def flush_player_stats(self, player_stats):
         """
         Updates stats from a pug. The dict given is used to update all values
-        for the user. 
+        for the user. Raises if the stats could not be written.
 
         :param player_stats A dict of all player stats, with the keys 64bit
                             SteamIDs
         """
         raise NotImplementedError("This must be implemented")
 
+    def import_player_stats(self, player_stats):
+        """
+        Bulk imports player stats, i.e. when backfilling the stat tables. The
+        base implementation simply flushes the stats.
+
+        :param player_stats A dict of all player stats, with the keys 64bit
+                            SteamIDs
+        """
+        self.flush_player_stats(player_stats)
+
+    def set_player_ratings(self, ratings, state = None):
+        """
+        Sets the rating stat of the given players, leaving their other stats
+        as they are.
+
+        :param ratings A dict of 64bit SteamID -> rating
+        :param state (optional) A dict of 64bit SteamID -> dict of any other
+                     stats kept by the rating system, to set as well
+
+        :return int The number of players updated
+        """
+        raise NotImplementedError("This must be implemented")
+
+    def iter_finished_pugs(self, jsoninterface):
+        """
+        Iterates over all finished pugs (of every api key), in the order they
+        were created. Implementations should not load every pug at once.
+
+        :param jsoninterface The JSON interface to be used to convert from JSON
+
+        :return An iterable of Pug objects
+        """
+        raise NotImplementedError("This must be implemented")
+
     def get_pugs(self, api_key, jsoninterface, include_finished = False):
         """
         Gets pug data pertaining to a specified API key, and returns it as a 
@@ -96,17 +175,40 @@ class BaseDatabaseInterface(object):
         """
         raise NotImplementedError("This must be implemented")
 
-    def flush_pug(self, api_key, jsoninterface, pug):
+    def flush_pug(self, api_key, jsoninterface, pug, async = False):
         """
-        Flushes a JSONised pug to the database. This method is only used for
-        non-new pugs, which already have an ID.
+        Flushes a JSONised pug to the database. New pugs (with no ID) are
+        inserted, and given their new ID. Raises (or the Future fails) if the
+        pug could not be written.
 
         :param api_key The API key the pug is under (not necessary?)
         :param jsoninterface The JSON interface to convert to JSON
         :param pug A Pug object
+        :param async (optional) Whether to return a Future to run in a 
+                                coroutine, or to perform the write 
+                                synchronously
         """
         raise NotImplementedError("This must be implemented")
 
+    def flush_pugs(self, api_key, jsoninterface, pugs, async = False):
+        """
+        Flushes a list of pugs to the database in a single batch. The base
+        implementation simply flushes each pug individually. Raises (or the
+        Future fails) if the pugs could not be written.
+
+        :param api_key The API key the pugs are under
+        :param jsoninterface The JSON interface to convert to JSON
+        :param pugs A list of Pug objects
+        :param async (optional) Whether to return a Future to run in a 
+                                coroutine, or to perform the write 
+                                synchronously
+        """
+        results = [ self.flush_pug(api_key, jsoninterface, pug, async = async)
+                    for pug in pugs ]
+
+        if async:
+            return gen.multi(results)
+
     def get_servers(self, group):
         """
         Gets all servers pertaining to the specified group. Multiple pug 
@@ -119,30 +221,41 @@ class BaseDatabaseInterface(object):
         """
         raise NotImplementedError("This must be implemented")
     
-    def flush_server(self, server):
+    def flush_server(self, server, async = False):
         """
-        Flushes a server to the database
+        Flushes a server to the database. Raises (or the Future fails) if the
+        server could not be written.
 
         :param server The server to flush
+        :param async (optional) Whether to return a Future to run in a 
+                                coroutine, or to perform the write 
+                                synchronously
         """
         raise NotImplementedError("This must be implemented")
 
-    def get_bans(self, cids = None, include_expired = False):
+    def get_bans(self, cids = None, include_expired = False, async = False):
         """
         Gets player bans. If cid is specified, gets bans only for that player.
 
         :param cids (optional) A list of player 64bit SteamIDs
         :param include_expired (optional) Whether to get expired bans as well
+        :param async (optional) Whether to return a Future resolving to the
+                                bans to run in a coroutine, or to perform the
+                                query synchronously
 
         :return List of dicts
         """
         raise NotImplementedError("Getting bans is not implemented")
 
-    def flush_ban(self, ban):
+    def flush_ban(self, ban, async = False):
         """
-        Flushes a ban object to the database
+        Flushes a ban object to the database. New bans (with no ID) are
+        inserted, and given their new ID.
 
         :param ban A ban object
+        :param async (optional) Whether to return a Future to run in a 
+                                coroutine, or to perform the write 
+                                synchronously
         """
         raise NotImplementedError("Flushing bans is not implemented")
 
@@ -158,6 +271,14 @@ class BaseLogInterface(object):
     def parse(self, data):
         raise NotImplementedError("Must implement this method")
 
+    def parse_batch(self, datagrams):
+        """
+        Parses a list of log datagrams, in the order they were received.
+        """
+        parse = self.parse
+        for data in datagrams:
+            parse(data)
+
     def start_game(self, start_time = 5):
         #self.server.start_game(start_time)
         self.pug.begin_game()
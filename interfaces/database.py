@@ -1,16 +1,24 @@
+import csv
 import logging
 
+from cStringIO import StringIO
+
 try:
     import ujson as json
 except ImportError:
     import json
 
 import psycopg2.extras
-from psycopg2.extras import Json
 
 import momoko
 
+from tornado import gen
+
 from BaseInterfaces import BaseDatabaseInterface
+from statcache import PlayerStatsCache
+
+# max number of rows sent in each INSERT when staging rows
+STAGE_PAGE_SIZE = 1000
 
 class PSQLDatabaseInterface(BaseDatabaseInterface):
     """
@@ -26,13 +34,30 @@ class PSQLDatabaseInterface(BaseDatabaseInterface):
     finally:
         self._close_db_objects(cursor, conn)
     """
-    def __init__(self, db, async_db):
+    def __init__(self, db, async_db, stats_cache_size = 10000, 
+                 stats_cache_ttl = 300, pug_compact_events = 100):
         BaseDatabaseInterface.__init__(self, db)
 
         self.async_db = async_db
 
+        # pug id -> what was last written for the pug, in the form
+        # { "state": state at the snapshot, "events": events since the
+        #   snapshot, "written": what was written, for the JSON interface's
+        #   dumps_delta }
+        self._pug_logs = {}
+
+        # max number of events written for a pug before they are compacted
+        # into a new snapshot
+        self.pug_compact_events = pug_compact_events
+
         self._indexable_stats = []
 
+        # deserialised player stats. updated whenever stats are flushed, so
+        # the stats are only stale if the database is modified elsewhere.
+        # ranks are refreshed periodically (see refresh_player_ranks), so the
+        # cached ranks may lag by up to ttl after a refresh
+        self.stats_cache = PlayerStatsCache(stats_cache_size, stats_cache_ttl)
+
     def add_stat_index(self, stat):
         self._indexable_stats.append(stat)
         logging.info("Will now maintain stat index for '%s' on stat flush", 
@@ -66,6 +91,55 @@ class PSQLDatabaseInterface(BaseDatabaseInterface):
             self._close_db_objects(cursor, conn)
 
     def get_player_stats(self, ids = None, async = False):
+        if async:
+            return self._get_player_stats_async(ids)
+
+        stats, missing = self._get_cached_player_stats(ids)
+        if missing is not None and not missing:
+            return stats
+
+        query, query_args = self._player_stats_query(missing)
+
+        conn, cursor = self._get_db_objects()
+        
+        try:
+            cursor.execute(query, query_args)
+
+            results = cursor.fetchall()
+
+        except:
+            logging.exception("An exception occurred getting stats for %s",  
+                              ids)
+            raise
+
+        finally:
+            self._close_db_objects(cursor, conn)
+
+        fetched = self.deserialize_player_stats(results)
+        self._cache_player_stats(missing, fetched)
+
+        stats.update(fetched)
+
+        return stats
+
+    @gen.coroutine
+    def _get_player_stats_async(self, ids):
+        stats, missing = self._get_cached_player_stats(ids)
+        if missing is not None and not missing:
+            raise gen.Return(stats)
+
+        query, query_args = self._player_stats_query(missing)
+
+        cursor = yield momoko.Op(self.async_db.execute, query, query_args)
+
+        fetched = self.deserialize_player_stats(cursor.fetchall())
+        self._cache_player_stats(missing, fetched)
+
+        stats.update(fetched)
+
+        raise gen.Return(stats)
+
+    def _player_stats_query(self, ids):
         query = """SELECT steamid, stats, rank
                    FROM player_ranking"""
 
@@ -77,26 +151,33 @@ class PSQLDatabaseInterface(BaseDatabaseInterface):
             query += " WHERE steamid IN %s"
             query_args.append(tuple(ids))
 
-        if async:
-            return momoko.Op(self.async_db.execute, query, query_args)
+        return query, query_args
 
-        else:
-            conn, cursor = self._get_db_objects()
-            
-            try:
-                cursor.execute(query, query_args)
+    def _get_cached_player_stats(self, ids):
+        """
+        Gets the stats of the given players from the stats cache.
 
-                results = cursor.fetchall()
+        :return tuple (stats, missing), where missing is the list of ids which
+                      need to be fetched from the database, or None if all
+                      stats are to be fetched
+        """
+        if ids is None:
+            return {}, None
 
-                return self.deserialize_player_stats(results)
+        stats, missing = self.stats_cache.get(ids)
 
-            except:
-                logging.exception("An exception occurred getting stats for %s",  
-                                  ids)
-                raise
+        logging.debug("Player stats cache: %d hits, %d misses", 
+                      len(ids) - len(missing), len(missing))
 
-            finally:
-                self._close_db_objects(cursor, conn)
+        return stats, missing
+
+    def _cache_player_stats(self, ids, stats):
+        # we don't cache the stats of every player, only the ones asked for
+        if ids is None:
+            return
+
+        for cid in ids:
+            self.stats_cache.put(cid, stats.get(cid))
 
     def deserialize_player_stats(self, results):
         return _deserialize_player_stats(results)
@@ -110,7 +191,7 @@ class PSQLDatabaseInterface(BaseDatabaseInterface):
 
         if stat == "rating":
             query = """SELECT steamid
-                       FROM player_ranking
+                       FROM player_ranks
                        ORDER BY rank ASC
                        OFFSET %s LIMIT %s"""
 
@@ -149,6 +230,44 @@ class PSQLDatabaseInterface(BaseDatabaseInterface):
                 self._close_db_objects(cursor, conn)
 
     def flush_player_stats(self, player_stats):
+        self._write_player_stats(player_stats, self._stage_rows)
+
+        logging.debug("Player stats cache: %d entries, %d hits, %d misses",
+                      len(self.stats_cache), self.stats_cache.hits,
+                      self.stats_cache.misses)
+
+    def import_player_stats(self, player_stats):
+        """
+        Bulk import mode for backfills (i.e. test/fill_player_stats.py). Works
+        the same as flush_player_stats, but loads the staging tables with COPY
+        rather than INSERT, which is much faster for a large number of players.
+        """
+        self._write_player_stats(player_stats, self._copy_rows, 
+                                 update_cache = False)
+
+    def _write_player_stats(self, player_stats, stage, update_cache = True):
+        """
+        Writes player stats (and the stat index) as a set-based upsert. The
+        rows are loaded into temporary staging tables using the `stage` method,
+        and then merged into players and players_index using a single UPDATE
+        and a single INSERT per table, regardless of the number of players.
+        Everything is done in a single transaction.
+
+        If update_cache is True, the stats cache is updated with the flushed
+        stats. Otherwise, the flushed players are simply removed from it. If
+        the write fails, the players are removed from the cache and the
+        exception is raised.
+        """
+        if not player_stats:
+            return
+
+        for s in player_stats:
+            if "rank" in player_stats[s]:
+                del player_stats[s]["rank"]
+
+        cids = player_stats.keys()
+        ranks = None
+
         conn, cursor = self._get_db_objects()
 
         try:
@@ -158,88 +277,287 @@ class PSQLDatabaseInterface(BaseDatabaseInterface):
             # keys without the need for modifying the table. We maintain
             # an index table, players_index, which allows us to lookup players
             # based on stat data.
+            cursor.execute("""CREATE TEMP TABLE players_stage 
+                                (steamid bigint, data text) 
+                              ON COMMIT DROP;
+                              CREATE TEMP TABLE players_index_stage 
+                                (steamid bigint, item text, value decimal) 
+                              ON COMMIT DROP""")
+
+            stage(cursor, "players_stage", 
+                  [ (cid, json.dumps(player_stats[cid])) 
+                    for cid in player_stats ])
+
+            stage(cursor, "players_index_stage", 
+                  self._stat_index_rows(player_stats))
+
+            # ON CONFLICT requires pg 9.5+, so we update the existing rows and
+            # then insert the rest
+            cursor.execute("""UPDATE players p
+                              SET data = s.data
+                              FROM players_stage s
+                              WHERE p.steamid = s.steamid""")
+
+            cursor.execute("""INSERT INTO players (steamid, data)
+                              SELECT s.steamid, s.data
+                              FROM players_stage s
+                              WHERE NOT EXISTS (
+                                SELECT 1 FROM players p
+                                WHERE p.steamid = s.steamid)""")
+
+            self._maintain_stat_index(cursor)
+
+            # ranks are not refreshed here, as a change in one player's rating
+            # can move the rank of every player between their old and new
+            # rating. see refresh_player_ranks
+            if update_cache:
+                cursor.execute("""SELECT steamid, rank
+                                  FROM player_ranks
+                                  WHERE steamid IN %s""", (tuple(cids),))
+
+                ranks = dict(cursor.fetchall())
 
-            # see which stats we should insert or update
-            cids = player_stats.keys()
-            cursor.execute("""SELECT steamid 
-                              FROM players 
-                              WHERE steamid IN %s""", (tuple(cids),))
+            conn.commit()
 
-            for s in player_stats:
-                if "rank" in player_stats[s]:
-                    del player_stats[s]["rank"]
+        except:
+            logging.exception("An exception occurred flushing player stats")
+            self.stats_cache.invalidate(cids)
+            raise
 
-            results = cursor.fetchall()
-            # populate existing with the steamids that are already in the
-            # table. these ids we will simply update
-            existing = [ x[0] for x in results ] if results else []
+        finally:
+            self._close_db_objects(cursor, conn)
+
+            self.stats_version += 1
+
+        if ranks is None:
+            self.stats_cache.invalidate(cids)
+            return
+
+        for cid in cids:
+            # players who have not been ranked yet have no rank until the
+            # next refresh
+            stats = dict(player_stats[cid])
+            stats["rank"] = ranks.get(cid)
+
+            self.stats_cache.put(cid, stats)
+
+    def _stat_index_rows(self, player_stats):
+        """
+        Gets the (steamid, item, value) rows of the stat index for each column
+        listed in self._indexable_stats
+        """
+        rows = []
+        for col in self._indexable_stats:
+            # col is the name of a key in the player stat dictionary
+            for cid in player_stats:
+                pstat = player_stats[cid]
+
+                if col not in pstat: # player does not contain this stat. skip?
+                    continue
 
-            insert_ids = [ x for x in cids if x not in existing ]
+                rows.append((cid, col, pstat[col]))
 
-            # Make data a list of tuples in the format (cid, JSON)
-            insert = [ (x, Json(player_stats[x])) for x in insert_ids ]
+        return rows
 
-            # opposite order for update because of query ordering
-            update = [ (Json(player_stats[x]), x) for x in existing ]
+    def _maintain_stat_index(self, cursor):
+        """
+        Merges the staged index rows into players_index. Must be run after the
+        players themselves have been merged, as the index references them.
+        """
+        cursor.execute("""UPDATE players_index pi
+                          SET value = s.value
+                          FROM players_index_stage s
+                          WHERE pi.steamid = s.steamid AND pi.item = s.item""")
+
+        cursor.execute("""INSERT INTO players_index (steamid, item, value)
+                          SELECT s.steamid, s.item, s.value
+                          FROM players_index_stage s
+                          WHERE NOT EXISTS (
+                            SELECT 1 FROM players_index pi
+                            WHERE pi.steamid = s.steamid 
+                                AND pi.item = s.item)""")
+
+    def refresh_player_ranks(self):
+        """
+        Brings the player_ranks table up to date with the ratings in
+        players_index. This is run when the daemon starts and periodically
+        after that (settings.player_rank_refresh_interval), rather than on
+        every stat flush, so ranks lag rating changes by up to the interval.
+        Ranks can only be refreshed if ratings are indexed.
+        """
+        if "rating" not in self._indexable_stats:
+            return
 
-            cursor.executemany("""INSERT INTO players (steamid, data) 
-                                  VALUES (%s, %s)""", insert)
+        conn, cursor = self._get_db_objects()
 
-            cursor.executemany("""UPDATE players
-                                  SET data = %s
-                                  WHERE steamid = %s""", update)
+        try:
+            self._refresh_player_ranks(cursor)
 
             conn.commit()
 
         except:
-            logging.exception("An exception occurred flushing player stats")
+            logging.exception("An exception occurred refreshing player ranks")
 
         finally:
             self._close_db_objects(cursor, conn)
 
-        self._maintain_stat_index(player_stats)
+            self.stats_version += 1
+
+    def _refresh_player_ranks(self, cursor):
+        """
+        Ranks every player by rating, and writes the ranks which have changed
+        to player_ranks. Ties are broken by steamid, so that the ranks of
+        tied players are stable between refreshes. Players who are no longer
+        in the index are removed.
+        """
+        cursor.execute("""CREATE TEMP TABLE player_ranks_stage 
+                          ON COMMIT DROP AS
+                            SELECT steamid, row_number() OVER (
+                                    ORDER BY value DESC, steamid) AS rank
+                            FROM players_index
+                            WHERE item = 'rating'""")
+
+        cursor.execute("""UPDATE player_ranks r
+                          SET rank = s.rank
+                          FROM player_ranks_stage s
+                          WHERE r.steamid = s.steamid AND r.rank <> s.rank""")
+
+        cursor.execute("""INSERT INTO player_ranks (steamid, rank)
+                          SELECT s.steamid, s.rank
+                          FROM player_ranks_stage s
+                          WHERE NOT EXISTS (
+                            SELECT 1 FROM player_ranks r
+                            WHERE r.steamid = s.steamid)""")
+
+        cursor.execute("""DELETE FROM player_ranks r
+                          WHERE NOT EXISTS (
+                            SELECT 1 FROM player_ranks_stage s
+                            WHERE s.steamid = r.steamid)""")
+
+    def _stage_rows(self, cursor, table, rows):
+        if not rows:
+            return
+
+        psycopg2.extras.execute_values(cursor, 
+                                       "INSERT INTO %s VALUES %%s" % table,
+                                       rows, page_size = STAGE_PAGE_SIZE)
+
+    def _copy_rows(self, cursor, table, rows):
+        if not rows:
+            return
+
+        # CSV format takes care of quoting the JSON for us
+        buf = StringIO()
+        csv.writer(buf, lineterminator = "\n").writerows(rows)
+        buf.seek(0)
 
-    def _maintain_stat_index(self, player_stats):
+        cursor.copy_expert("COPY %s FROM STDIN WITH CSV" % table, buf)
+
+    def set_player_ratings(self, ratings, state = None):
         """
-        Maintains the stat table index for each column listed in 
-        self._indexable_stats
+        Sets the rating of the given players, i.e. after replaying the rating
+        history. Player data is read and rewritten STAGE_PAGE_SIZE players at
+        a time, and merged with a set-based update in a single transaction.
+        Players which are not in the players table are skipped.
+
+        :param ratings A dict of 64bit SteamID -> rating
+        :param state (optional) A dict of 64bit SteamID -> dict of any other
+                     stats kept by the rating system, which are set along
+                     with the rating
+
+        :return int The number of players updated
         """
+        if not ratings:
+            return 0
+
+        cids = ratings.keys()
+        updated = 0
+
         conn, cursor = self._get_db_objects()
 
         try:
-            for col in self._indexable_stats:
-                # col is the name of a key in the player stat dictionary
-                for cid in player_stats:
-                    pstat = player_stats[cid]
-                    
-                    if col not in pstat: # player does not contain this stat. skip?
-                        continue
-
-                    # see if this item already exists in the index
-                    cursor.execute("""SELECT 1 
-                                      FROM players_index
-                                      WHERE steamid = %s AND item = %s""",
-                                    [ cid, col ])
-
-                    result = cursor.fetchone()
-                    if result:
-                        # exists, so we should update the value
-                        cursor.execute("""UPDATE players_index
-                                          SET value = %s
-                                          WHERE steamid = %s AND item = %s""",
-                                        [ pstat[col], cid, col ])
-                    else:
-                        # insert into index
-                        cursor.execute("""INSERT INTO players_index 
-                                            (steamid, item, value)
-                                          VALUES (%s, %s, %s)""",
-                                        [ cid, col, pstat[col] ])
-
-                # commit after each indexable column
-                conn.commit()
+            cursor.execute("""CREATE TEMP TABLE players_stage 
+                                (steamid bigint, data text) 
+                              ON COMMIT DROP;
+                              CREATE TEMP TABLE players_index_stage 
+                                (steamid bigint, item text, value decimal) 
+                              ON COMMIT DROP""")
+
+            for i in xrange(0, len(cids), STAGE_PAGE_SIZE):
+                cursor.execute("""SELECT steamid, data
+                                  FROM players
+                                  WHERE steamid IN %s""", 
+                                  (tuple(cids[i:i + STAGE_PAGE_SIZE]),))
+
+                rows = []
+                for cid, data in cursor.fetchall():
+                    stats = json.loads(data)
+                    stats["rating"] = ratings[cid]
+
+                    if state and cid in state:
+                        stats.update(state[cid])
+
+                    rows.append((cid, json.dumps(stats)))
+
+                self._copy_rows(cursor, "players_stage", rows)
+
+                if "rating" in self._indexable_stats:
+                    self._copy_rows(cursor, "players_index_stage",
+                                    [ (x[0], "rating", ratings[x[0]]) 
+                                      for x in rows ])
+
+                updated += len(rows)
+
+            cursor.execute("""UPDATE players p
+                              SET data = s.data
+                              FROM players_stage s
+                              WHERE p.steamid = s.steamid""")
+
+            self._maintain_stat_index(cursor)
+
+            if "rating" in self._indexable_stats:
+                self._refresh_player_ranks(cursor)
+
+            conn.commit()
 
         except:
-            logging.exception("An exception occurred updating the stat index")
+            logging.exception("An exception occurred setting player ratings")
+            raise
+
+        finally:
+            self._close_db_objects(cursor, conn)
+
+            self.stats_cache.invalidate(cids)
+            self.stats_version += 1
+
+        return updated
+
+    def iter_finished_pugs(self, jsoninterface):
+        """
+        Iterates over every finished pug, for all api keys, in the order they
+        were created. A named (server-side) cursor is used, so that only
+        STAGE_PAGE_SIZE pugs are held in memory at a time. A connection is
+        held from the pool until the iteration is finished.
+
+        :param jsoninterface The JSON interface to be used to convert from JSON
+
+        :return generator A generator of Pug objects
+        """
+        conn = self.db.getconn()
+        cursor = None
+
+        try:
+            cursor = conn.cursor("finished_pugs")
+            cursor.itersize = STAGE_PAGE_SIZE
+
+            cursor.execute("""SELECT p.id, p.data
+                              FROM pugs p
+                              JOIN pugs_index pi ON pi.pug_entity_id = p.id
+                              WHERE pi.finished = true
+                              ORDER BY p.id""")
+
+            for pid, data in cursor:
+                yield jsoninterface.loads(pid, data)
 
         finally:
             self._close_db_objects(cursor, conn)
@@ -273,6 +591,18 @@ class PSQLDatabaseInterface(BaseDatabaseInterface):
                 results = cursor.fetchall()
                 if results:
                     pugs = [ jsoninterface.loads(x[0], x[1]) for x in results ]
+
+                # replay the changes written since each pug's snapshot
+                pug_index = dict((x.id, x) for x in pugs)
+
+                cursor.execute("""SELECT pug_entity_id, data
+                                  FROM pug_events
+                                  WHERE pug_entity_id IN %s
+                                  ORDER BY id""", [tuple(pug_ids)])
+
+                for pid, data in cursor:
+                    if pid in pug_index:
+                        jsoninterface.apply_delta(pug_index[pid], data)
                 
             # pugs is a list of Pug objects, converted using the jsoninterface
 
@@ -285,7 +615,16 @@ class PSQLDatabaseInterface(BaseDatabaseInterface):
         finally:
             self._close_db_objects(cursor, conn)
 
-    def flush_pug(self, api_key, jsoninterface, pug):
+    def flush_pug(self, api_key, jsoninterface, pug, async = False):
+        """
+        Writes a pug. New pugs are inserted with a full snapshot. Existing pugs
+        only have the sections which have changed since they were last written
+        appended to pug_events, unless the snapshot is due to be compacted
+        (see _pug_write).
+        """
+        if async:
+            return self._flush_pug_async(api_key, jsoninterface, pug)
+
         conn, cursor = self._get_db_objects()
 
         try:
@@ -293,8 +632,11 @@ class PSQLDatabaseInterface(BaseDatabaseInterface):
                 # this is a new pug, so we need to INSERT into the pug table
                 # AND update the index table. Then we set the pug's ID to the
                 # new ID
+                written = {}
+                sections = jsoninterface.dump_sections(pug, written)
+
                 cursor.execute("INSERT INTO pugs (data) VALUES (%s) RETURNING id", 
-                                [Json(pug, dumps=jsoninterface.dumps)])
+                                [jsoninterface.join_sections(sections)])
 
                 result = cursor.fetchone()
                 if result and result[0]:
@@ -305,25 +647,192 @@ class PSQLDatabaseInterface(BaseDatabaseInterface):
                 cursor.execute("""INSERT INTO pugs_index (pug_entity_id, finished, api_key) 
                                   VALUES (%s, %s, %s)""", [pug.id, pug.game_over, api_key])
 
+                conn.commit()
+
+                self._pug_snapshot(pug, written)
+
             else:
                 # Else, this pug has already been flushed once. So we just
-                # update the data column, and the index if necessary
-                cursor.execute("UPDATE pugs SET data = %s WHERE id = %s", 
-                                [Json(pug, dumps=jsoninterface.dumps), pug.id])
+                # write its changes, and update the index if necessary
+                for statement in self._pug_write(jsoninterface, pug):
+                    cursor.execute(*statement)
 
-                if pug.game_over:
-                    cursor.execute("""UPDATE pugs_index 
-                                      SET finished = true
-                                      WHERE pug_entity_id = %s""", [pug.id])
+                conn.commit()
 
-            conn.commit()
+        except:
+            logging.exception("An exception occurred flushing pug %s" % pug.id)
+            self._pug_logs.pop(pug.id, None)
+            raise
+
+        finally:
+            self._close_db_objects(cursor, conn)
+
+    @gen.coroutine
+    def _flush_pug_async(self, api_key, jsoninterface, pug):
+        try:
+            if pug.id is None:
+                written = {}
+                sections = jsoninterface.dump_sections(pug, written)
+
+                # a new pug. the pug and its index entry are inserted with a
+                # single statement, so we don't need a transaction to get the
+                # new ID for the index
+                cursor = yield momoko.Op(self.async_db.execute,
+                        """WITH new_pug AS (
+                                INSERT INTO pugs (data) VALUES (%s) 
+                                RETURNING id
+                            )
+                           INSERT INTO pugs_index 
+                                (pug_entity_id, finished, api_key)
+                           SELECT id, %s, %s FROM new_pug
+                           RETURNING pug_entity_id""", 
+                        [jsoninterface.join_sections(sections), pug.game_over,
+                         api_key])
+
+                result = cursor.fetchone()
+                if result and result[0]:
+                    pug.id = result[0]
+                else:
+                    raise ValueError("No ID was returned on new pug insert")
+
+                self._pug_snapshot(pug, written)
+
+            else:
+                statements = self._pug_write(jsoninterface, pug)
+
+                if statements:
+                    yield momoko.Op(self.async_db.transaction, statements)
 
         except:
             logging.exception("An exception occurred flushing pug %s" % pug.id)
+            self._pug_logs.pop(pug.id, None)
+            raise
+
+    def flush_pugs(self, api_key, jsoninterface, pugs, async = False):
+        """
+        Flushes a batch of pugs in a single transaction. New pugs (with no ID)
+        are inserted individually, as we need their new ID.
+        """
+        if async:
+            return self._flush_pugs_async(api_key, jsoninterface, pugs)
+
+        new_pugs = [ x for x in pugs if x.id is None ]
+        existing = [ x for x in pugs if x.id is not None ]
+
+        for pug in new_pugs:
+            self.flush_pug(api_key, jsoninterface, pug)
+
+        if not existing:
+            return
+
+        conn, cursor = self._get_db_objects()
+
+        try:
+            for pug in existing:
+                for statement in self._pug_write(jsoninterface, pug):
+                    cursor.execute(*statement)
+
+            conn.commit()
+
+        except:
+            logging.exception("An exception occurred flushing pugs %s",
+                              [ x.id for x in existing ])
+
+            for pug in existing:
+                self._pug_logs.pop(pug.id, None)
+
+            raise
 
         finally:
             self._close_db_objects(cursor, conn)
 
+    @gen.coroutine
+    def _flush_pugs_async(self, api_key, jsoninterface, pugs):
+        new_pugs = [ x for x in pugs if x.id is None ]
+        existing = [ x for x in pugs if x.id is not None ]
+
+        for pug in new_pugs:
+            yield self._flush_pug_async(api_key, jsoninterface, pug)
+
+        if not existing:
+            return
+
+        statements = []
+        for pug in existing:
+            statements.extend(self._pug_write(jsoninterface, pug))
+
+        if not statements:
+            return
+
+        try:
+            yield momoko.Op(self.async_db.transaction, statements)
+
+        except:
+            logging.exception("An exception occurred flushing pugs %s",
+                              [ x.id for x in existing ])
+
+            for pug in existing:
+                self._pug_logs.pop(pug.id, None)
+
+            raise
+
+    def _pug_write(self, jsoninterface, pug):
+        """
+        Gets the statements to write an existing pug. The sections of the pug
+        which have changed since the last write are appended to pug_events.
+        The events are compacted into a new snapshot instead when the pug
+        changes state, when the game is over, when there are too many events
+        since the last snapshot, or if we don't know what was last written
+        (i.e. the pug was loaded, or the last write failed).
+
+        :return list A list of (query, params) tuples, to be executed in a
+                     single transaction
+        """
+        log = self._pug_logs.get(pug.id)
+
+        if (log is None or pug.game_over or log["state"] != pug.state or
+                log["events"] >= self.pug_compact_events):
+            written = {}
+            sections = jsoninterface.dump_sections(pug, written)
+
+            statements = [ ("UPDATE pugs SET data = %s WHERE id = %s",
+                            [jsoninterface.join_sections(sections), pug.id]),
+                           ("DELETE FROM pug_events WHERE pug_entity_id = %s",
+                            [pug.id]) ]
+
+            if pug.game_over:
+                statements.append(("""UPDATE pugs_index 
+                                      SET finished = true
+                                      WHERE pug_entity_id = %s""", [pug.id]))
+
+                # the pug won't be written again
+                self._pug_logs.pop(pug.id, None)
+
+            else:
+                self._pug_snapshot(pug, written)
+
+            return statements
+
+        delta = jsoninterface.dumps_delta(pug, log["written"])
+        if delta is None:
+            return []
+
+        log["events"] += 1
+
+        return [ ("""INSERT INTO pug_events (pug_entity_id, data) 
+                     VALUES (%s, %s)""", [pug.id, delta]) ]
+
+    def _pug_snapshot(self, pug, written):
+        """
+        Records what has been written as the pug's snapshot (from the JSON
+        interface's dump_sections), with no events after it
+        """
+        self._pug_logs[pug.id] = {
+            "state": pug.state,
+            "events": 0,
+            "written": written
+        }
+
     def get_servers(self, group):
         conn, cursor = self._get_db_objects()
 
@@ -349,31 +858,51 @@ class PSQLDatabaseInterface(BaseDatabaseInterface):
         finally:
             self._close_db_objects(cursor, conn)
 
-    def flush_server(self, server):
+    def flush_server(self, server, async = False):
+        if async:
+            return self._flush_server_async(server)
+
         conn, cursor = self._get_db_objects()
 
         try:
-            cursor.execute("""UPDATE servers 
-                              SET password = %s, pug_id = %s, log_port = %s
-                              WHERE id = %s""",
-                              [server.password, server.pug_id, server.log_port,
-                                server.id])
+            cursor.execute(*self._server_update(server))
 
             conn.commit()
 
         except:
             logging.exception("An exception occurred flushing a server")
+            raise
 
         finally:
             self._close_db_objects(cursor, conn)
 
-    def get_bans(self, cids = None, include_expired = False):
+    @gen.coroutine
+    def _flush_server_async(self, server):
+        try:
+            yield momoko.Op(self.async_db.execute, *self._server_update(server))
+
+        except:
+            logging.exception("An exception occurred flushing a server")
+            raise
+
+    def _server_update(self, server):
+        return ("""UPDATE servers 
+                   SET password = %s, pug_id = %s, log_port = %s
+                   WHERE id = %s""",
+                [server.password, server.pug_id, server.log_port, server.id])
+
+    def get_bans(self, cids = None, include_expired = False, async = False):
         """
         If cids is specified, we only get ban(s) matching those cids.
         If no cid is specified, we get bans depending on expired.
         If expired is set (True), we include expired bans as well, else
         we only get bans that have not expired.
         """
+        query, query_params = self._bans_query(cids, include_expired)
+
+        if async:
+            return self._get_bans_async(query, query_params)
+
         conn, cursor = self._get_db_objects()
         try:
             # like get_servers(), we want to use a dict cursor
@@ -381,33 +910,6 @@ class PSQLDatabaseInterface(BaseDatabaseInterface):
             cursor.close()
             cursor = conn.cursor(cursor_factory = psycopg2.extras.DictCursor)
 
-            # The base query will select ALL bans, regardless of CID/expired.
-            # Filtering checks below will parse the given parameters for
-            # appropriate filtering.
-            query = """SELECT id, banned_cid, banned_name,
-                        banner_cid, banner_name,
-                        ban_start_time, ban_duration, reason,
-                        expired
-                       FROM bans"""
-            query_params = []
-
-            if cids is not None and include_expired:
-                # if we WANT TO INCLUDE expired bans (i.e have expired AND 
-                # active), we ONLY filter by cid
-                query += " WHERE banned_cid IN %s"
-                query_params.append(tuple(cids))
-
-            elif cids is not None and not include_expired:
-                # if we _DON'T_ WANT TO INCLUDE expired bans, we filter by cid
-                # AND expired
-                query += " WHERE banned_cid IN %s AND expired = false"
-                query_params.append(tuple(cids))
-
-            elif cids is None and not include_expired:
-                # if NO CID is specified, and we DON'T WANT expired bans, we
-                # just filter by expired
-                query += " WHERE expired = false"
-
             cursor.execute(query, query_params)
 
             results = cursor.fetchall()
@@ -420,33 +922,62 @@ class PSQLDatabaseInterface(BaseDatabaseInterface):
         finally:
             self._close_db_objects(cursor, conn)
 
-    def flush_ban(self, ban):
+    @gen.coroutine
+    def _get_bans_async(self, query, query_params):
+        try:
+            cursor = yield momoko.Op(self.async_db.execute, query, 
+                            query_params,
+                            cursor_factory = psycopg2.extras.DictCursor)
+
+            results = cursor.fetchall()
+
+        except:
+            logging.exception("Exception getting bans")
+            return
+
+        raise gen.Return(results if results else [])
+
+    def _bans_query(self, cids, include_expired):
+        # The base query will select ALL bans, regardless of CID/expired.
+        # Filtering checks below will parse the given parameters for
+        # appropriate filtering.
+        query = """SELECT id, banned_cid, banned_name,
+                    banner_cid, banner_name,
+                    ban_start_time, ban_duration, reason,
+                    expired
+                   FROM bans"""
+        query_params = []
+
+        if cids is not None and include_expired:
+            # if we WANT TO INCLUDE expired bans (i.e have expired AND 
+            # active), we ONLY filter by cid
+            query += " WHERE banned_cid IN %s"
+            query_params.append(tuple(cids))
+
+        elif cids is not None and not include_expired:
+            # if we _DON'T_ WANT TO INCLUDE expired bans, we filter by cid
+            # AND expired
+            query += " WHERE banned_cid IN %s AND expired = false"
+            query_params.append(tuple(cids))
+
+        elif cids is None and not include_expired:
+            # if NO CID is specified, and we DON'T WANT expired bans, we
+            # just filter by expired
+            query += " WHERE expired = false"
+
+        return query, query_params
+
+    def flush_ban(self, ban, async = False):
+        if async:
+            return self._flush_ban_async(ban)
+
         # ban is as dictated in puglib/bans.py
         conn, cursor = self._get_db_objects()
         try:
-            if ban.id is None:
-                # new ban being inserted
-                cursor.execute("""INSERT INTO bans (banned_cid, banned_name,
-                                    banner_cid, banner_name,
-                                    ban_start_time, ban_duration, reason,
-                                    expired)
-                                  VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                                  RETURNING id""",
-                                ban.tuplify())
+            cursor.execute(*self._ban_write(ban))
 
-                result = cursor.fetchone()
-                if result and result[0]:
-                    ban.id = result[0]
-                else:
-                    raise ValueError("No ID was returned on new ban insert")
-            else:
-                # I think it's safe to assume the only thing that is going to
-                # to be updated is ban duration and whether or not the ban has
-                # expired.
-                cursor.execute("""UPDATE bans
-                                  SET reason = %s, ban_duration = %s, expired = %s
-                                  WHERE id = %s""", 
-                                [ ban.reason, ban.duration, ban.expired, ban.id ])
+            if ban.id is None:
+                self._set_ban_id(ban, cursor.fetchone())
 
             conn.commit()
         except:
@@ -455,6 +986,45 @@ class PSQLDatabaseInterface(BaseDatabaseInterface):
 
         finally:
             self._close_db_objects(cursor, conn)
+
+    @gen.coroutine
+    def _flush_ban_async(self, ban):
+        try:
+            cursor = yield momoko.Op(self.async_db.execute, 
+                                     *self._ban_write(ban))
+
+            if ban.id is None:
+                self._set_ban_id(ban, cursor.fetchone())
+
+        except:
+            logging.exception("Exception flushing ban")
+            raise
+
+    def _ban_write(self, ban):
+        if ban.id is None:
+            # new ban being inserted
+            return ("""INSERT INTO bans (banned_cid, banned_name,
+                        banner_cid, banner_name,
+                        ban_start_time, ban_duration, reason,
+                        expired)
+                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                       RETURNING id""",
+                    ban.tuplify())
+
+        else:
+            # I think it's safe to assume the only thing that is going to
+            # to be updated is ban duration and whether or not the ban has
+            # expired.
+            return ("""UPDATE bans
+                       SET reason = %s, ban_duration = %s, expired = %s
+                       WHERE id = %s""", 
+                    [ ban.reason, ban.duration, ban.expired, ban.id ])
+
+    def _set_ban_id(self, ban, result):
+        if result and result[0]:
+            ban.id = result[0]
+        else:
+            raise ValueError("No ID was returned on new ban insert")
     
     def _get_db_objects(self):
         """
@@ -0,0 +1,123 @@
+"""
+Runs blocking database interface calls on a bounded thread pool, so that they
+do not block the IOLoop. The synchronous connection pool used by the database
+interface must be thread safe (i.e. psycopg2.pool.ThreadedConnectionPool) and
+have at least as many connections as the executor has workers.
+
+Queue depth and the time calls spend waiting for a worker are recorded, so
+that the pool can be sized appropriately.
+"""
+
+import sys
+import logging
+import threading
+
+from timeit import default_timer as timer
+
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado.concurrent import Future
+
+class DatabaseExecutor(object):
+    def __init__(self, workers):
+        """
+        :param workers The max number of calls to run at once
+        """
+        self.workers = workers
+
+        self._executor = ThreadPoolExecutor(workers)
+
+        # metrics are updated from the worker threads
+        self._lock = threading.Lock()
+
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, method, *args, **kwargs):
+        """
+        Runs `method(*args, **kwargs)` on a worker thread.
+
+        :return Future A Future resolving to the result of the method, which
+                       can be yielded in a coroutine
+        """
+        with self._lock:
+            self.queued += 1
+
+        return self._executor.submit(self._run, timer(), method, args, kwargs)
+
+    def _run(self, submitted, method, args, kwargs):
+        wait = timer() - submitted
+
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+        success = False
+        try:
+            result = method(*args, **kwargs)
+            success = True
+
+            return result
+
+        finally:
+            with self._lock:
+                self.running -= 1
+
+                if success:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+    def stats(self):
+        """
+        Gets the executor's metrics
+
+        :return dict
+        """
+        with self._lock:
+            done = self.completed + self.failed
+
+            return {
+                "workers": self.workers,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "avg_wait": self.total_wait / done if done else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+    def log_stats(self):
+        logging.info("DB executor: %(queued)d queued, %(running)d running, "
+                     "%(completed)d completed, %(failed)d failed. "
+                     "Wait avg %(avg_wait).3fs, max %(max_wait).3fs",
+                     self.stats())
+
+    def shutdown(self, wait = True):
+        self._executor.shutdown(wait = wait)
+
+def run_blocking(executor, method, *args, **kwargs):
+    """
+    Runs a blocking method on the given executor. If there is no executor, the
+    method is run immediately instead.
+
+    :return Future A Future resolving to the result of the method
+    """
+    if executor is not None:
+        return executor.submit(method, *args, **kwargs)
+
+    future = Future()
+    try:
+        future.set_result(method(*args, **kwargs))
+    except Exception:
+        future.set_exc_info(sys.exc_info())
+
+    return future
@@ -2,6 +2,8 @@ from entities import Pug
 
 import json
 
+from collections import OrderedDict
+
 from BaseInterfaces import BaseJsonInterface
 
 """
@@ -15,24 +17,225 @@ This class conforms to psycopg's json methodology, so it can be used freely
 with PostgreSQL 9.2+ and JSON fields. You can of course use it to convert
 Pug objects to JSON and store it in string fields, or any applicable data
 field in your database of choice.
+
+Pugs are written in a compact, versioned format (FORMAT_VERSION). The pug is
+split into sections, each of which is encoded separately:
+
+    {"v": 2, "meta": {...}, "players": {...}, "votes": {...}, ...}
+
+Player dicts are stored as columns, so each SteamID and stat name is written
+once per section rather than once per player and stat. i.e. game_stats is
+
+    {"ids": [cid, ...], "keys": ["kills", ...], "rows": [[1, ...], ...]}
+
+Because the sections are encoded separately, a delta containing only the
+sections which have changed since the last write can be produced (see
+dumps_delta). The meta section and the player tables are diffed more finely:
+a delta only holds the meta attributes and the players' rows which have
+changed, and the players removed from each table are listed in "removed".
+Pugs written in the old format (a dump of the pug's __dict__) can still be
+loaded.
 """
 
+FORMAT_VERSION = 2
+
+# the pug attributes stored in each section. any attribute not listed here is
+# stored in the "meta" section
+SECTIONS = OrderedDict([
+    ("players", ("_players",)),
+    ("votes", ("player_votes",)),
+    ("teams", ("teams", "team_ratings", "game_scores", "medics")),
+    ("player_stats", ("player_stats",)),
+    ("game_stats", ("game_stats",)),
+    ("end_stats", ("end_stats",)),
+    ("records", ("disconnects", "disconnect_record", "leaver_record")),
+])
+
+# sections in which player dicts are stored as columns
+TABLE_SECTIONS = ("player_stats", "game_stats", "end_stats")
+
+# attributes which are not stored. the id is the row id, and the server and
+# player index are references set by the managers
+EXCLUDED = ("id", "server", "player_index")
+
+# meta attributes which are not compared when producing a delta. the version
+# changes on every change to the pug, so it is only written along with other
+# changes
+UNCOMPARED = ("version",)
+
 def default(obj):
     if isinstance(obj, set):
         return list(obj)
 
-    raise TypeError(repr(o) + " is not JSON serializable")
+    raise TypeError(repr(obj) + " is not JSON serializable")
+
+def _encode(obj):
+    # no whitespace after separators
+    return json.dumps(obj, default = default, separators = (",", ":"))
+
+def _encode_table(players):
+    """
+    Encodes a dict of { cid: dict } as columns. Missing values are listed
+    separately in "missing" as [row, column] pairs, so that None is kept.
+    """
+    ids = players.keys()
+    keys = sorted(set(k for x in players.itervalues() for k in x))
+
+    rows = []
+    missing = []
+    for row, cid in enumerate(ids):
+        values = players[cid]
+
+        if len(values) == len(keys):
+            rows.append([ values[k] for k in keys ])
+            continue
+
+        row_values = []
+        for column, k in enumerate(keys):
+            if k in values:
+                row_values.append(values[k])
+            else:
+                row_values.append(None)
+                missing.append([ row, column ])
+
+        rows.append(row_values)
+
+    table = { "ids": ids, "keys": keys, "rows": rows }
+    if missing:
+        table["missing"] = missing
+
+    return table
+
+def _row_prints(players):
+    """
+    Encodes each player's dict separately, to find the rows which have
+    changed since the last write
+
+    :return dict A dict of cid -> encoded dict
+    """
+    return dict((cid, json.dumps(values, default = default, sort_keys = True,
+                                 separators = (",", ":")))
+                for cid, values in players.iteritems())
+
+def _decode_table(table):
+    keys = table["keys"]
+
+    players = [ dict(zip(keys, row)) for row in table["rows"] ]
+    for row, column in table.get("missing", ()):
+        del players[row][keys[column]]
+
+    return dict(zip([ long(x) for x in table["ids"] ], players))
 
 class TFPugJsonInterface(BaseJsonInterface):
     def dumps(self, pug):
-        # need to establish a dictionary, and then dump it into a json string
-        # to do this, we use the object's inbuilt __dict__ method (inherited
-        # from base object class)
-        obj_dict = pug.__dict__.copy()
+        return self.join_sections(self.dump_sections(pug))
+
+    def dump_sections(self, pug, written = None):
+        """
+        Encodes each section of the pug
+
+        :param written (optional) A dict which is filled with what has been
+                       written, for `dumps_delta`
+
+        :return OrderedDict An OrderedDict of section name -> encoded section
+        """
+        meta = self._dump_meta(pug)
+
+        sections = OrderedDict()
+        sections["meta"] = _encode(meta)
+
+        for name in SECTIONS:
+            sections[name] = _encode(self._dump_section(pug, name))
+
+        if written is not None:
+            written.clear()
+            written["meta"] = self._meta_prints(meta)
+
+            for name in SECTIONS:
+                if name in TABLE_SECTIONS:
+                    written[name] = _row_prints(getattr(pug, name))
+                else:
+                    written[name] = sections[name]
+
+        return sections
+
+    def join_sections(self, sections):
+        """
+        Joins encoded sections (from dump_sections) into a single document
+        """
+        parts = [ '"%s":%s' % x for x in sections.iteritems() ]
+
+        return '{"v":%d,%s}' % (FORMAT_VERSION, ",".join(parts))
+
+    def dumps_delta(self, pug, written):
+        """
+        Encodes only the parts of the pug which have changed since they were
+        last written. For the meta section, only the changed attributes are
+        written, and for the player tables only the changed rows (and the ids
+        of the removed players).
+
+        :param written A dict of what was last written, from `dump_sections`
+                       or a previous delta (or empty, if nothing has been).
+                       It is updated with the changes
+
+        :return string The encoded changes, or None if nothing has changed.
+                       Applied on top of the last written sections with
+                       `apply_delta`
+        """
+        changed = OrderedDict()
+
+        for name in SECTIONS:
+            if name in TABLE_SECTIONS:
+                players = getattr(pug, name)
+                rows = _row_prints(players)
+                last = written.get(name, {})
+
+                updated = dict((cid, players[cid])
+                                for cid, x in rows.iteritems()
+                                if last.get(cid) != x)
+                removed = [ cid for cid in last if cid not in rows ]
+
+                if updated or removed:
+                    table = _encode_table(updated)
+                    table["removed"] = removed
+
+                    changed[name] = _encode(table)
+                    written[name] = rows
 
-        obj_dict["server"] = None # remove the server reference
+            else:
+                data = _encode(self._dump_section(pug, name))
 
-        return json.dumps(obj_dict, default = default)
+                if written.get(name) != data:
+                    changed[name] = data
+                    written[name] = data
+
+        meta = self._dump_meta(pug)
+        prints = self._meta_prints(meta)
+        last = written.get("meta", {})
+
+        meta_delta = dict((key, meta[key]) for key, x in prints.iteritems()
+                            if last.get(key) != x)
+
+        # attributes which are no longer stored are back to their defaults
+        # (i.e. the map list)
+        for key in last:
+            if key not in prints:
+                meta_delta[key] = getattr(pug, key)
+
+        if not meta_delta and not changed:
+            return None
+
+        written["meta"] = prints
+
+        for key in UNCOMPARED:
+            if key in meta:
+                meta_delta[key] = meta[key]
+
+        sections = OrderedDict()
+        sections["meta"] = _encode(meta_delta)
+        sections.update(changed)
+
+        return self.join_sections(sections)
 
     def loads(self, pid, data):
         # load the data into a dictionary and then set a Pug object's fields
@@ -40,12 +243,116 @@ class TFPugJsonInterface(BaseJsonInterface):
 
         pug = Pug.Pug()
 
+        if data_dict.get(u"v") == FORMAT_VERSION:
+            self._load_sections(pug, data_dict)
+
+        else:
+            self._load_legacy(pug, data_dict)
+
+        pug.id = pid
+
+        return pug
+
+    def apply_delta(self, pug, data):
+        """
+        Applies a delta from `dumps_delta` to a pug
+        """
+        self._load_sections(pug, json.loads(data))
+
+    def _dump_meta(self, pug):
+        """
+        :return dict The attributes of the pug which are stored in the meta
+                     section
+        """
+        meta = {}
+        stored = set(EXCLUDED)
+        for attrs in SECTIONS.itervalues():
+            stored.update(attrs)
+
+        for key, value in pug.__dict__.iteritems():
+            if key not in stored:
+                meta[key] = value
+
+        # the map list is only stored if it isn't the default
+        if meta.get("maps") == Pug.AVAILABLE_MAPS:
+            del meta["maps"]
+
+        return meta
+
+    def _meta_prints(self, meta):
+        """
+        Encodes each meta attribute separately, leaving out the attributes
+        which aren't compared
+
+        :return dict A dict of attribute -> encoded value
+        """
+        return dict((key, _encode(value)) for key, value in meta.iteritems()
+                    if key not in UNCOMPARED)
+
+    def _dump_section(self, pug, name):
+        if name in TABLE_SECTIONS:
+            return _encode_table(getattr(pug, name))
+
+        elif name == "players":
+            return { "ids": pug._players.keys(),
+                     "names": pug._players.values() }
+
+        elif name == "votes":
+            return { "ids": pug.player_votes.keys(),
+                     "maps": pug.player_votes.values() }
+
+        return dict((x, getattr(pug, x)) for x in SECTIONS[name])
+
+    def _load_sections(self, pug, data_dict):
+        for name, value in data_dict.iteritems():
+            if name == u"v":
+                continue
+
+            elif name == u"meta":
+                for key in value:
+                    setattr(pug, str(key), value[key])
+
+            elif name in TABLE_SECTIONS:
+                players = _decode_table(value)
+
+                if u"removed" in value:
+                    # a delta of the changed rows
+                    table = getattr(pug, str(name))
+                    for cid in value["removed"]:
+                        table.pop(long(cid), None)
+
+                    table.update(players)
+
+                else:
+                    setattr(pug, str(name), players)
+
+            elif name == u"players":
+                pug._players = dict(zip([ long(x) for x in value["ids"] ],
+                                        value["names"]))
+
+            elif name == u"votes":
+                pug.player_votes = dict(zip([ long(x) for x in value["ids"] ],
+                                            value["maps"]))
+
+            elif name == u"teams":
+                for key in value:
+                    setattr(pug, str(key), value[key])
+
+                # we should convert teams back to sets!
+                pug.teams = dict((team, set(value["teams"][team]))
+                                    for team in value["teams"])
+
+            else:
+                for key in value:
+                    setattr(pug, str(key), value[key])
+
+    def _load_legacy(self, pug, data_dict):
         for key in data_dict:
-            if (key == u'player_votes' or key == u'_players' or 
+            if (key == u'player_votes' or key == u'_players' or
                 key == u'player_stats' or key == u'game_stats' or
                 key == u'end_stats'):
 
-                # these keys are dictionaries, so we want to do them slightly 
+                # these keys are dictionaries, so we want to do them slightly
                 # different. i.e convert unicode keys back to longs
                 tmp = {}
                 for itemkey in data_dict[key]:
@@ -62,7 +369,3 @@ class TFPugJsonInterface(BaseJsonInterface):
                 data_dict[key] = tmp
 
             setattr(pug, str(key), data_dict[key])
-
-        pug.id = pid
-
-        return pug
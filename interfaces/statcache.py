@@ -0,0 +1,126 @@
+"""
+An in-process cache of deserialised player stats, used by the database
+interface so that repeated stat lookups for the same players (i.e. players
+re-adding to pugs) don't need to go to the database. Entries are evicted in
+least recently used order once the cache is full, and expire after a fixed
+time to live.
+
+The cache also remembers players which have no stats, so that lookups for new
+players are cached too. The cache is thread safe, as stats may be flushed on a
+worker thread.
+"""
+
+import time
+import threading
+
+from collections import OrderedDict
+
+class PlayerStatsCache(object):
+    def __init__(self, max_size, ttl, clock = time.time):
+        """
+        :param max_size The maximum number of players to cache
+        :param ttl The time in seconds an entry is valid for
+        :param clock (optional) The method used to get the current time
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._clock = clock
+
+        # steamid -> (expiry time, stats or None)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cids):
+        """
+        Gets the cached stats for the given players.
+
+        :param cids A list of 64bit SteamIDs
+
+        :return tuple A tuple in the form (stats, missing). stats is a dict of
+                      stats for the cached players that have stats, and missing
+                      is a list of the players which are not cached
+        """
+        now = self._clock()
+
+        stats = {}
+        missing = []
+
+        with self._lock:
+            self._get(cids, now, stats, missing)
+
+        return stats, missing
+
+    def _get(self, cids, now, stats, missing):
+        for cid in cids:
+            entry = self._entries.pop(cid, None)
+
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                missing.append(cid)
+                continue
+
+            self.hits += 1
+
+            # re-insert to mark the entry as most recently used
+            self._entries[cid] = entry
+
+            if entry[1] is not None:
+                # copy, so callers can't modify the cached stats
+                stats[cid] = dict(entry[1])
+
+    def put(self, cid, stats):
+        """
+        Caches the given stats for a player. If stats is None, the player is
+        cached as having no stats.
+        """
+        if stats is not None:
+            stats = dict(stats)
+
+        with self._lock:
+            self._entries.pop(cid, None)
+            self._entries[cid] = (self._clock() + self.ttl, stats)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last = False)
+
+    def invalidate(self, cids = None):
+        """
+        Removes the given players from the cache, or all players if no list is
+        given
+        """
+        with self._lock:
+            if cids is None:
+                self._entries.clear()
+
+            else:
+                for cid in cids:
+                    self._entries.pop(cid, None)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def __contains__(self, cid):
+        """
+        Whether the player is cached and their entry hasn't expired. This
+        doesn't count as a lookup, or mark the entry as recently used.
+        """
+        now = self._clock()
+
+        with self._lock:
+            entry = self._entries.get(cid)
+
+        return entry is not None and entry[0] > now
+
+    def __len__(self):
+        """
+        The number of entries held, including any which have expired but
+        haven't been looked up or evicted yet
+        """
+        with self._lock:
+            return len(self._entries)
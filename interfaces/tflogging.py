@@ -20,29 +20,34 @@ if USING_UNITY:
                                         settings.pes_api_userid,
                                         settings.pes_api_privatekey)
 
-round_win = re.compile(r'^L [0-9\/]+ - [0-9\:]+: World triggered "Round_Win" \x28winner "(Blue|Red)"\x29$')
-round_overtime = re.compile(r'^L [0-9\/]+ - [0-9\:]+: World triggered "Round_Overtime"$')
-round_length = re.compile(r'^L [0-9\/]+ - [0-9\:]+: World triggered "Round_Length" \x28seconds "(\d+)\.(\d+)"\x29$')
-round_start = re.compile(r'^L [0-9\/]+ - [0-9\:]+: World triggered "Round_Start"$')
-round_setup_start = re.compile(r'^L [0-9\/]+ - [0-9\:]+: World triggered "Round_Setup_Begin"$')
-round_setup_end = re.compile(r'^L [0-9\/]+ - [0-9\:]+: World triggered "Round_Setup_End"$')
+# Every log line begins with the same timestamp prefix. It is matched once by
+# check_regex_match, and the expressions below are then matched against the
+# remainder of the line (from the end of the prefix) only.
+log_prefix = re.compile(r'^L [0-9\/]+ - [0-9\:]+: ')
 
-player_connect = re.compile(r'^L [0-9\/]+ - [0-9\:]+: "(.*?)<(\d+)><(.*?)><>" connected, address "(.*?):(.*?)"$')
-player_disconnect = re.compile(r'^L [0-9\/]+ - [0-9\:]+: "(.*?)<(\d+)><(.*?)><(.*?)>" disconnected \x28reason "(.*?)"\x29$')
-player_validated = re.compile(r'^L [0-9\/]+ - [0-9\:]+: "(.*?)<(\d+)><(.*?)><>" STEAM USERID validated$')
+round_win = re.compile(r'World triggered "Round_Win" \x28winner "(Blue|Red)"\x29$')
+round_overtime = re.compile(r'World triggered "Round_Overtime"$')
+round_length = re.compile(r'World triggered "Round_Length" \x28seconds "(\d+)\.(\d+)"\x29$')
+round_start = re.compile(r'World triggered "Round_Start"$')
+round_setup_start = re.compile(r'World triggered "Round_Setup_Begin"$')
+round_setup_end = re.compile(r'World triggered "Round_Setup_End"$')
 
-team_score = re.compile(r'^L [0-9\/]+ - [0-9\:]+: Team "(Blue|Red)" current score "(\d+)" with "(\d+)" players$')
-final_team_score = re.compile(r'^L [0-9\/]+ - [0-9\:]+: Team "(Blue|Red)" final score "(\d+)" with "(\d+)" players$')
+player_connect = re.compile(r'"(.*?)<(\d+)><(.*?)><>" connected, address "(.*?):(.*?)"$')
+player_disconnect = re.compile(r'"(.*?)<(\d+)><(.*?)><(.*?)>" disconnected \x28reason "(.*?)"\x29$')
+player_validated = re.compile(r'"(.*?)<(\d+)><(.*?)><>" STEAM USERID validated$')
 
-game_over = re.compile(r'^L [0-9\/]+ - [0-9\:]+: World triggered "Game_Over" reason "(.*?)"$')
+team_score = re.compile(r'Team "(Blue|Red)" current score "(\d+)" with "(\d+)" players$')
+final_team_score = re.compile(r'Team "(Blue|Red)" final score "(\d+)" with "(\d+)" players$')
 
-chat_message = re.compile(r'^L [0-9\/]+ - [0-9\:]+: "(.*?)<(\d+)><(.*?)><(Red|Blue|Spectator|Console)>" (say|say_team) "(.*)"$')
+game_over = re.compile(r'World triggered "Game_Over" reason "(.*?)"$')
 
-player_kill = re.compile(r'^L [0-9\/]+ - [0-9\:]+: "(.*?)<(\d+)><(.*?)><(Red|Blue)>" killed "(.*?)<(\d+)><(.*?)><(Red|Blue)>" with "(.*?)" \x28attacker_position "(.*?)"\x29 \x28victim_position "(.*?)"\x29$')
-player_kill_special = re.compile(r'^L [0-9\/]+ - [0-9\:]+: "(.*?)<(\d+)><(.*?)><(Red|Blue)>" killed "(.*?)<(\d+)><(.*?)><(Red|Blue)>" with "(.*?)" \x28customkill "(.*?)"\x29 \x28attacker_position "(.*?)"\x29 \x28victim_position "(.*?)"\x29$')
-player_assist = re.compile(r'^L [0-9\/]+ - [0-9\:]+: "(.*?)<(\d+)><(.*?)><(Red|Blue)>" triggered "kill assist" against "(.*?)<(\d+)><(.*?)><(Red|Blue)>" \x28assister_position "(.*?)"\x29 \x28attacker_position "(.*?)"\x29 \x28victim_position "(.*?)"\x29$')
+chat_message = re.compile(r'"(.*?)<(\d+)><(.*?)><(Red|Blue|Spectator|Console)>" (say|say_team) "(.*)"$')
 
-unity_report = re.compile(r'^L [0-9\/]+ - [0-9\:]+: "{"token":"REPORT","data":{"reported":"(.*)","reporter":"(.*)","reason":"(.*)","matchId":(\d+)}}"')
+player_kill = re.compile(r'"(.*?)<(\d+)><(.*?)><(Red|Blue)>" killed "(.*?)<(\d+)><(.*?)><(Red|Blue)>" with "(.*?)" \x28attacker_position "(.*?)"\x29 \x28victim_position "(.*?)"\x29$')
+player_kill_special = re.compile(r'"(.*?)<(\d+)><(.*?)><(Red|Blue)>" killed "(.*?)<(\d+)><(.*?)><(Red|Blue)>" with "(.*?)" \x28customkill "(.*?)"\x29 \x28attacker_position "(.*?)"\x29 \x28victim_position "(.*?)"\x29$')
+player_assist = re.compile(r'"(.*?)<(\d+)><(.*?)><(Red|Blue)>" triggered "kill assist" against "(.*?)<(\d+)><(.*?)><(Red|Blue)>" \x28assister_position "(.*?)"\x29 \x28attacker_position "(.*?)"\x29 \x28victim_position "(.*?)"\x29$')
+
+unity_report = re.compile(r'"{"token":"REPORT","data":{"reported":"(.*)","reporter":"(.*)","reason":"(.*)","matchId":(\d+)}}"')
 
 regex = {
     "round": (round_win, round_overtime, round_length, round_start, 
@@ -56,12 +61,95 @@ regex = {
     "report": (unity_report,),
 }
 
+# Lookup tables used to pick the candidate expressions for a line, so that at
+# most one or two expressions are ever run against it. Candidates are tuples
+# of (group, expr).
+#
+# World events are keyed on the quoted event name, i.e. World triggered "<x>"
+WORLD_TRIGGER = 'World triggered "'
+world_events = {
+    "Round_Win": (("round", round_win),),
+    "Round_Overtime": (("round", round_overtime),),
+    "Round_Length": (("round", round_length),),
+    "Round_Start": (("round", round_start),),
+    "Round_Setup_Begin": (("round", round_setup_start),),
+    "Round_Setup_End": (("round", round_setup_end),),
+    "Game_Over": (("game_event", game_over),),
+}
+
+TEAM_PREFIX = 'Team "'
+team_events = (("team_score", team_score), ("team_score", final_team_score))
+
+REPORT_PREFIX = '"{"token":'
+report_events = (("report", unity_report),)
+
+# Player events are keyed on the verb following the player's name, i.e.
+# "name<uid><steamid><team>" <verb>. The "triggered" verb is followed by a
+# quoted event name, which is included in the key.
+PLAYER_END = '>" '
+player_events = {
+    "connected,": (("player_connection", player_connect),),
+    "disconnected": (("player_connection", player_disconnect),),
+    "STEAM": (("player_connection", player_validated),),
+    "say": (("chat", chat_message),),
+    "say_team": (("chat", chat_message),),
+    "killed": (("player_stat", player_kill), 
+               ("player_stat", player_kill_special)),
+    'triggered "kill assist"': (("player_stat", player_assist),),
+}
+
+def _candidates(data, pos):
+    """
+    Returns an iterable of (group, expr) tuples which could potentially match
+    the log line `data`, with the timestamp prefix ending at `pos`.
+    """
+    if data.startswith(WORLD_TRIGGER, pos):
+        start = pos + len(WORLD_TRIGGER)
+        return world_events.get(data[start:data.find('"', start)], ())
+
+    elif data.startswith(TEAM_PREFIX, pos):
+        return team_events
+
+    elif data.startswith(REPORT_PREFIX, pos):
+        return report_events
+
+    elif data.startswith('"', pos):
+        return _player_candidates(data, pos)
+
+    return ()
+
+def _player_candidates(data, pos):
+    # player names can contain just about anything, including '>" ', so we
+    # walk each potential end of the name until we find a known verb
+    end = data.find(PLAYER_END, pos)
+    while end != -1:
+        verb_start = end + len(PLAYER_END)
+        verb_end = data.find(" ", verb_start)
+        if verb_end == -1:
+            verb_end = len(data)
+
+        verb = data[verb_start:verb_end]
+        if verb == "triggered":
+            # include the quoted event name, i.e. triggered "kill assist"
+            verb_end = data.find('"', verb_end + 2) + 1
+            verb = data[verb_start:verb_end]
+
+        if verb in player_events:
+            for candidate in player_events[verb]:
+                yield candidate
+
+        end = data.find(PLAYER_END, end + 1)
+
 def check_regex_match(data):
-    for group in regex:
-        for expr in regex[group]:
-            match = expr.match(data)
-            if match:
-                return (group, match, expr) # return at the first regex match
+    prefix = log_prefix.match(data)
+    if prefix is None:
+        return None
+
+    pos = prefix.end()
+    for group, expr in _candidates(data, pos):
+        match = expr.match(data, pos)
+        if match:
+            return (group, match, expr) # return at the first regex match
 
     return None
 
@@ -130,6 +218,14 @@ class TFLogInterface(BaseLogInterface):
         # for pausing stat recording when game is not actually in progress
         self.ROUND_PAUSE = True
 
+    def use_secret(self, secret):
+        """
+        Only accept data with the given secret (i.e. sv_logsecret has been set
+        to this on the server)
+        """
+        self._using_secret = True
+        self._secret = secret
+
     def _verify_data(self, data):
         # check if we're using a secret
         if self._using_secret or data[0] == "S":
@@ -3,13 +3,18 @@
 
 import logging
 import time
+import functools
+
+from tornado import gen
 
 import settings
-import rating
+import ratingsystems
 
 from entities import Pug
 from entities.Pug import PlayerStats
 from interfaces import get_json_interface
+from interfaces.executor import run_blocking
+from flushqueue import FlushQueue, WriteChain
 from Exceptions import *
 
 class PugManager(object):
@@ -18,7 +23,8 @@ class PugManager(object):
     adding players to appropriate pugs, maintaining a list of active pugs,
     etc.
     """
-    def __init__(self, group, api_key, db, server_manager, ban_manager):
+    def __init__(self, group, api_key, db, server_manager, ban_manager,
+                 player_index = None, executor = None):
         self.game = "TF2"
 
         self._json_iface_cls = get_json_interface(self.game)
@@ -26,23 +32,56 @@ class PugManager(object):
         self.api_key = api_key
         self.db = db
 
-        # pugs are maintained as a list of Pug objects
+        # blocking database calls are run on the executor if one is given
+        self.executor = executor
+
+        # the end of game stat flush for each pug that is over. a pug is not
+        # ended until its stats have been written, so that players can't
+        # re-add and load their old stats in the meantime
+        self._stat_flushes = {}
+
+        # pugs are maintained as a list of Pug objects, and indexed by id
         self._pugs = []
+        self._pug_index = {}
 
         self.server_manager = server_manager
         self.ban_manager = ban_manager
 
-        # A list of all other pug managers in the same group, used to prevent
-        # people joining pugs when they are in another pug belonging to a
-        # manager in the same group.
+        # pug changes which do not need to be written immediately are queued,
+        # and written in batches
+        self._flush_queue = FlushQueue(self.__flush_pugs, 
+                                       settings.pug_flush_delay)
+
+        # pugs are written asynchronously, one write at a time so that writes
+        # of the same pug are applied in order
+        self._writes = WriteChain()
+
+        # set while status_check is running, as it waits for writes. checks
+        # are not overlapped
+        self._status_checking = False
+
+        # the version of each pug when it was last flushed, so that we only
+        # flush pugs which have changed since
+        self._flushed_versions = {}
+
+        # A dict of { player id: Pug } shared by all pug managers in the same
+        # group, used to prevent people joining pugs when they are in another
+        # pug belonging to a manager in the same group. The index is kept up
+        # to date by the pugs themselves as players are added and removed.
         self.group = group
-        self.group_managers = []
+        self._player_index = player_index if player_index is not None else {}
+
+        # each group can use a different rating system (see _update_ratings)
+        system = settings.rating_systems.get(group, 
+                                             settings.default_rating_system)
+        self.rating_system = ratingsystems.get_rating_system(system)()
 
         self.__load_pugs()
 
+    @gen.coroutine
     def add_player(self, player_id, player_name, pug_id):
         """
-        Adds a player to a pug. 
+        Adds a player to a pug. This is a coroutine.
 
         The player is added to the given pug id if possible. If not possible,
         an exception is raised.
@@ -60,13 +99,14 @@ class PugManager(object):
 
         # Use internal method to avoid duplication. Exception will be raised by
         # `_add_player` if adding the player is not possible.
-        self._add_player(pug, player_id, player_name)
+        yield self._add_player(pug, player_id, player_name)
 
-        # update the database with current pug details
-        self._flush_pug(pug)
+        # queue the updated pug details to be written to the database
+        self._queue_flush(pug)
 
-        return pug
+        raise gen.Return(pug)
 
+    @gen.coroutine
     def _add_player(self, pug, player_id, player_name):
         """
         Internal method for adding a player to the given pug object. Raises an
@@ -74,29 +114,35 @@ class PugManager(object):
         code duplication in `create_pug` and `add_player`. Note that this
         method does NOT flush the pug, so it must be done by the calling
         method after this succeeds.
-        """
-        # let's see if the user is banned/already in a pug
-        if self._player_banned(player_id):
-            raise PlayerBannedException("Player '%s' is banned" % player_id)
 
-        if self._player_in_pug(player_id):
-            raise PlayerInPugException("Player '%s' is already in pug" % player_id)
+        The player is reserved in the group's player index before anything
+        is waited on, so that they can't be added to another pug in the
+        meantime. If adding them fails, the reservation is released.
+        """
+        self._check_can_add(pug, player_id)
 
-        if pug.full:
-            raise PugFullException("Pug '%d' is full" % pug.id )
+        self._reserve_player(pug, player_id)
 
-        else:
+        try:
             # have potential pug. we need to check if the player is within the
             # rating restriction. meaning, we need to get the player stats here
+            stats = yield self._get_player_stats(player_id)
+
+            # other requests may have been handled while we were waiting for
+            # the stats (i.e. the pug may have filled), so the checks need to
+            # be done again
+            self._check_can_add(pug, player_id, reserved = True)
 
-            stats = self._get_player_stats(player_id)
             player_rating = stats[player_id]["rating"]
 
             if pug.player_restricted(player_rating):
                 raise PlayerRestrictedException("Player too good (or bad)")
 
-            else:
-                pug.add_player(player_id, player_name, stats[player_id])
+        except:
+            self._release_player(pug, player_id)
+            raise
+
+        pug.add_player(player_id, player_name, stats[player_id])
 
         # We now have a valid pug and the player has been aded. check if it's
         # full, and proceed to map voting. Only do this if the current state is
@@ -106,6 +152,43 @@ class PugManager(object):
         if pug.full and pug.state == Pug.states["GATHERING_PLAYERS"]:
             pug.begin_map_vote()
 
+    def _check_can_add(self, pug, player_id, reserved = False):
+        """
+        Raises an exception if the player cannot be added to the pug
+
+        :param reserved Whether the player has been reserved for the pug
+                        already, in which case they are not checked for being
+                        in a pug
+        """
+        if pug.game_over:
+            raise InvalidPugException("Pug '%s' is over" % pug.id)
+
+        # let's see if the user is banned/already in a pug
+        if self._player_banned(player_id):
+            raise PlayerBannedException("Player '%s' is banned" % player_id)
+
+        if not reserved and self._player_in_pug(player_id):
+            raise PlayerInPugException("Player '%s' is already in pug" % player_id)
+
+        if pug.full:
+            raise PugFullException("Pug '%d' is full" % pug.id )
+
+    def _reserve_player(self, pug, player_id):
+        """
+        Reserves the player for the given pug in the group's player index, so
+        that they are treated as being in the pug while they are being added
+        """
+        self._player_index[player_id] = pug
+
+    def _release_player(self, pug, player_id):
+        """
+        Releases a player reserved with `_reserve_player`, if they have not
+        been added to the pug
+        """
+        if (not pug.has_player(player_id) and 
+                self._player_index.get(player_id) is pug):
+            del self._player_index[player_id]
+
     def remove_player(self, player_id):
         """
         This method removes the given player ID from any pug they may be in.
@@ -130,18 +213,22 @@ class PugManager(object):
 
         # if there's no more players in the pug, we need to end it
         if pug.player_count == 0:
-            self._end_pug(pug)
+            self._end_pug(pug).add_done_callback(
+                    functools.partial(self._log_flush_failure, pug))
 
             raise PugEmptyEndException("Pug %d is empty and was ended" % pug.id)
         else:
+            self._queue_flush(pug)
+
             return pug
 
+    @gen.coroutine
     def create_pug(self, player_id, player_name, size = 12, pug_map = None,
                    custom_id = None, restriction = None):
         """
         This method is used to create a new pug. Size and map are optional. If 
         the player is already in a pug, is banned, or does not meet the
-        restriction themselves, an exception is raised.
+        restriction themselves, an exception is raised. This is a coroutine.
 
         :param player_id The ID of the player to add
         :param player_name The name of the player to add
@@ -167,27 +254,51 @@ class PugManager(object):
         # try to add the player to the newly created pug. if the player is
         # banned, restricted, or in another pug, _add_player will raise an
         # exception. The pug is not flushed to the database by _add_player.
-        self._add_player(pug, player_id, player_name)
-
-        # if we've reached here, player was successfully added to the pug.
-        # check if we can get a server or not. if not, raise an exception and
-        # escape before we add the pug to the internal list and flush it.
-        server = self.server_manager.allocate(pug)
-
-        # If the server returned is None, there are no servers available.
-        # Therefore, we raise an exception. Else, code continues and player
-        # gets added/pug gets flushed
-        if server is None:
-            raise NoAvailableServersException("No more servers are available")
-            
+        yield self._add_player(pug, player_id, player_name)
+
+        # the pug is registered with the group's player index while it is
+        # being created, so that its players can't join other pugs. it is only
+        # added to the list once it has an ID, so that nothing else tries to
+        # write it before it has been inserted
+        pug.set_player_index(self._player_index)
+
+        server = None
+        try:
+            # if we've reached here, player was successfully added to the pug.
+            # check if we can get a server or not. if not, raise an exception
+            # and escape before we add the pug to the internal list and flush
+            # it.
+            server = self.server_manager.allocate(pug)
+
+            # If the server returned is None, there are no servers available.
+            # Therefore, we raise an exception. Else, code continues and
+            # player gets added/pug gets flushed
+            if server is None:
+                raise NoAvailableServersException("No more servers are available")
+
+            version = pug.version
+
+            yield self._flush_pug(pug)
+
+        except:
+            # undo the allocation and registration, as the pug doesn't exist
+            pug.set_player_index(None)
+
+            if server is not None:
+                self.server_manager.release(server)
+
+            raise
+
         self._pugs.append(pug)
+        self._pug_flushed(pug, version)
 
-        self._flush_pug(pug)
+        # the pug has an ID now, so it can be indexed
+        self._index_pug(pug)
 
         # prepare the server for pug (empty it, set pw, update pug id, etc)
         self.server_manager.prepare(server)
 
-        return pug
+        raise gen.Return(pug)
 
     def end_pug(self, pug_id):
         """
@@ -196,35 +307,53 @@ class PugManager(object):
         an ID. 
 
         :param pug_id The ID of the pug to end
+
+        :return Future A Future which resolves once the ended pug has been
+                       written
         """
         pug = self.get_pug_by_id(pug_id)
 
         if pug is None:
             raise InvalidPugException("Pug with id %d does not exist", pug_id)
 
-        self._end_pug(pug)
+        return self._end_pug(pug)
 
+    @gen.coroutine
     def _end_pug(self, pug):
         """
-        Ends the given pug. This means we set the state to game over, reset the
-        assigned server, close the logging socket and flush the pug/server.
+        Ends the given pug. This means we set the state to game over, flush
+        the pug, and then reset the assigned server and close the logging
+        socket. This is a coroutine.
+
+        The pug is removed from the list and indexes straight away. If the
+        write fails, the pug is queued to be written again (see _flush_pug)
+        and the exception is raised.
 
         :param pug The pug to end
         """
-        # resetting the server automatically causes a server_manager flush.
-        # also closes the logging socket
-        self.server_manager.reset(pug.server)
-
         # set to game over so we never load this pug again if forced end
         pug.state = Pug.states["GAME_OVER"]
+        pug.mark_changed()
 
-        # flush updated pug
-        self._flush_pug(pug)
+        # remove the pug from the list and indexes first, so that nothing
+        # else acts on it while it is written
+        self._unindex_pug(pug)
+        self._flushed_versions.pop(pug, None)
+        self._stat_flushes.pop(pug, None)
 
-        # lastly, remove the pug from the list
         if pug in self._pugs:
             self._pugs.remove(pug)
 
+        try:
+            # flush updated pug
+            yield self._flush_pug(pug)
+
+        finally:
+            # the server is only released once the end of the pug has been
+            # written (or queued to be). resetting the server automatically
+            # causes a server_manager flush. also closes the logging socket
+            self.server_manager.reset(pug.server)
+
     def vote_map(self, player_id, pmap):
         """
         Adds a vote for the given map by the specified player.
@@ -250,8 +379,8 @@ class PugManager(object):
 
         pug.vote_map(player_id, pmap)
 
-        # update the database with current pug details
-        self._flush_pug(pug)
+        # queue the updated pug details to be written to the database
+        self._queue_flush(pug)
 
         return pug
 
@@ -273,8 +402,8 @@ class PugManager(object):
 
         pug.force_map(pmap)
 
-        # update the database with current pug details
-        self._flush_pug(pug)
+        # queue the updated pug details to be written to the database
+        self._queue_flush(pug)
 
         return pug
 
@@ -292,14 +421,7 @@ class PugManager(object):
 
         :return bool True if the player is in a pug, else False
         """
-        if self.get_player_pug(player_id) is not None:
-            return True
-        
-        for pm in self.group_managers:
-            if pm.get_player_pug(player_id) is not None:
-                return True
-
-        return False
+        return player_id in self._player_index
 
     def _player_banned(self, player_id):
         """
@@ -324,25 +446,42 @@ class PugManager(object):
 
         :return Pug The pug the player is in, or none
         """
-        for pug in self._pugs:
-            if pug.has_player(player_id):
-                return pug
+        pug = self._player_index.get(player_id)
+
+        # the player index is shared by the whole group, so the pug may belong
+        # to another manager
+        if pug is not None and self._pug_index.get(pug.id) is pug:
+            return pug
 
         return None
 
     def get_pug_by_id(self, pug_id):
         """
-        Searches through the pug list for a pug matching the given id.
+        Gets the pug matching the given id.
 
         :param pug_id The pug ID to search for
 
         :return Pug The pug matching the given ID, or None
         """
-        for pug in self._pugs:
-            if pug.id == pug_id:
-                return pug
+        return self._pug_index.get(pug_id)
 
-        return None
+    def _index_pug(self, pug):
+        """
+        Adds the pug to the pug id index, and its players to the group's
+        player index.
+        """
+        self._pug_index[pug.id] = pug
+        pug.set_player_index(self._player_index)
+
+    def _unindex_pug(self, pug):
+        """
+        Removes the pug from the pug id index, and its players from the
+        group's player index.
+        """
+        if self._pug_index.get(pug.id) is pug:
+            del self._pug_index[pug.id]
+
+        pug.set_player_index(None)
 
     def _get_pug_with_space(self, size = 12):
         """
@@ -359,108 +498,143 @@ class PugManager(object):
 
         return None
 
+    @gen.coroutine
     def status_check(self, ctime = 0):
         """
         Performs various status checks on all pugs managed by this manager.
         These includes things such as ending map votes, shuffling teams,
-        ending pugs at game over, etc.
+        ending pugs at game over, etc. This is a coroutine.
+
+        The writes which must not be lost (game over, ending a pug) are
+        waited for. A failure checking one pug is logged, and doesn't stop
+        the other pugs being checked. If the previous check is still running,
+        this does nothing.
 
         :param ctime The current epoch time (used for checking map vote end)
         """
-        for pug in self._pugs[:]:
-            if (pug.state == Pug.states["MAP_VOTING"]) and (ctime > pug.map_vote_end):
-                logging.debug("Map vote period is over for pug %d", pug.id)
-                # END MAP VOTING FOR THIS PUG
-                pug.end_map_vote()
-
-                # Make the teams and then change the map to the voted map
-                pug.shuffle_teams()
-                pug.server.change_map()
-                pug.setup_connect_timer()
-
-                self._flush_pug(pug)
-
-            elif (pug.state == Pug.states["MAPVOTE_COMPLETED"]):
-                # means the map was forced and begin_map_vote just set
-                # the state to mapvote_completed (i.e teams were not shuffled)
-                # so we need to shuffle teams and change map
-
-                pug.shuffle_teams()
-                pug.server.change_map()
-                pug.setup_connect_timer()
-
-                self._flush_pug(pug)
-
-            elif (pug.state == Pug.states["GAME_OVER"]):
-                # game is over! we need to update player rating based on the
-                # results, flush the pug one final time, and then remove pug
-                # from the internal list
-                if not pug.stats_done:
-                    self._update_ratings(pug)
-                
-                    pug.update_end_stats()
-                    self.__flush_pug_stats(pug)
-
-                # 10 second grace period for clients to update with the end
-                # stats and for players in the server to get the end of game
-                # panel and statistics in-game.
-                if ctime - pug.game_over_time > 10:
-                    self._end_pug(pug)
-
-            elif (pug.state == Pug.states["GATHERING_PLAYERS"] and
-                    ctime > pug.start_time + 1200):
-                # Pug has been looking for players for longer than 20 minutes,
-                # so we force end
-                
-                self._end_pug(pug)
-
-            elif (pug.state == Pug.states["REPLACEMENT_REQUIRED"]):
-                """
-                A replacement is required. If the game has not started yet
-                (i.e. has not gone live -> state is not GAME_STARTED) and 5
-                minutes has passed without a replacement joining, we end the
-                pug. Similarly, if the game is live, less than 15 minutes
-                has been played, and if no replacement is found in 5 minutes,
-                end the pug. 
-                """
-                #logging.debug("Pug is in replacement state. Game started: %s, "
-                #              "Replacement timed out: %s, replace timeout: %d, curr time: %d",
-                #              pug.game_started, pug.replacement_timed_out, 
-                #              pug.replacement_timeout, ctime)
-
-                if not pug.game_started and pug.replacement_timed_out:
-                    # Game not live, replace timed out. End the pug.
-                    self._end_pug(pug)
-
-                elif (pug.game_started and 
-                      ctime < pug.game_start_time + 900 and
-                      pug.replacement_timed_out):
-
-                    # Game is live, less than 15 minutes has elapsed and
-                    # replacement has timed out. End the pug.
-
-                    self._end_pug(pug)
-
-            if pug.has_disconnects:
-                # Check pugs for disconnects. If a player has been disconnected
-                # for longer than a certain time, they are removed.
-                pug.check_disconnects()
-                # If ALL players were removed from the pug after 
-                # `check_disconnects()`, there's likely something wrong with
-                # the server. End the pug straight away.
-                if pug.player_count == 0:
-                    self._end_pug(pug)
+        if self._status_checking:
+            return
+
+        self._status_checking = True
+
+        try:
+            for pug in self._pugs[:]:
+                # the pug may have been ended while waiting for a write
+                if pug not in self._pugs:
+                    continue
+
+                try:
+                    yield self.__check_pug(pug, ctime)
+
+                except Exception:
+                    logging.exception("Exception checking the status of pug "
+                                      "%s", pug.id)
+
+        finally:
+            self._status_checking = False
+
+    @gen.coroutine
+    def __check_pug(self, pug, ctime):
+        """
+        Performs the status checks on a single pug (see status_check)
+        """
+        if (pug.state == Pug.states["MAP_VOTING"]) and (ctime > pug.map_vote_end):
+            logging.debug("Map vote period is over for pug %d", pug.id)
+            # END MAP VOTING FOR THIS PUG
+            pug.end_map_vote()
+
+            # Make the teams and then change the map to the voted map
+            pug.shuffle_teams()
+            pug.server.change_map()
+            pug.setup_connect_timer()
+
+            self._queue_flush(pug)
+
+        elif (pug.state == Pug.states["MAPVOTE_COMPLETED"]):
+            # means the map was forced and begin_map_vote just set
+            # the state to mapvote_completed (i.e teams were not shuffled)
+            # so we need to shuffle teams and change map
+
+            pug.shuffle_teams()
+            pug.server.change_map()
+            pug.setup_connect_timer()
 
+            self._queue_flush(pug)
+
+        elif (pug.state == Pug.states["GAME_OVER"]):
+            # game is over! we need to update player rating based on the
+            # results, flush the pug one final time, and then remove pug
+            # from the internal list
+            if not pug.stats_done:
+                self._update_ratings(pug)
+            
+                pug.update_end_stats()
+                self.__flush_pug_stats(pug)
+
+                # the end of game must not be lost, so write it now
+                yield self._flush_pug(pug)
+
+            # 10 second grace period for clients to update with the end
+            # stats and for players in the server to get the end of game
+            # panel and statistics in-game.
+            if ctime - pug.game_over_time > 10 and self._stats_flushed(pug):
+                yield self._end_pug(pug)
+
+        elif (pug.state == Pug.states["GATHERING_PLAYERS"] and
+                ctime > pug.start_time + 1200):
+            # Pug has been looking for players for longer than 20 minutes,
+            # so we force end
+            
+            yield self._end_pug(pug)
+
+        elif (pug.state == Pug.states["REPLACEMENT_REQUIRED"]):
+            """
+            A replacement is required. If the game has not started yet
+            (i.e. has not gone live -> state is not GAME_STARTED) and 5
+            minutes has passed without a replacement joining, we end the
+            pug. Similarly, if the game is live, less than 15 minutes
+            has been played, and if no replacement is found in 5 minutes,
+            end the pug. 
+            """
+            #logging.debug("Pug is in replacement state. Game started: %s, "
+            #              "Replacement timed out: %s, replace timeout: %d, curr time: %d",
+            #              pug.game_started, pug.replacement_timed_out, 
+            #              pug.replacement_timeout, ctime)
+
+            if not pug.game_started and pug.replacement_timed_out:
+                # Game not live, replace timed out. End the pug.
+                yield self._end_pug(pug)
+
+            elif (pug.game_started and 
+                  ctime < pug.game_start_time + 900 and
+                  pug.replacement_timed_out):
+
+                # Game is live, less than 15 minutes has elapsed and
+                # replacement has timed out. End the pug.
+
+                yield self._end_pug(pug)
+
+        if pug in self._pugs and pug.has_disconnects:
+            # Check pugs for disconnects. If a player has been disconnected
+            # for longer than a certain time, they are removed.
+            pug.check_disconnects()
+            # If ALL players were removed from the pug after 
+            # `check_disconnects()`, there's likely something wrong with
+            # the server. End the pug straight away.
+            if pug.player_count == 0:
+                yield self._end_pug(pug)
+
+    @gen.coroutine
     def _get_multi_player_stats(self, players):
         """
-        Gets a list of player's stats
+        Gets a list of player's stats. This is a coroutine.
 
         :param players A list of 64bit SteamIDs
 
         :return dict A dict containing stats with CIDs as keys
         """
         # need to get player stats from livelogs, and med stats from pug db
-        stats = self.db.get_player_stats(players)
+        stats = yield self.db.get_player_stats(players, async = True)
 
         logging.debug("Player stats: %s", stats)
 
@@ -474,31 +648,57 @@ class PugManager(object):
                 # create new player stats object for this player
                 stats[cid] = PlayerStats()
 
-        return stats
+        raise gen.Return(stats)
 
+    @gen.coroutine
     def _get_player_stats(self, player_id):
         """
-        Get an individual player's stat data
+        Get an individual player's stat data. This is a coroutine.
 
         :param player_id The player's 64bit SteamID
 
         :return dict A dict of the player's stats with CID as key
         """
-        stats = self.db.get_player_stats([ player_id ])
+        stats = yield self.db.get_player_stats([ player_id ], async = True)
         if stats and player_id in stats:
             # player has existing stats. pass them through the player stats
             # object, which will initialize any new stats
             stats[player_id] = PlayerStats(stats[player_id])
-            return stats
+            raise gen.Return(stats)
 
         else:
             # return new, empty, playerstats object
-            return {
+            raise gen.Return({
                 player_id: PlayerStats()
-            }
+            })
 
     def __flush_pug_stats(self, pug):
-        self.db.flush_player_stats(pug.end_stats)
+        # the stats are copied, as the flush may happen on another thread
+        stats = dict((cid, dict(pug.end_stats[cid])) for cid in pug.end_stats)
+
+        self._stat_flushes[pug] = run_blocking(self.executor, 
+                                    self.db.flush_player_stats, stats)
+
+    def _stats_flushed(self, pug):
+        """
+        Whether the end of game stats of the pug have been written. If the
+        write failed, it is started again.
+        """
+        flush = self._stat_flushes.get(pug)
+        if flush is None:
+            return True
+
+        if not flush.done():
+            return False
+
+        if flush.exception() is not None:
+            logging.error("Flushing the end of game stats of pug %s failed. "
+                          "Retrying", pug.id, exc_info = flush.exc_info())
+
+            self.__flush_pug_stats(pug)
+            return False
+
+        return True
 
     def _update_ratings(self, pug):
         """
@@ -521,45 +721,22 @@ class PugManager(object):
         number of players (average it).
 
 
-        There are also other algorithms that could be used, such as TrueSkill,
-        or Glicko, which both have their ups and downs. For TrueSkill, I feel 
-        that the player's rating can vary greatly after a match. Sometimes
-        increasing after a win, sometimes decreasing depending on the team
-        ratings. The amount that the scores change by can vary significantly
-        too, such as an increase of ~60 for a player with 1700 rating when 
-        winning against a team with players all of lower rating. That being
-        said, it is probably more suitable to a team game than a hacked elo
-        based system. There is a python library available for TrueSkill.
-
-        Glicko, like Elo, is designed for chess. Therefore, to use it, it would
-        be necessary to hack it together for a team-based game, such as using
-        the duels method. The algorithm is a bit more complex, but not too
-        difficult to implement. It utilises a guassian distribution, and
-        uncertainty factors into the rating. There is also a python library
-        available for Glicko2
-
-        If a duel-based Elo system does not work out, implementing TrueSkill
-        or Glicko will not be too hard.
+        This is the default rating system. Glicko-2 and a TrueSkill-style
+        system can be used instead by setting the group's rating system in
+        settings.rating_systems (see ratingsystems.py). For TrueSkill, the
+        player's rating can vary greatly after a match, depending on the team
+        ratings, but it is probably more suitable to a team game than a hacked
+        elo based system. Glicko, like Elo, is designed for chess, so we treat
+        the opposing team as a single opponent. Both keep an uncertainty for
+        each player, so new players' ratings converge faster.
 
         :param pug The pug to update ratings for
         """
         team1, team2 = pug.teams.keys()
 
-        # we need to construct 2 lists of Rating, one for each team. These will
-        # be passed to the rating calculator
-        ratings = {
-            team1: [],
-            team2: []
-        }
-
         # rank in order of winning team. i.e [0, 1] = team 1 > team 2
         # [1, 0] = team 1 < team 2
         # we'll always put it in order of team 1 - team 2
-        ranking = []
-
-        for team in pug.teams:
-            ratings[team] = [ rating.Rating(pug.player_stats[x]["rating"]) for x in pug.teams[team] ]
-
         team1_game_score = pug.game_scores[team1]
         team2_game_score = pug.game_scores[team2]
 
@@ -572,22 +749,21 @@ class PugManager(object):
         else:
             ranking = [0, 0]
 
-        new_ratings = rating.calculate_rating([ratings[team1], ratings[team2]], ranking)
+        stats = lambda team: [ pug.player_stats[x] for x in pug.teams[team] ]
 
-        # new_ratings is a list in the form [team1_new, team2_new], where each
-        # teamX_new is a tuple of player ratings in the same order they were
-        # passed in (as Rating objects)
-        team1_rating, team2_rating = new_ratings
+        # new_stats is in the form (team1_new, team2_new), where each
+        # teamX_new is a list of dicts of the stats kept by the rating system,
+        # in the same order the players were passed in
+        new_stats = self.rating_system.rate(stats(team1), stats(team2), ranking)
 
-        # map player rating to player id, store as list of tuples which can be
-        # easily inserted into the db
-        mapper = lambda cid, r: (cid, float(r))
-        ratings_tupled = map(mapper, pug.teams[team1], team1_rating) + map(mapper, pug.teams[team2], team2_rating)
-        logging.debug("Players with new ratings: %s", ratings_tupled)
+        players = list(pug.teams[team1]) + list(pug.teams[team2])
+        player_stats = zip(players, new_stats[0] + new_stats[1])
+        logging.debug("Players with new ratings: %s", player_stats)
 
         # update player stats dict with new ratings in preparation for flush
-        for cid, new_rating in ratings_tupled:
-            pug.set_player_rating(cid, new_rating)
+        for cid, new in player_stats:
+            state = dict(new)
+            pug.set_player_rating(cid, state.pop("rating"), state)
 
     def __load_pugs(self):
         """
@@ -595,6 +771,8 @@ class PugManager(object):
         """
         # clear the pug list
         del self._pugs[:]
+        self._pug_index.clear()
+        self._flushed_versions.clear()
         logging.debug("Attempting to load pugs under API key %s", self.api_key)
  
         pugs = self.db.get_pugs(self.api_key, self._json_iface_cls())
@@ -611,32 +789,153 @@ class PugManager(object):
             # pug needs to be killed
             if ((pug.server_id is not None and pug.server is None)
               or (time.time() - pug.start_time) > 7200):
-                self._end_pug(pug)
+                self._end_pug(pug).add_done_callback(
+                        functools.partial(self._log_flush_failure, pug))
 
             elif pug.server is not None:
                 pug.server.pug = pug # make sure to give the server the pug again!
 
                 self._pugs.append(pug)
+                self._index_pug(pug)
+
+                self._flushed_versions[pug] = pug.version
 
         # If any servers were allocated previously to a pug and were not reset
         # for whatever reason, they are considered orphaned. We should
         # reset these servers so they will be available for use again.
         self.server_manager.reset_orphans()
         
+    @gen.coroutine
     def _flush_pug(self, pug):
         """
-        Flush the given pug to the database
+        Flush the given pug to the database immediately. This is used for
+        changes that must not be lost (i.e. pug creation and game over), and
+        supersedes any queued flush of the pug. This is a coroutine.
+
+        If the write fails, an existing pug is queued to be written again
+        with the next batch, and the exception is raised. New pugs are not
+        queued, as the caller (create_pug) needs to know the pug was not
+        created.
 
         :param pug The pug to flush
+
+        :return Future A Future which resolves once the pug has been written
         """
         logging.debug("Flushing pug to database. ID: %s", pug.id)
         jsoninterface = self._json_iface_cls()
 
-        self.db.flush_pug(self.api_key, jsoninterface, pug)
+        self._flush_queue.discard(pug)
+
+        version = pug.version
+
+        try:
+            yield self._writes.submit(self.db.flush_pug, self.api_key, 
+                                      jsoninterface, pug, async = True)
 
-    def flush_all(self):
+        except Exception:
+            if pug.id is not None:
+                self._flush_queue.add(pug)
+
+            raise
+
+        self._pug_flushed(pug, version)
+
+    def _queue_flush(self, pug):
+        """
+        Queue the given pug to be flushed to the database with the next batch.
+        New pugs are flushed immediately, as they need an ID.
+
+        :param pug The pug to flush
+        """
+        if pug.id is None:
+            self._flush_pug(pug).add_done_callback(
+                    functools.partial(self._log_flush_failure, pug))
+
+        else:
+            self._flush_queue.add(pug)
+
+    def _log_flush_failure(self, pug, future):
+        """
+        Logs the failure of a pug write which isn't waited for
         """
-        Flush all active pugs in this manager
+        if future.exception() is not None:
+            logging.error("Flushing pug %s failed", pug.id,
+                          exc_info = future.exc_info())
+
+    def __flush_pugs(self, pugs, async = True):
         """
+        Flush a batch of pugs to the database
+
+        :param pugs A list of pugs to flush
+        :param async (optional) Whether to write the pugs asynchronously or
+                                wait for the write to complete
+
+        :return Future A Future which resolves once the pugs have been written
+                       if async is True
+        """
+        logging.debug("Flushing pugs to database. IDs: %s", 
+                      [ x.id for x in pugs ])
+
+        if async:
+            return self.__flush_pugs_async(pugs)
+
+        versions = [ x.version for x in pugs ]
+
+        self.db.flush_pugs(self.api_key, self._json_iface_cls(), pugs)
+
+        for pug, version in zip(pugs, versions):
+            self._pug_flushed(pug, version)
+
+    @gen.coroutine
+    def __flush_pugs_async(self, pugs):
+        # the pugs may change while the write is waiting, so we record the
+        # versions as they were when the write was submitted. if the pugs
+        # changed, they are written again by the next flush
+        versions = [ x.version for x in pugs ]
+
+        yield self._writes.submit(self.db.flush_pugs, self.api_key,
+                                  self._json_iface_cls(), pugs, async = True)
+
+        for pug, version in zip(pugs, versions):
+            self._pug_flushed(pug, version)
+
+    def _pug_flushed(self, pug, version):
+        """
+        Records that the pug has been written as of the given version. Pugs
+        are only marked as flushed once the write has succeeded, so that a
+        failed write is retried by the next flush
+        """
+        # pugs which have been ended since the write was submitted are no
+        # longer tracked
+        if pug in self._pugs:
+            self._flushed_versions[pug] = version
+
+    def _pug_changed(self, pug):
+        """
+        Checks if the pug has changed since it was last flushed
+        """
+        return self._flushed_versions.get(pug) != pug.version
+
+    def flush_all(self, async = False):
+        """
+        Flush all active pugs in this manager which have changed since they
+        were last flushed.
+
+        :param async (optional) Whether to write the pugs asynchronously. The
+                                pugs must be written synchronously when 
+                                shutting down.
+        """
+        # the changed pugs are written with any queued pugs, which includes
+        # ended pugs whose last write failed. asynchronous writes go through
+        # the queue, so that they are queued again if they fail
         for pug in self._pugs:
-            self._flush_pug(pug)
+            if self._pug_changed(pug):
+                self._flush_queue.add(pug)
+
+        if async:
+            self._flush_queue.flush()
+            return
+
+        pugs = self._flush_queue.take()
+        if pugs:
+            self.__flush_pugs(pugs, async = False)
@@ -1,4 +1,12 @@
 import time
+import heapq
+import logging
+import itertools
+
+from tornado import ioloop, gen
+from tornado.concurrent import Future
+
+from flushqueue import WriteChain
 
 class Ban(dict):
     """
@@ -33,12 +41,20 @@ class Ban(dict):
 
     def check_expiration(self):
         # ban_duration of None means the ban is permanent
-        if self["ban_duration"] is None or self["ban_duration"] == 0:
+        if self.expiry_time is None:
             return
 
-        if time.time() > self["ban_start_time"] + self["ban_duration"]:
+        if time.time() > self.expiry_time:
             self["expired"] = True
 
+    @property
+    def expiry_time(self):
+        """ The time the ban expires at, or None if the ban is permanent """
+        if self["ban_duration"] is None or self["ban_duration"] == 0:
+            return None
+
+        return self["ban_start_time"] + self["ban_duration"]
+
     @property
     def duration(self):
         """ Gets ban duration """
@@ -78,16 +94,41 @@ class NoBanFoundException(Exception):
     pass
 
 class BanManager(object):
-    def __init__(self, db):
+    def __init__(self, db, io_loop = None):
+        """
+        :param db The database interface
+        :param io_loop (optional) The IOLoop to schedule ban expiry on
+        """
         self.db = db
 
-        self.bans = set()
+        # banned cid -> Ban
+        self.bans = {}
+
+        # a min-heap of (expiry time, sequence, Ban) for bans which expire.
+        # entries are not removed when a ban is removed or changed, they are
+        # skipped when they reach the top instead (see check_bans)
+        self._expiries = []
+        self._expiry_sequence = itertools.count()
+
+        # a single timeout is scheduled for the next ban to expire
+        self._io_loop = io_loop
+        self._expiry_timeout = None
+        self._expiry_timeout_loop = None
+        self._expiry_deadline = None
+
+        # bans are written asynchronously, in order
+        self._writes = WriteChain()
+
+        # banned cid -> Future resolving when the last add for that cid is
+        # done. adds for the same player are run one at a time
+        self._adding = {}
 
         self.__load_bans()
 
+    @gen.coroutine
     def add_ban(self, ban_data):
         """
-        Takes a dict (decoded JSON) of parameters for the ban. Format is:
+        This is a coroutine. Takes a dict (decoded JSON) of parameters for the ban. Format is:
         {
             "bannee": {
                 "id": cid,
@@ -125,75 +166,176 @@ class BanManager(object):
         ban["ban_duration"] = ban_data["duration"]
 
         try:
-            return self._add_ban(ban)
+            ban = yield self._add_ban(ban)
         except:
             raise BanAddException("Unable to add ban")
 
+        raise gen.Return(ban)
 
+    @gen.coroutine
     def _add_ban(self, ban):
         """
-        Internal method for adding ban to database/list
+        Internal method for adding ban to database/list. The ban is indexed
+        (and its expiry scheduled) before it is written, so that it applies
+        straight away, and is rolled back if the write fails. Adds for the
+        same player wait for the previous one to finish.
         """
+        cid = ban["banned_cid"]
+
+        previous = self._adding.get(cid)
+        done = Future()
+        self._adding[cid] = done
+
+        try:
+            if previous is not None:
+                yield previous
+
+            ban = yield self.__add_ban(ban)
+
+        finally:
+            done.set_result(None)
+
+            if self._adding.get(cid) is done:
+                del self._adding[cid]
+
+        raise gen.Return(ban)
+
+    @gen.coroutine
+    def __add_ban(self, ban):
         existing_ban = self.get_player_ban(ban["banned_cid"])
         if existing_ban is not None:
             # If the player already has an existing ban, we just update it with
             # the new values (might be a duration change/reason change)
             ban.id = existing_ban.id # make sure we set the ID or it'll dupe
+            old_values = dict(existing_ban)
             existing_ban.update(ban)
 
             ban = existing_ban
-            
-        self._flush_ban(ban)
 
-        if existing_ban is None:
-            self.bans.add(ban)
+        else:
+            self.bans[ban["banned_cid"]] = ban
+
+        self._push_expiry(ban)
+
+        try:
+            yield self._flush_ban(ban)
+
+        except:
+            if existing_ban is None:
+                if self.bans.get(ban["banned_cid"]) is ban:
+                    del self.bans[ban["banned_cid"]]
+
+            else:
+                # the ban may have been removed while it was being written
+                expired = ban.expired
+                ban.update(old_values)
+                ban.expired = expired
+
+            # the expiry pushed for the ban is skipped by check_bans, as the
+            # ban is no longer indexed or has a different expiry time
+            raise
 
-        return ban
+        raise gen.Return(ban)
 
+    @gen.coroutine
     def remove_ban(self, cid):
         """
         Public ban removal. Finds ban matching CID and then calls internal
-        method
+        method. This is a coroutine.
         """
         ban = self.get_player_ban(cid)
 
         if ban is None:
             raise NoBanFoundException("No ban found for %s" % cid)
 
-        self._remove_ban(ban)
+        yield self._remove_ban(ban)
 
     def _remove_ban(self, ban):
         """
-        Internal ban object removal. All we do is set expired to True, flush
-        the ban and then remove it from the set.
+        Internal ban object removal. All we do is set expired to True, remove
+        it from the set and then flush the ban.
+
+        :return Future A Future which resolves once the ban has been written
         """
         ban.expired = True
-        self._flush_ban(ban)
+        if self.bans.get(ban["banned_cid"]) is ban:
+            del self.bans[ban["banned_cid"]]
 
-        self.bans.remove(ban)
+        return self._flush_ban(ban)
 
     def get_player_ban(self, cid):
-        # Try find a ban matching the given cid. We check banned_cid
-        for b in self.bans:
-            if b["banned_cid"] == cid:
-                return b
-
-        return None
+        return self.bans.get(cid)
 
     def _flush_ban(self, ban):
-        self.db.flush_ban(ban)
+        # the asynchronous write uses momoko, so it doesn't need the executor
+        return self._writes.submit(self.db.flush_ban, ban, async = True)
 
 
     def check_bans(self):
         """
-        Check bans to see if any have expired
+        Removes the bans which have expired, and schedules the next check for
+        when the next ban expires
+        """
+        now = time.time()
+
+        while self._expiries and self._expiries[0][0] <= now:
+            expiry_time, sequence, ban = heapq.heappop(self._expiries)
+
+            # skip entries for bans which have since been removed or changed
+            if (self.bans.get(ban["banned_cid"]) is not ban or 
+                    ban.expiry_time != expiry_time):
+                continue
+
+            logging.info("Ban of %s has expired", ban["banned_cid"])
+            self._remove_ban(ban)
+
+        self._schedule_expiry()
+
+    def close(self):
+        """
+        Cancels the scheduled expiry check
+        """
+        if self._expiry_timeout is not None:
+            self._expiry_timeout_loop.remove_timeout(self._expiry_timeout)
+
+            self._expiry_timeout = None
+            self._expiry_deadline = None
+
+    def _push_expiry(self, ban):
+        if ban.expiry_time is None:
+            return
+
+        heapq.heappush(self._expiries, (ban.expiry_time, 
+                                        next(self._expiry_sequence), ban))
+
+        self._schedule_expiry()
+
+    def _schedule_expiry(self):
+        """
+        Schedules check_bans for when the ban at the top of the heap expires,
+        if it isn't already scheduled by then
         """
-        for b in self.bans.copy():
-            b.check_expiration()
+        if not self._expiries:
+            return
+
+        deadline = self._expiries[0][0]
+        if (self._expiry_deadline is not None and 
+                self._expiry_deadline <= deadline):
+            return
+
+        self.close()
 
-            if b.expired:
-                # ban is expired, need to delete it
-                self._remove_ban(b)
+        self._expiry_timeout_loop = self._io_loop or ioloop.IOLoop.current()
+        self._expiry_timeout = self._expiry_timeout_loop.call_later(
+                                    max(deadline - time.time(), 0), 
+                                    self._expiry_timer)
+        self._expiry_deadline = deadline
+
+    def _expiry_timer(self):
+        self._expiry_timeout = None
+        self._expiry_deadline = None
+
+        self.check_bans()
 
     def __load_bans(self):
         """
@@ -201,18 +343,29 @@ class BanManager(object):
         bans are managed entirely by this class. Hence, the database state will
         consistent with the stored state in this manager.
         """
+        self.close()
+
         self.bans.clear()
+        del self._expiries[:]
 
         bans = self.db.get_bans()
 
         for x in bans:
-            from pprint import pprint
             b = Ban(x)
-            pprint(b)
-            self.bans.add(b)
+            self.bans[b["banned_cid"]] = b
+
+            if b.expiry_time is not None:
+                self._expiries.append((b.expiry_time, 
+                                       next(self._expiry_sequence), b))
+
+        heapq.heapify(self._expiries)
+
+        # bans which expired while we were down are removed straight away
+        self._schedule_expiry()
 
 if __name__ == "__main__":
     from pprint import pprint
+    from tornado.ioloop import IOLoop
     """ Some simple tests of ban methods """
     b = Ban()
 
@@ -225,7 +378,7 @@ if __name__ == "__main__":
             pass
 
         def flush_ban(self, *args, **kwargs):
-            pass
+            return gen.maybe_future(None)
         def get_bans(self, *args, **kwargs):
             return []
 
@@ -246,21 +399,21 @@ if __name__ == "__main__":
         "duration": 2
     }
 
-    m.add_ban(new)
+    IOLoop.current().run_sync(lambda: m.add_ban(new))
     print "Getting added ban:"
     b = m.get_player_ban(1)
 
     pprint(b)
 
     print "Deleting ban and checking it:"
-    m.remove_ban(1)
+    IOLoop.current().run_sync(lambda: m.remove_ban(1))
 
     b = m.get_player_ban(1)
     pprint(b)
 
     print "Testing ban expiration"
     # test automatic expiration
-    m.add_ban(new)
+    IOLoop.current().run_sync(lambda: m.add_ban(new))
     b = m.get_player_ban(1)
     pprint(b)
 
@@ -0,0 +1,154 @@
+"""
+A write-behind queue for flushing entities to the database. Entities are
+marked dirty as they change, and all dirty entities are flushed together in a
+single batch a short time after the first one is marked. Repeated changes to
+the same entity before the batch is flushed only result in a single write. If
+the write of a batch fails, its entities are queued again.
+
+Also provides WriteChain, which runs asynchronous writes one after the other.
+"""
+
+import logging
+import functools
+
+from collections import OrderedDict
+
+from tornado import ioloop, gen
+from tornado.concurrent import is_future
+
+class FlushQueue(object):
+    def __init__(self, flush_callback, delay, io_loop = None):
+        """
+        :param flush_callback The method used to flush entities. Called with a
+                              list of entities in the order they were first
+                              marked dirty. If it returns a Future, the
+                              entities are queued again if the Future fails
+        :param delay The time in seconds to wait before flushing a batch
+        :param io_loop (optional) The IOLoop to schedule flushes on
+        """
+        self._flush_callback = flush_callback
+        self.delay = delay
+
+        self._io_loop = io_loop
+
+        # entity -> None. An OrderedDict gives us a set which maintains order
+        self._pending = OrderedDict()
+        self._timeout = None
+        self._timeout_loop = None
+
+    def add(self, entity):
+        """
+        Marks an entity as dirty, and schedules a flush if one is not already
+        scheduled.
+        """
+        self._pending[entity] = None
+
+        if self._timeout is None:
+            self._timeout_loop = self._io_loop or ioloop.IOLoop.current()
+            self._timeout = self._timeout_loop.call_later(self.delay, 
+                                                          self.flush)
+
+    def discard(self, entity):
+        """
+        Removes an entity from the queue (i.e. it has been flushed elsewhere)
+        """
+        self._pending.pop(entity, None)
+
+    def flush(self):
+        """
+        Flushes all pending entities now
+        """
+        entities = self.take()
+        if not entities:
+            return
+
+        logging.debug("Flushing %d queued entities", len(entities))
+
+        result = self._flush_callback(entities)
+
+        if is_future(result):
+            result.add_done_callback(functools.partial(self._flushed, 
+                                                       entities))
+
+    def _flushed(self, entities, future):
+        if future.exception() is None:
+            return
+
+        logging.error("Flush of %d entities failed, queueing them again",
+                      len(entities))
+
+        for entity in entities:
+            self.add(entity)
+
+    def take(self):
+        """
+        Removes all pending entities from the queue without flushing them, so
+        that they can be flushed by the caller
+
+        :return list The pending entities, in the order they were queued
+        """
+        self._cancel_timeout()
+
+        entities = self._pending.keys()
+        self._pending.clear()
+
+        return entities
+
+    def clear(self):
+        """
+        Drops all pending entities without flushing them
+        """
+        self._cancel_timeout()
+        self._pending.clear()
+
+    def _cancel_timeout(self):
+        if self._timeout is not None:
+            self._timeout_loop.remove_timeout(self._timeout)
+
+            self._timeout = None
+            self._timeout_loop = None
+
+    def __contains__(self, entity):
+        return entity in self._pending
+
+    def __len__(self):
+        return len(self._pending)
+
+class WriteChain(object):
+    """
+    Runs asynchronous database writes one at a time, in the order they were
+    submitted. Asynchronous writes may otherwise run concurrently on different
+    connections, in which case an older write of an entity could be applied
+    after a newer one.
+    """
+    def __init__(self):
+        self._last = None
+
+    def submit(self, method, *args, **kwargs):
+        """
+        Runs `method(*args, **kwargs)` once all previously submitted writes
+        are done. The method must return a Future (or other yieldable).
+
+        :return Future A Future resolving to the result of the method
+        """
+        future = self._run(self._last, method, args, kwargs)
+        self._last = future
+
+        return future
+
+    @gen.coroutine
+    def _run(self, previous, method, args, kwargs):
+        if previous is not None and not previous.done():
+            try:
+                yield previous
+            except Exception:
+                # the error is the concern of whoever submitted the write
+                pass
+
+        result = yield method(*args, **kwargs)
+
+        raise gen.Return(result)
+
+    @property
+    def idle(self):
+        return self._last is None or self._last.done()
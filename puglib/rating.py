@@ -1,6 +1,13 @@
 
 import math
 import numbers
+import logging
+
+try:
+    import numpy
+except ImportError:
+    logging.info("numpy is not available. Batch rating will not be vectorised")
+    numpy = None
 
 K_table = {
     "2.0": 6,
@@ -152,3 +159,176 @@ def calculate_rating(teams, rank):
 
     return new
 
+
+def _actual_score(rank, i, j):
+    # rank is reverse sorted (i.e 0,1,2,3), so lower is better
+    if rank[i] < rank[j]:
+        return WIN
+    elif rank[i] > rank[j]:
+        return LOSS
+    else:
+        return DRAW
+
+def calculate_ratings_batch(games):
+    """
+    Calculates the new ratings for many 2-team games at once. The results are
+    exactly those of `calculate_rating` for each game, but the duels for all
+    games with the same team sizes are computed together with numpy arrays.
+
+    The games must be independent (i.e. no player in more than one game), as
+    every game is rated using the ratings given.
+
+    :param games A list of games in the form (team1, team2, rank), where the
+                 teams are lists of ratings (floats or Rating objects) and
+                 rank is as for `calculate_rating`
+
+    :return list A list of the new ratings for each game, in the form
+                 (team1 ratings, team2 ratings), where each is a tuple of
+                 floats in the same order as given
+    """
+    if numpy is None:
+        return [ tuple(tuple(float(r) for r in team) for team in 
+                        calculate_rating([ [ Rating(x) for x in t1 ], 
+                                           [ Rating(x) for x in t2 ] ], rank))
+                 for t1, t2, rank in games ]
+
+    results = [ None ] * len(games)
+
+    # group the games by team sizes, so that each group can be stacked
+    groups = {}
+    for index, (team1, team2, rank) in enumerate(games):
+        groups.setdefault((len(team1), len(team2)), []).append(index)
+
+    for (size1, size2), indexes in groups.iteritems():
+        # ratings are rounded as they would be by Rating, and K-factors are
+        # looked up once per player rather than once per duel
+        ratings1 = [ [ round(float(x), 3) for x in games[i][0] ] 
+                        for i in indexes ]
+        ratings2 = [ [ round(float(x), 3) for x in games[i][1] ] 
+                        for i in indexes ]
+
+        t1 = numpy.array(ratings1, dtype = numpy.float64).reshape(-1, size1)
+        t2 = numpy.array(ratings2, dtype = numpy.float64).reshape(-1, size2)
+        k1 = numpy.array([ [ K_lookup(x) for x in r ] for r in ratings1 ],
+                         dtype = numpy.float64).reshape(-1, size1)
+        k2 = numpy.array([ [ K_lookup(x) for x in r ] for r in ratings2 ],
+                         dtype = numpy.float64).reshape(-1, size2)
+
+        score1 = numpy.array([ _actual_score(games[i][2], 0, 1) 
+                                for i in indexes ], dtype = numpy.float64)
+        score2 = numpy.array([ _actual_score(games[i][2], 1, 0) 
+                                for i in indexes ], dtype = numpy.float64)
+
+        K_mitigate = 1.0/(1 + abs(size1 - size2))
+        divisor = max(size1, size2)
+
+        new1 = _duel_ratings(t1, t2, k1, k2, score1, K_mitigate, divisor)
+        new2 = _duel_ratings(t2, t1, k2, k1, score2, K_mitigate, divisor)
+
+        for row, i in enumerate(indexes):
+            results[i] = (tuple(round(x, 3) for x in new1[row]),
+                          tuple(round(x, 3) for x in new2[row]))
+
+    return results
+
+def _duel_ratings(team, e_team, k_team, k_e_team, actual_score, K_mitigate,
+                  divisor):
+    """
+    Computes the new ratings of `team` from its duels against `e_team`, for a
+    stack of games. Arrays are (games, players) and actual_score is (games,).
+    The operations are done in the same order as in `calculate_rating`, so
+    that the results are identical.
+
+    :return list A list of lists of new (unrounded) ratings
+    """
+    p = team[:, :, None]
+    e = e_team[:, None, :]
+
+    expected_score = 1/(1 + numpy.power(10, (e - p)/400))
+
+    # the winner's K-factor is used, and in the case of a draw the K-factor
+    # of the last opponent with a lower rating (the K-factor carries over
+    # to the following duels in calculate_rating)
+    k_p = numpy.broadcast_to(k_team[:, :, None], expected_score.shape)
+    k_e = numpy.broadcast_to(k_e_team[:, None, :], expected_score.shape)
+
+    lower = numpy.where(p > e, numpy.arange(e_team.shape[1]), -1)
+    last_lower = numpy.maximum.accumulate(lower, axis = 2)
+
+    k_draw = numpy.where(last_lower >= 0, 
+                numpy.take_along_axis(k_e, numpy.maximum(last_lower, 0), 
+                                      axis = 2),
+                k_p)
+
+    outcome = actual_score[:, None, None]
+    K_factor = numpy.where(outcome == LOSS, k_e, 
+                           numpy.where(outcome == DRAW, k_draw, k_p))
+
+    rating_gain = K_mitigate*K_factor*(outcome - expected_score)
+
+    # accumulate sequentially (sum() is pairwise), as the duels are summed
+    duel_sum = numpy.add.accumulate(rating_gain, axis = 2)[:, :, -1]
+
+    return (team + duel_sum/divisor).tolist()
+
+def independent_batches(history, batch_size = 512):
+    """
+    Splits a history of games into batches of consecutive games with no
+    players in common. Rating the games in a batch together gives the same
+    result as rating them one by one.
+
+    :param history An iterable of games in chronological order, in the form
+                   (team1, team2, rank), where the teams are lists of player
+                   ids. It is only iterated once, so it can be a generator
+    :param batch_size (optional) The max number of games in a batch
+
+    :return generator A generator of lists of games
+    """
+    batch = []
+    batch_players = set()
+
+    for game in history:
+        players = set(game[0]) | set(game[1])
+
+        if len(batch) >= batch_size or not batch_players.isdisjoint(players):
+            yield batch
+
+            batch = []
+            batch_players.clear()
+
+        batch.append(game)
+        batch_players.update(players)
+
+    if batch:
+        yield batch
+
+def recompute_ratings(history, ratings = None, batch_size = 512):
+    """
+    Replays a history of games to compute everyone's rating from scratch.
+    Consecutive games with no players in common are rated together in a
+    single batch (see independent_batches).
+
+    :param history An iterable of games in chronological order, in the form
+                   (team1, team2, rank), where the teams are lists of player
+                   ids. It is only iterated once, so it can be a generator
+    :param ratings (optional) A dict of player id -> rating to start from.
+                   Players not in it start at BASE. It is updated in place
+    :param batch_size (optional) The max number of games in a batch
+
+    :return dict A dict of player id -> rating
+    """
+    if ratings is None:
+        ratings = {}
+
+    for batch in independent_batches(history, batch_size):
+        games = [ ([ ratings.get(x, BASE) for x in team1 ],
+                   [ ratings.get(x, BASE) for x in team2 ], rank)
+                  for team1, team2, rank in batch ]
+
+        new_ratings = calculate_ratings_batch(games)
+
+        for (team1, team2, rank), (new1, new2) in zip(batch, new_ratings):
+            ratings.update(zip(team1, new1))
+            ratings.update(zip(team2, new2))
+
+    return ratings
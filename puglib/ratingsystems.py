@@ -0,0 +1,467 @@
+"""
+Rating systems which can be used to rate pugs. Each pug group can use a
+different system (see settings.rating_systems).
+
+All systems work on the player stats dicts of the two teams. Each system
+keeps the stats listed in its `stats` dict for every player (e.g. Glicko-2
+keeps a rating deviation and volatility as well as the rating), and players
+which don't have a stat yet start at the default given there.
+
+The systems rate whole batches of games at once. The players of games with
+the same team sizes are stacked into numpy arrays and updated together, so
+the cost of rating a game is a handful of array operations regardless of how
+many players are in it.
+"""
+
+import math
+import logging
+
+import rating
+
+try:
+    import numpy
+except ImportError:
+    logging.info("numpy is not available. Only the Elo rating system can be used")
+    numpy = None
+
+def _size_groups(games):
+    """
+    Groups games by their team sizes, so that each group can be stacked
+
+    :return dict A dict of (team1 size, team2 size) -> list of game indexes
+    """
+    groups = {}
+    for index, game in enumerate(games):
+        groups.setdefault((len(game[0]), len(game[1])), []).append(index)
+
+    return groups
+
+def _cdf(x):
+    return 0.5*math.erfc(-x/math.sqrt(2))
+
+def _pdf(x):
+    return math.exp(-x*x/2)/math.sqrt(2*math.pi)
+
+def _inverse_cdf(p):
+    # bisection is plenty, as this is only used for constants
+    low, high = -10.0, 10.0
+    for i in range(100):
+        mid = (low + high)/2
+        if _cdf(mid) < p:
+            low = mid
+        else:
+            high = mid
+
+    return (low + high)/2
+
+class RatingSystem(object):
+    """
+    The interface implemented by every rating system
+    """
+    name = None
+
+    # the stats kept for each player by this system, and their starting values
+    stats = { "rating": rating.BASE }
+
+    def rate(self, team1, team2, rank):
+        """
+        Rates a single game
+
+        :param team1 A list of the stats dicts of the players in team 1
+        :param team2 A list of the stats dicts of the players in team 2
+        :param rank The rank of the teams, as for `rating.calculate_rating`
+
+        :return tuple The new stats of the players, in the form
+                      (team1 stats, team2 stats), where each is a list of
+                      dicts of the stats to set, in the same order as given
+        """
+        return self.rate_batch([ (team1, team2, rank) ])[0]
+
+    def rate_batch(self, games):
+        """
+        Rates many games at once. The games must be independent (i.e. no
+        player in more than one game).
+
+        :param games A list of games in the form (team1, team2, rank)
+
+        :return list A list of the results of `rate` for each game
+        """
+        raise NotImplementedError("rate_batch is not implemented")
+
+    def win_probability(self, team1, team2):
+        """
+        The probability that team 1 beats team 2, given their current stats
+        """
+        return self.predict_batch([ (team1, team2) ])[0]
+
+    def predict_batch(self, games):
+        """
+        :param games A list of games in the form (team1, team2)
+
+        :return list A list of the probability that team 1 wins each game
+        """
+        raise NotImplementedError("predict_batch is not implemented")
+
+    def _stat(self, player, stat):
+        value = player.get(stat)
+        if value is None:
+            return self.stats[stat]
+
+        return float(value)
+
+    def _team_stat(self, team, stat):
+        return [ self._stat(x, stat) for x in team ]
+
+    def _stat_array(self, games, indexes, team, stat, size):
+        return numpy.array([ self._team_stat(games[i][team], stat)
+                                for i in indexes ],
+                           dtype = numpy.float64).reshape(-1, size)
+
+class EloRatingSystem(RatingSystem):
+    """
+    The duels Elo system described in PugManager._update_ratings. Ratings are
+    computed by rating.calculate_ratings_batch, so this works without numpy.
+    """
+    name = "elo"
+
+    def rate_batch(self, games):
+        new_ratings = rating.calculate_ratings_batch([
+                            (self._team_stat(team1, "rating"),
+                             self._team_stat(team2, "rating"), rank)
+                            for team1, team2, rank in games ])
+
+        return [ ([ { "rating": x } for x in new1 ],
+                  [ { "rating": x } for x in new2 ])
+                 for new1, new2 in new_ratings ]
+
+    def predict_batch(self, games):
+        probabilities = []
+
+        for team1, team2 in games:
+            ratings1 = self._team_stat(team1, "rating")
+            ratings2 = self._team_stat(team2, "rating")
+
+            # the average expected score of team 1's duels
+            expected = 0.0
+            for p in ratings1:
+                for e in ratings2:
+                    expected += 1/(1 + math.pow(10, (e - p)/400))
+
+            probabilities.append(expected/(len(ratings1)*len(ratings2)))
+
+        return probabilities
+
+class Glicko2RatingSystem(RatingSystem):
+    """
+    Glicko-2 (http://www.glicko.net/glicko/glicko2.pdf), adapted for teams by
+    treating the opposing team as a single opponent with the mean rating and
+    the root mean square deviation of its players. Each game is one rating
+    period.
+    """
+    name = "glicko2"
+
+    # converts between the Glicko-2 and Glicko scales
+    SCALE = 173.7178
+
+    # constrains the change in volatility over time
+    TAU = 0.5
+
+    # convergence tolerance for the volatility iteration
+    EPSILON = 0.000001
+    MAX_ITERATIONS = 100
+
+    stats = {
+        "rating": rating.BASE,
+        "rating_rd": 350.0,
+        "rating_vol": 0.06
+    }
+
+    def __init__(self):
+        if numpy is None:
+            raise ImportError("numpy is required for the Glicko-2 rating system")
+
+    def rate_batch(self, games):
+        results = [ None ] * len(games)
+
+        for (size1, size2), indexes in _size_groups(games).iteritems():
+            mu1, phi1, sigma1 = self._arrays(games, indexes, 0, size1)
+            mu2, phi2, sigma2 = self._arrays(games, indexes, 1, size2)
+
+            score1 = numpy.array([ rating._actual_score(games[i][2], 0, 1)
+                                    for i in indexes ], dtype = numpy.float64)
+
+            new1 = self._update(mu1, phi1, sigma1, mu2, phi2, score1)
+            new2 = self._update(mu2, phi2, sigma2, mu1, phi1, 1 - score1)
+
+            for row, i in enumerate(indexes):
+                results[i] = (self._player_stats(new1, row),
+                              self._player_stats(new2, row))
+
+        return results
+
+    def predict_batch(self, games):
+        probabilities = [ None ] * len(games)
+
+        for (size1, size2), indexes in _size_groups(games).iteritems():
+            mu1, phi1, sigma1 = self._arrays(games, indexes, 0, size1)
+            mu2, phi2, sigma2 = self._arrays(games, indexes, 1, size2)
+
+            phi = numpy.sqrt((phi1**2).mean(axis = 1) + (phi2**2).mean(axis = 1))
+            p = self._expected(mu1.mean(axis = 1), mu2.mean(axis = 1), phi)
+
+            for row, i in enumerate(indexes):
+                probabilities[i] = float(p[row])
+
+        return probabilities
+
+    def _arrays(self, games, indexes, team, size):
+        mu = (self._stat_array(games, indexes, team, "rating", size) -
+                rating.BASE)/self.SCALE
+        phi = self._stat_array(games, indexes, team, "rating_rd", size)/self.SCALE
+        sigma = self._stat_array(games, indexes, team, "rating_vol", size)
+
+        return mu, phi, sigma
+
+    def _player_stats(self, arrays, row):
+        mu, phi, sigma = arrays
+
+        return [ { "rating": round(m*self.SCALE + rating.BASE, 3),
+                   "rating_rd": round(p*self.SCALE, 3),
+                   "rating_vol": s }
+                 for m, p, s in zip(mu[row].tolist(), phi[row].tolist(),
+                                    sigma[row].tolist()) ]
+
+    def _g(self, phi):
+        return 1/numpy.sqrt(1 + 3*phi**2/math.pi**2)
+
+    def _expected(self, mu, e_mu, e_phi):
+        return 1/(1 + numpy.exp(-self._g(e_phi)*(mu - e_mu)))
+
+    def _update(self, mu, phi, sigma, e_mu, e_phi, score):
+        """
+        Updates a team's players against the composite opponent. Arrays are
+        (games, players) and score is (games,)
+
+        :return tuple The new (mu, phi, sigma) arrays
+        """
+        o_mu = e_mu.mean(axis = 1)[:, None]
+        o_phi = numpy.sqrt((e_phi**2).mean(axis = 1))[:, None]
+        score = score[:, None]
+
+        g = self._g(o_phi)
+        expected = self._expected(mu, o_mu, o_phi)
+
+        v = 1/(g**2*expected*(1 - expected))
+        delta = v*g*(score - expected)
+
+        sigma = self._volatility(phi, sigma, v, delta)
+
+        phi_star = numpy.sqrt(phi**2 + sigma**2)
+        phi = 1/numpy.sqrt(1/phi_star**2 + 1/v)
+        mu = mu + phi**2*g*(score - expected)
+
+        return mu, phi, sigma
+
+    def _volatility(self, phi, sigma, v, delta):
+        """
+        Step 5 of the algorithm (the Illinois algorithm), done for every
+        player at once. Players stop being updated once they have converged.
+        """
+        a = numpy.log(sigma**2)
+        phi2 = phi**2
+        delta2 = delta**2
+        tau2 = self.TAU**2
+
+        def f(x):
+            ex = numpy.exp(x)
+            return (ex*(delta2 - phi2 - v - ex)/(2*(phi2 + v + ex)**2) -
+                    (x - a)/tau2)
+
+        A = a
+        large = delta2 > phi2 + v
+        B = numpy.where(large, numpy.log(numpy.maximum(delta2 - phi2 - v,
+                                                       1e-300)),
+                        a - self.TAU)
+
+        k = 1
+        stepping = ~large & (f(B) < 0)
+        while stepping.any() and k < self.MAX_ITERATIONS:
+            k += 1
+            B = numpy.where(stepping, a - k*self.TAU, B)
+            stepping &= f(B) < 0
+
+        fA = f(A)
+        fB = f(B)
+
+        with numpy.errstate(divide = "ignore", invalid = "ignore"):
+            for i in range(self.MAX_ITERATIONS):
+                active = numpy.abs(B - A) > self.EPSILON
+                if not active.any():
+                    break
+
+                C = A + (A - B)*fA/(fB - fA)
+                fC = f(C)
+
+                swap = fC*fB < 0
+
+                A = numpy.where(active, numpy.where(swap, B, A), A)
+                fA = numpy.where(active, numpy.where(swap, fB, fA/2), fA)
+                B = numpy.where(active, C, B)
+                fB = numpy.where(active, fC, fB)
+
+        return numpy.exp(A/2)
+
+class TrueSkillRatingSystem(RatingSystem):
+    """
+    A two team TrueSkill-style system
+    (https://www.microsoft.com/en-us/research/publication/trueskilltm-a-bayesian-skill-rating-system/).
+    Each player's skill is a gaussian with mean `rating` and standard
+    deviation `rating_sigma`, and a team's performance is the sum of its
+    players' performances. Both teams are updated with the exact two team
+    message passing update, so no factor graph is needed.
+    """
+    name = "trueskill"
+
+    SIGMA = 350.0
+
+    # the performance deviation, i.e. the rating difference which gives
+    # ~76% chance of winning a 1v1
+    BETA = SIGMA/2
+
+    # added to the deviation before each game, so ratings don't freeze
+    TAU = SIGMA/100
+
+    DRAW_PROBABILITY = 0.05
+
+    stats = {
+        "rating": rating.BASE,
+        "rating_sigma": SIGMA
+    }
+
+    def __init__(self):
+        if numpy is None:
+            raise ImportError("numpy is required for the TrueSkill rating system")
+
+        # the draw margin for each total number of players
+        self._draw_margins = {}
+
+    def rate_batch(self, games):
+        results = [ None ] * len(games)
+
+        for (size1, size2), indexes in _size_groups(games).iteritems():
+            mu1 = self._stat_array(games, indexes, 0, "rating", size1)
+            mu2 = self._stat_array(games, indexes, 1, "rating", size2)
+
+            var1 = self._stat_array(games, indexes, 0, "rating_sigma",
+                                    size1)**2 + self.TAU**2
+            var2 = self._stat_array(games, indexes, 1, "rating_sigma",
+                                    size2)**2 + self.TAU**2
+
+            c = numpy.sqrt(var1.sum(axis = 1) + var2.sum(axis = 1) +
+                           (size1 + size2)*self.BETA**2)
+            t = (mu1.sum(axis = 1) - mu2.sum(axis = 1))/c
+
+            margin = self._draw_margin(size1 + size2)/c
+
+            # the truncated gaussian corrections are scalars per game
+            vw = [ self._v_w(t_i, margin_i, games[i][2]) for i, t_i, margin_i
+                    in zip(indexes, t.tolist(), margin.tolist()) ]
+
+            v = numpy.array([ x[0] for x in vw ], dtype = numpy.float64)[:, None]
+            w = numpy.array([ x[1] for x in vw ], dtype = numpy.float64)[:, None]
+            c = c[:, None]
+
+            new1 = (mu1 + var1/c*v, numpy.sqrt(var1*(1 - var1/c**2*w)))
+            new2 = (mu2 - var2/c*v, numpy.sqrt(var2*(1 - var2/c**2*w)))
+
+            for row, i in enumerate(indexes):
+                results[i] = (self._player_stats(new1, row),
+                              self._player_stats(new2, row))
+
+        return results
+
+    def predict_batch(self, games):
+        probabilities = []
+
+        for team1, team2 in games:
+            mu = sum(self._team_stat(team1, "rating")) - \
+                    sum(self._team_stat(team2, "rating"))
+            var = sum(x**2 for x in self._team_stat(team1, "rating_sigma")) + \
+                    sum(x**2 for x in self._team_stat(team2, "rating_sigma")) + \
+                    (len(team1) + len(team2))*self.BETA**2
+
+            probabilities.append(_cdf(mu/math.sqrt(var)))
+
+        return probabilities
+
+    def _player_stats(self, arrays, row):
+        mu, sigma = arrays
+
+        return [ { "rating": round(m, 3), "rating_sigma": round(s, 3) }
+                 for m, s in zip(mu[row].tolist(), sigma[row].tolist()) ]
+
+    def _draw_margin(self, players):
+        if players not in self._draw_margins:
+            self._draw_margins[players] = (
+                _inverse_cdf((self.DRAW_PROBABILITY + 1)/2)*
+                math.sqrt(players)*self.BETA)
+
+        return self._draw_margins[players]
+
+    def _v_w(self, t, margin, rank):
+        """
+        The mean and variance corrections for a game, from team 1's point of
+        view. t is the normalised difference in team means.
+        """
+        if rank[0] < rank[1]:
+            return self._v_w_win(t, margin)
+
+        elif rank[0] > rank[1]:
+            v, w = self._v_w_win(-t, margin)
+            return -v, w
+
+        else:
+            return self._v_w_draw(t, margin)
+
+    def _v_w_win(self, t, margin):
+        x = t - margin
+        denom = _cdf(x)
+        if denom < 1e-300:
+            # an extremely unlikely win. the limit of v as x -> -inf is -x
+            return -x, 1.0
+
+        v = _pdf(x)/denom
+        return v, v*(v + x)
+
+    def _v_w_draw(self, t, margin):
+        denom = _cdf(margin - t) - _cdf(-margin - t)
+        if denom < 1e-300:
+            return (-t - margin if t < 0 else -t + margin), 1.0
+
+        v = (_pdf(-margin - t) - _pdf(margin - t))/denom
+        w = v**2 + ((margin - t)*_pdf(margin - t) +
+                    (margin + t)*_pdf(margin + t))/denom
+
+        return v, w
+
+RATING_SYSTEMS = {
+    EloRatingSystem.name: EloRatingSystem,
+    Glicko2RatingSystem.name: Glicko2RatingSystem,
+    TrueSkillRatingSystem.name: TrueSkillRatingSystem
+}
+
+# the stats kept by any rating system, which are set rather than added to at
+# the end of a game
+STATE_STATS = tuple(sorted(set(stat for system in RATING_SYSTEMS.values()
+                            for stat in system.stats)))
+
+def get_rating_system(name):
+    """
+    Gets the rating system class with the given name. Raises ValueError if
+    there is no such system (i.e. settings.rating_systems is misconfigured)
+    """
+    if not name in RATING_SYSTEMS:
+        raise ValueError("No rating system named %r. Valid systems are: %s" %
+                         (name, ", ".join(sorted(RATING_SYSTEMS))))
+
+    return RATING_SYSTEMS[name]
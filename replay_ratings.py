@@ -0,0 +1,172 @@
+"""
+Rebuilds every player's rating by replaying all finished pugs, in the order
+they were created, through the rating engine (see rating.recompute_ratings).
+Use this after changing the rating algorithm (i.e. K_table).
+
+Players (and so their ratings) are shared by every pug group, so the whole
+history is replayed with one rating system: the system configured for the
+groups in settings.rating_systems, or the one given with --system. If groups
+are configured with different systems, --system must be given. Systems other
+than Elo are replayed through ratingsystems.py, and the other stats they keep
+(i.e. the Glicko-2 deviation) are written along with the rating.
+
+Pugs are streamed from the database with a server-side cursor and rated in
+batches, so memory use does not grow with the size of the history (only with
+the number of players). The final ratings are written back in one bulk update.
+The daemon should not be running, as it would overwrite the new ratings with
+the ratings it has cached.
+
+Usage: python replay_ratings.py [--dry-run] [--batch-size N] [--system NAME]
+"""
+
+import sys
+import time
+import logging
+import argparse
+
+import psycopg2.pool
+
+import settings
+
+from interfaces import get_db_interface, TFPugJsonInterface
+from puglib import rating, ratingsystems
+
+def pug_games(pugs, counts):
+    """
+    Converts pugs to games in the form used by rating.recompute_ratings,
+    skipping pugs which were never rated (i.e. ended before the game was over)
+
+    :param counts A dict which the number of rated and skipped pugs is
+                  recorded in
+    """
+    for pug in pugs:
+        if not pug.stats_done or len(pug.teams) != 2:
+            counts["skipped"] += 1
+            continue
+
+        team1, team2 = pug.teams.keys()
+
+        # rank in order of winning team, as in PugManager._update_ratings
+        team1_game_score = pug.game_scores[team1]
+        team2_game_score = pug.game_scores[team2]
+
+        if team1_game_score > team2_game_score:
+            ranking = [0, 1]
+
+        elif team1_game_score < team2_game_score:
+            ranking = [1, 0]
+
+        else:
+            ranking = [0, 0]
+
+        counts["rated"] += 1
+
+        yield (list(pug.teams[team1]), list(pug.teams[team2]), ranking)
+
+def configured_system():
+    """
+    :return str The rating system used by every pug group, or None if groups
+                are configured with different systems
+    """
+    systems = set(settings.rating_systems.values())
+    systems.add(settings.default_rating_system)
+
+    if len(systems) != 1:
+        return None
+
+    return systems.pop()
+
+def replay(system, games, batch_size):
+    """
+    Rates the games with the given rating system (see ratingsystems.py),
+    batched as for rating.recompute_ratings
+
+    :return dict A dict of player id -> dict of the stats kept by the system
+    """
+    stats = {}
+    new_player = {}
+
+    team_stats = lambda team: [ stats.get(x, new_player) for x in team ]
+
+    for batch in rating.independent_batches(games, batch_size):
+        new_stats = system.rate_batch([ (team_stats(team1), team_stats(team2),
+                                         rank)
+                                        for team1, team2, rank in batch ])
+
+        for (team1, team2, rank), (new1, new2) in zip(batch, new_stats):
+            stats.update(zip(team1, new1))
+            stats.update(zip(team2, new2))
+
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description = "Rating history replay")
+    parser.add_argument("--dry-run", action = "store_true",
+                        help = "Compute the ratings without writing them")
+    parser.add_argument("--batch-size", type = int, default = 512,
+                        help = "Max number of games rated together")
+    parser.add_argument("--system", choices = ratingsystems.RATING_SYSTEMS,
+                        help = "The rating system to replay with")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+
+    system = args.system or configured_system()
+    if system is None:
+        logging.error("Pug groups are configured with different rating "
+                      "systems (%s). Use --system to choose which to replay "
+                      "with", settings.rating_systems)
+        return 1
+
+    logging.info("Replaying with the %s rating system", system)
+
+    dsn = "dbname=%s user=%s password=%s host=%s port=%s" % (
+                settings.db_name, settings.db_user, settings.db_pass,
+                settings.db_host, settings.db_port
+            )
+
+    # one connection is held by the pug cursor while the history is replayed
+    pool = psycopg2.pool.SimpleConnectionPool(minconn = 1, maxconn = 2,
+                                              dsn = dsn)
+
+    db = get_db_interface("PGSQL")(pool, None)
+    for statcol in settings.indexed_stats:
+        db.add_stat_index(statcol)
+
+    counts = { "rated": 0, "skipped": 0 }
+
+    start = time.time()
+
+    pugs = db.iter_finished_pugs(TFPugJsonInterface())
+    state = None
+
+    if system == ratingsystems.EloRatingSystem.name:
+        ratings = rating.recompute_ratings(pug_games(pugs, counts),
+                                           batch_size = args.batch_size)
+
+    else:
+        state = replay(ratingsystems.get_rating_system(system)(),
+                       pug_games(pugs, counts), args.batch_size)
+
+        ratings = dict((cid, x.pop("rating")) for cid, x in state.items())
+
+    logging.info("Replayed %d pugs (%d skipped) for %d players in %.1fs",
+                 counts["rated"], counts["skipped"], len(ratings),
+                 time.time() - start)
+
+    if args.dry_run:
+        for cid, r in sorted(ratings.items(), key = lambda x: -x[1])[:20]:
+            print "%s %.3f" % (cid, r)
+
+        return 0
+
+    updated = db.set_player_ratings(ratings, state)
+
+    logging.info("Updated the ratings of %d players", updated)
+
+    pool.closeall()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+A shared log listener, which receives the logs of all servers on a single UDP
+socket and routes each datagram to the log interface of the server that sent
+it. Datagrams are routed by their sv_logsecret if they have one, else by their
+source address.
+
+This replaces the per-server listening socket when settings.logging_listen_port
+is set.
+"""
+
+import random
+import logging
+
+import settings
+
+from serverlib import UDPServer
+
+class SharedLogListener(object):
+    def __init__(self, server_address, io_loop = None):
+        # routes are in the form { secret: log interface } and
+        # { (ip, port): log interface }
+        self._secret_routes = {}
+        self._address_routes = {}
+
+        # the log interface registered for each server, so routes can be
+        # removed when the server is unregistered
+        self._registered = {}
+
+        self._listener = UDPServer.UDPServer(server_address, None,
+                                io_loop = io_loop,
+                                batch_callback = self._route_batch,
+                                read_budget = settings.logging_read_budget,
+                                include_address = True)
+        self._listener.start()
+
+        self.server_address = self._listener.server_address
+
+    def register(self, server, log_interface):
+        """
+        Registers the given server's log interface to receive all datagrams
+        sent by the server, and returns the sv_logsecret the server should use.
+        """
+        self.unregister(server)
+
+        secret = self._new_secret()
+
+        self._secret_routes[secret] = log_interface
+        self._address_routes[(server.ip, server.port)] = log_interface
+        self._registered[server] = (secret, (server.ip, server.port))
+
+        return secret
+
+    def unregister(self, server):
+        if server not in self._registered:
+            return
+
+        secret, address = self._registered.pop(server)
+
+        self._secret_routes.pop(secret, None)
+        self._address_routes.pop(address, None)
+
+    def _new_secret(self):
+        # srcds secrets are numeric
+        secret = str(random.randint(10**8, 10**9 - 1))
+        while secret in self._secret_routes:
+            secret = str(random.randint(10**8, 10**9 - 1))
+
+        return secret
+
+    def _route_batch(self, datagrams):
+        for data, address in datagrams:
+            log_interface = self._route(data, address)
+
+            if log_interface is None:
+                logging.debug("No log route for datagram from %s:%s",
+                              address[0], address[1])
+                continue
+
+            try:
+                log_interface.parse(data)
+
+            except:
+                logging.exception("Exception parsing data from %s:%s",
+                                  address[0], address[1])
+
+    def _route(self, data, address):
+        # data is in the form \xFF\xFF\xFF\xFFS<secret>L ... if the server has
+        # sv_logsecret set, else \xFF\xFF\xFF\xFFRL ...
+        start = 0
+        while start < len(data) and data[start] == "\xFF":
+            start += 1
+
+        if data.startswith("S", start):
+            secret = data[start + 1:data.find(" ", start) - 1]
+
+            if secret in self._secret_routes:
+                return self._secret_routes[secret]
+
+        return self._address_routes.get(address)
+
+    def close(self):
+        self._listener.close()
+
+        self._secret_routes.clear()
+        self._address_routes.clear()
+        self._registered.clear()
+
+_shared_listener = None
+
+def get_shared_listener():
+    """
+    Gets the shared log listener, creating it on the first call
+    """
+    global _shared_listener
+
+    if _shared_listener is None:
+        _shared_listener = SharedLogListener((settings.logging_listen_ip,
+                                              settings.logging_listen_port))
+
+    return _shared_listener
@@ -1,7 +1,10 @@
 import socket
-import struct
 import logging
 
+from collections import deque
+
+from serverlib import RconPacket
+
 SERVERDATA_AUTH = 3
 SERVERDATA_EXEC_COMMAND = 2
 
@@ -53,6 +56,15 @@ class RconConnection(object):
         self.authed = False
         self.request_id = 0
 
+        # packets are packed into the write buffer, and received data is read
+        # into the read buffer. both are reused for every packet
+        self._write_buffer = bytearray(RconPacket.MAX_PACKET_SIZE)
+        self._read_buffer = bytearray(RconPacket.MAX_PACKET_SIZE)
+
+        self._reader = RconPacket.PacketReader()
+        # packets which have been parsed but not yet handled
+        self._packets = deque()
+
         self._connect()
 
         self._auth()
@@ -80,15 +92,7 @@ class RconConnection(object):
 
         self.request_id += 1
 
-        #use little endian packing of ints, terminate body with a null, and add a null at the end for the empty string
-        packet = struct.pack('<l', self.request_id) + struct.pack('<l', code) + body.encode('ascii') + '\x00\x00'
-
-        #add the packed length of the message body to the beginning of the packet
-        logging.debug("Packet length: %s, packet: %s", len(packet), repr(packet))
-
-        packet = struct.pack('<l', len(packet)) + packet
-
-        return packet
+        return (self.request_id, code, body.encode('ascii'))
 
     def _receive_data(self):
         if not self.socket:
@@ -97,31 +101,17 @@ class RconConnection(object):
         first_packet_id = None #this will be the ID return in multi-line responses
         curr_packet_id = 0 #this will be the ID checked against for the end of multi-line responses
         response_code = 0
-        entire_message = ''
+        message_parts = []
 
         got_empty_packet = False
 
         while 1:
-            # we don't know the packet size. so we read the first 4 bytes, 
-            # (the packet size) this tells us the size of the current packet.
-            # however, we want to keep reading packets until we receive an 
-            # empty response if what we're reading is an EXEC
-
-            packet_len_packed = self.__read_socket(4)
-
-            # now we have the entire packet length. 
-            # all data is not necessarily sent in a single packet, and may be 
-            # split into multiple packets (fuark)
-            packet_len = struct.unpack('<l', packet_len_packed)[0] 
+            # we want to keep reading packets until we receive an empty 
+            # response if what we're reading is an EXEC
+            curr_packet_id, response_code, message = self.__read_packet()
 
-            packet_packed = self.__read_socket(packet_len)
-
-            logging.debug("Entire packet: %s", repr(packet_len_packed + packet_packed))
-
-            #packet is in the form <id (packed int)><response code (packed int)><body>\x00\x00
-            curr_packet_id = struct.unpack('<l', packet_packed[0:4])[0]
-            response_code = struct.unpack('<l', packet_packed[4:8])[0]
-            message = packet_packed[8:].strip('\x00') #strip the terminators
+            logging.debug("Entire packet: %s", repr((curr_packet_id, 
+                                                     response_code, message)))
 
             if first_packet_id is None:
                 first_packet_id = curr_packet_id
@@ -135,46 +125,53 @@ class RconConnection(object):
                     #this is the mirror packet after sending a RESPONSE_VALUE command, so we know our potentially multi-line response has ended
                     if got_empty_packet:
                         logging.debug("Got empty packet after mirror. This signals end of multi-line response")
-                        return (first_packet_id, response_code, entire_message)
+                        return (first_packet_id, response_code, 
+                                "".join(message_parts))
                     
                     else:
                         logging.debug("Got empty mirror response")
                         got_empty_packet = True
                 
 
-                entire_message += message #concatenate the read message onto the full message
+                message_parts.append(message)
 
             #else we're waiting for an EXEC response, so we should read another packet until we get an empty one
 
-    def __read_socket(self, num_bytes):
-        #loops over the socket, reading until num_bytes is read
+    def __read_packet(self):
+        # reads from the socket until we have a complete packet. all complete
+        # packets in the data received are parsed at once, and kept until 
+        # they're needed
         if self.closed:
             raise RconConnectionError("Cannot read from closed socket")
 
-        data = r''
-        num_read = 0
-
-        while num_read < num_bytes:
+        while not self._packets:
             try:
-                rcvd = self.socket.recv(num_bytes - num_read)
+                num_read = self.socket.recv_into(self._read_buffer)
             except:
                 raise RconConnectionError("Connection timed out while waiting for data")
 
-            if len(rcvd) == 0:
+            if num_read == 0:
                 raise RconConnectionInterruptedError("RCon connection unexpectedly closed")
 
-            data += rcvd
-
-            num_read = len(data)
+            try:
+                self._packets.extend(self._reader.feed(
+                                        memoryview(self._read_buffer)[:num_read]))
+            except ValueError as e:
+                self.close()
+                raise RconError(str(e))
 
-        logging.debug("Data read: %s", to_hex(data))
-        return data
+        return self._packets.popleft()
 
-    def _send_packet(self, packet):
+    def _send_packets(self, packets):
         if self.socket and not self.closed:
-            logging.debug("Packet to send: %s", repr(packet))
-            if not self.socket.send(packet):
-                raise RconError("Unable to send packet %s" % packet)
+            logging.debug("Packets to send: %s", repr(packets))
+
+            self._write_buffer, length = RconPacket.pack(packets, 
+                                                         self._write_buffer)
+            try:
+                self.socket.sendall(memoryview(self._write_buffer)[:length])
+            except:
+                raise RconError("Unable to send packets %s" % repr(packets))
 
         else:
             raise RconConnectionError("Cannot send to dead socket")
@@ -183,7 +180,7 @@ class RconConnection(object):
     def _auth(self):
         if not self.authed:
             auth_packet = self._construct_packet(SERVERDATA_AUTH, self.rcon_password)
-            self._send_packet(auth_packet)
+            self._send_packets([ auth_packet ])
 
             junk = self._receive_data() # get junk packet pre-auth
             response = self._receive_data()
@@ -209,11 +206,12 @@ class RconConnection(object):
         if self.authed:
             cmd_packet = self._construct_packet(SERVERDATA_EXEC_COMMAND, cmd)
 
-            self._send_packet(cmd_packet)
             # send a "response" packet, which srcds will mirror back after 
             # responding to the EXEC, letting us know the exec command has 
-            # finished. this makes it easier to read multi-line responses
-            self._send_packet(self._construct_packet(SERVERDATA_COMMAND_RESPONSE, r''))
+            # finished. this makes it easier to read multi-line responses.
+            # both packets are sent at once
+            mirror_packet = self._construct_packet(SERVERDATA_COMMAND_RESPONSE, r'')
+            self._send_packets([ cmd_packet, mirror_packet ])
 
             return self._receive_data()
 
@@ -0,0 +1,121 @@
+"""
+Source RCON packet framing, shared by the blocking (Rcon) and asynchronous
+(RconStream) RCON implementations.
+
+Packets are in the form dictated at
+https://developer.valvesoftware.com/wiki/Source_RCON_Protocol
+
+    <packet size><request id><request code><body string><empty string>
+
+The ints are little endian, and both strings are null terminated. The packet
+size does not include the size field itself.
+
+Packets are packed straight into a buffer with a single precompiled struct,
+and received data is buffered so that every complete packet in a chunk is
+parsed at once, rather than reading each packet with separate reads.
+"""
+
+import struct
+
+# <packet size><request id><request code>
+HEADER = struct.Struct('<lll')
+SIZE = struct.Struct('<l')
+
+# the id, code and the two null terminators are included in the packet size
+MIN_PACKET_SIZE = 10
+
+# srcds splits responses into packets of at most 4096 bytes. anything larger
+# than this means we've lost track of the packet boundaries
+MAX_PACKET_SIZE = 4096 + MIN_PACKET_SIZE
+
+def packed_size(body):
+    """
+    The number of bytes a packet with the given body takes
+    """
+    return HEADER.size + len(body) + 2
+
+def pack_into(buffer, offset, request_id, code, body):
+    """
+    Packs a packet into the buffer at the given offset. The buffer must have
+    room for `packed_size(body)` bytes.
+
+    :return int The offset of the end of the packet
+    """
+    HEADER.pack_into(buffer, offset, len(body) + MIN_PACKET_SIZE, request_id,
+                     code)
+
+    start = offset + HEADER.size
+    end = start + len(body)
+
+    buffer[start:end] = body
+    buffer[end:end + 2] = '\x00\x00'
+
+    return end + 2
+
+def pack(packets, buffer = None):
+    """
+    Packs a list of packets, in the form (id, code, body), one after the other.
+    Bodies must be byte strings.
+
+    :param buffer (optional) A bytearray to pack the packets into. If it is
+                  too small, a new bytearray is used instead
+
+    :return tuple A tuple in the form (buffer, length)
+    """
+    length = sum(packed_size(x[2]) for x in packets)
+
+    if buffer is None or len(buffer) < length:
+        buffer = bytearray(length)
+
+    offset = 0
+    for request_id, code, body in packets:
+        offset = pack_into(buffer, offset, request_id, code, body)
+
+    return buffer, length
+
+class PacketReader(object):
+    """
+    Buffers received data, and parses the complete packets out of it
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Adds received data to the buffer
+
+        :return list A list of the complete packets received, in the form
+                     (id, code, body). The body has its terminators stripped.
+                     Raises ValueError if a packet has an invalid size
+        """
+        buf = self._buffer
+        buf += data
+
+        packets = []
+        offset = 0
+        available = len(buf)
+
+        while available - offset >= HEADER.size:
+            size, request_id, code = HEADER.unpack_from(buf, offset)
+
+            if size < MIN_PACKET_SIZE or size > MAX_PACKET_SIZE:
+                raise ValueError("Invalid RCON packet size %d" % size)
+
+            end = offset + SIZE.size + size
+            if end > available:
+                # the rest of the packet hasn't arrived yet
+                break
+
+            body = str(buf[offset + HEADER.size:end]).strip('\x00')
+            packets.append((request_id, code, body))
+
+            offset = end
+
+        if offset:
+            # drop the parsed packets from the buffer in one go
+            del buf[:offset]
+
+        return packets
+
+    def __len__(self):
+        return len(self._buffer)
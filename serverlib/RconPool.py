@@ -0,0 +1,99 @@
+"""
+Keeps a persistent, authenticated RCON connection open to each game server,
+so that commands don't each need a new TCP connection and auth handshake.
+Idle connections are periodically sent an empty command to keep them alive.
+Dropped connections re-authenticate themselves (see RconStream).
+"""
+
+import logging
+
+from tornado.ioloop import PeriodicCallback
+
+import settings
+
+from serverlib import RconStream
+
+class RconPool(object):
+    def __init__(self, keepalive_interval, io_loop = None):
+        """
+        :param keepalive_interval The time in seconds a connection can be idle
+                                  before it is sent a keepalive
+        :param io_loop (optional) The IOLoop to run keepalives on
+        """
+        self.keepalive_interval = keepalive_interval
+
+        self._io_loop = io_loop
+
+        # (ip, port) -> connection
+        self._connections = {}
+
+        self._keepalive_timer = None
+
+    def get(self, ip, port, rcon_password, health = None):
+        """
+        Gets the connection for the given server, creating a new one if there
+        is no open connection using the given password
+        """
+        key = (ip, port)
+
+        connection = self._connections.get(key)
+        if connection is not None and not connection.closed:
+            if connection.rcon_password == rcon_password:
+                return connection
+
+            connection.close()
+
+        connection = RconStream.RconConnection(ip, port, rcon_password,
+                                   health = health,
+                                   max_pipeline = settings.rcon_max_pipeline)
+        self._connections[key] = connection
+
+        self._start_keepalive()
+
+        return connection
+
+    def _start_keepalive(self):
+        if self._keepalive_timer is None:
+            self._keepalive_timer = PeriodicCallback(self._keepalive,
+                                        self.keepalive_interval * 1000,
+                                        io_loop = self._io_loop)
+            self._keepalive_timer.start()
+
+    def _keepalive(self):
+        for key, connection in self._connections.items():
+            if connection.closed:
+                del self._connections[key]
+                continue
+
+            try:
+                connection.keepalive(self.keepalive_interval)
+
+            except:
+                logging.exception("Exception sending keepalive to %s:%s",
+                                  key[0], key[1])
+
+    def close(self):
+        if self._keepalive_timer is not None:
+            self._keepalive_timer.stop()
+            self._keepalive_timer = None
+
+        for connection in self._connections.values():
+            connection.close()
+
+        self._connections.clear()
+
+    def __len__(self):
+        return len(self._connections)
+
+_pool = None
+
+def get_pool():
+    """
+    Gets the shared RCON connection pool, creating it on the first call
+    """
+    global _pool
+
+    if _pool is None:
+        _pool = RconPool(settings.rcon_keepalive_interval)
+
+    return _pool
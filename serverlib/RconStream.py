@@ -1,23 +1,47 @@
 """
 A source RCON implementation utilising the tornado IOStream class for async
 operations. Utilises futures to return data where applicable
+
+Commands are pipelined; several commands may be written to the socket before
+the responses to earlier ones have been read. Responses are matched to their
+command by request id. If an authenticated connection is dropped, it is
+re-established and re-authenticated automatically.
+
+`execute` returns a Future resolving to a command's response. Every command
+has a deadline; if an in-flight command misses its deadline, the server is
+assumed to be hung and the connection is re-established, so that the commands
+behind it are not blocked forever. Queued fire-and-forget commands (`send_cmd`
+without a callback) are joined with ';' and sent as a single command.
 """
 
 import socket
-import struct
 import logging
 
 from tornado.iostream import IOStream
+from tornado.concurrent import Future
+from tornado import ioloop
 
+from timeit import default_timer as timer
 from functools import partial
 from collections import deque
 
+from serverlib import RconPacket
+
 SERVERDATA_AUTH = 3
 SERVERDATA_EXEC_COMMAND = 2
 
 SERVERDATA_AUTH_RESPONSE = 2
 SERVERDATA_COMMAND_RESPONSE = 0
 
+# the max length of a command the engine will accept
+MAX_COMMAND_LENGTH = 510
+
+# the time in seconds a command is given to complete, if no timeout is given
+DEFAULT_TIMEOUT = 10
+
+# the max number of bytes read from the socket at once
+READ_CHUNK_SIZE = 64 * 1024
+
 to_hex = lambda x : ":".join(hex(ord(c))[2:].zfill(2) for c in x)
 
 class RconError(Exception):
@@ -45,14 +69,64 @@ class RconConnectionInterruptedError(Exception):
     """
     pass
 
+class RconTimeoutError(Exception):
+    """
+    raised when a command is not completed before its deadline
+    """
+    pass
+
+class RconCancelledError(Exception):
+    """
+    raised when a command is cancelled before it is completed
+    """
+    pass
+
+class RconCommand(object):
+    """
+    A command which has been queued or sent to the server
+    """
+    def __init__(self, command, callback = None, future = None):
+        self.command = command
+        self.callback = callback
+        self.future = future
+
+        # the IOLoop timeout for the command's deadline
+        self.timeout = None
+
+        # the id of the command packet, and of the empty packet sent after it
+        # which the server mirrors back once the command's response is done
+        self.cmd_id = None
+        self.mirror_id = None
+        self.got_mirror = False
+
+        self.parts = []
+        self.sent_time = None
+
+    @property
+    def coalescable(self):
+        # fire-and-forget commands, whose responses nobody is waiting for
+        return self.callback is None and self.future is None
+
+    def merge(self, other):
+        self.command += ";" + other.command
+
 class RconConnection(object):
-    def __init__(self, ip, port, rcon_password):
+    def __init__(self, ip, port, rcon_password, health = None, 
+                 max_pipeline = 8):
+        """
+        :param health (optional) A ServerHealth which connection round trip
+                      times and failures are recorded to
+        :param max_pipeline (optional) The max number of commands to have sent
+                            to the server without a complete response
+        """
         self.ip = ip
         self.port = port
         self.rcon_password = rcon_password
 
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-        self._stream = IOStream(self._socket)
+        self.health = health
+        self.max_pipeline = max_pipeline
+
+        self._io_loop = ioloop.IOLoop.current()
 
         self.authed = False
         self.request_id = 0
@@ -62,94 +136,137 @@ class RconConnection(object):
         # what we want (FIFO)
         self._queue = deque()
 
-        self._busy = False
+        # commands which have been sent, keyed by both of their packet ids
+        self._in_flight = {}
+
+        self._closing = False
+
+        # the time of the last complete response, so that idle connections 
+        # can be kept alive
+        self.last_activity = timer()
+
+        self._connect()
+
+    def _connect(self):
+        self.authed = False
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        self._stream = IOStream(self._socket)
+        self._stream.set_close_callback(partial(self._on_close, self._stream))
+
+        self._reader = RconPacket.PacketReader()
+
+        # the time the connection was started, for measuring round trip time
+        self._connect_time = timer()
 
         # async connect & call _auth when connected
-        self._stream.connect((ip, port), self._auth)
+        self._stream.connect((self.ip, self.port), self._auth)
 
-    def _construct_packet(self, code, body):
-        #packets are in the form dictated at 
-        # https://developer.valvesoftware.com/wiki/Source_RCON_Protocol
-        #<packet size><request id><request code><body string><empty string>
-        #strings must be null terminated, even the empty one
+    def _on_close(self, stream):
+        if stream is not self._stream or self._closing or self.error:
+            return
+
+        if self.authed:
+            # the connection was established and has been dropped (i.e. the
+            # server restarted). any commands in flight fail, because we
+            # don't know whether they were run. queued commands are sent once
+            # we have re-authed
+            lost = set(self._in_flight.values())
+            self._in_flight.clear()
+
+            logging.warning("RCON connection to %s:%s dropped. Reconnecting. "
+                            "%d commands in flight were lost", self.ip, 
+                            self.port, len(lost))
+
+            error = RconConnectionInterruptedError(
+                                        "RCON connection to %s:%s dropped" % (
+                                            self.ip, self.port))
+            for command in lost:
+                self._fail(command, error)
+
+            self._connect()
+            return
 
+        # the connection was closed before we authed, so the connect failed
+        # or the server dropped us
+        self.error = RconConnectionError("Unable to connect to %s:%s: %s" % (
+                        self.ip, self.port, stream.error))
+
+        logging.warning("RCON connection to %s:%s failed: %s", self.ip, 
+                        self.port, stream.error)
+
+        self._fail_queue()
+        self._record_failure()
+
+    def _record_success(self, rtt):
+        if self.health is not None:
+            self.health.record_success(rtt)
+
+    def _record_failure(self):
+        if self.health is not None:
+            self.health.record_failure()
+
+    def _construct_packet(self, code, body):
+        """
+        :return tuple The packet in the form (id, code, body), to be packed by
+                      `_send_packets`
+        """
         if body is None:
             body = r''
 
         self.request_id += 1
 
-        # use little endian packing of ints, terminate body with a null,
-        # and add a null at the end for the empty string
-        packet = struct.pack('<l', self.request_id)
-        packet += struct.pack('<l', code) 
-        packet += body.encode('ascii') + '\x00\x00'
+        return (self.request_id, code, body.encode('ascii'))
 
-        # add packet length to the front of the packet
-        packet = struct.pack('<l', len(packet)) + packet
+    def _send_packets(self, packets):
+        logging.debug("Sending packets %s", repr(packets))
 
-        return packet
+        # the stream copies the data into its write buffer, unless it is
+        # frozen, so we don't reuse the buffer
+        buffer, length = RconPacket.pack(packets)
+        self._stream.write(buffer)
 
-    def _send_packet(self, packet, callback = None):
-        logging.debug("Sending packet %s", repr(packet))
-        self._stream.write(packet, callback)
+    def _read_next_chunk(self):
+        if not self._stream.closed():
+            self._stream.read_bytes(READ_CHUNK_SIZE, 
+                                    partial(self._handle_chunk, self._stream),
+                                    partial = True)
 
-    def _read_single_packet(self, callback = None):
-        # reads a single packet from the stream and pushes the processed
-        # response through the given callback if provided
-        #logging.debug("Reading single packet from stream")
+    def _handle_chunk(self, stream, data):
+        if stream is not self._stream:
+            # data from a connection which has since been replaced
+            return
 
-        def process_packet(packed_packet):
-            #logging.debug("Processing packet: %s", repr(packed_packet))
-            #packet <id (packed int)><response code (packed int)><body>\x00\x00
-            curr_packet_id = struct.unpack('<l', packed_packet[0:4])[0]
-            response_code = struct.unpack('<l', packed_packet[4:8])[0]
-            message = packed_packet[8:].strip('\x00') #strip the terminators
+        try:
+            packets = self._reader.feed(data)
 
-            """logging.debug("ID: %d CODE: %d MESSAGE: %s", curr_packet_id,
-                            response_code, message)"""
+        except ValueError:
+            # we've lost track of where packets start, so the connection is
+            # unusable
+            logging.exception("Invalid data received from %s:%s", self.ip, 
+                              self.port)
 
-            # we now have the packet message, response code, and response id, 
-            # so push it through the given callback
-            if callback is not None:
-                callback((curr_packet_id, response_code, message))
+            stream.close()
+            return
 
-        def process_packet_len(packed_packet_len):
-            packet_len = struct.unpack('<l', packed_packet_len)[0]
-            """logging.debug("Processing packet length: %s, length: %s", 
-                            repr(packed_packet_len), packet_len)"""
+        for packet in packets:
+            self._handle_packet(packet)
 
-            # read the entire packet
-            #logging.debug("Reading the rest of the packet")
-            self._stream.read_bytes(packet_len, process_packet)
+            if stream is not self._stream or stream.closed():
+                return
 
-        self._stream.read_bytes(4, process_packet_len)
+        self._read_next_chunk()
 
-    def _auth(self, data = None, auth_sent = False, junked = False):
+    def _auth(self):
         """
         Called when connect is successful. First thing we always do after
-        connecting is attempt to authenticate. Authentication is asynchronous.
-        We'll utilise partials to do this
+        connecting is attempt to authenticate. The auth response is handled
+        by `_handle_packet` like any other packet.
         """
-        if self.error:
-            raise self.error
+        self._send_packets([ self._construct_packet(SERVERDATA_AUTH, 
+                                                    self.rcon_password) ])
 
-        if not auth_sent:
-            auth_packet = self._construct_packet(SERVERDATA_AUTH, 
-                                                 self.rcon_password)
-
-            # _auth will be called again once the auth packet has been sent
-
-            f = partial(self._auth, auth_sent = True)
-            self._send_packet(auth_packet, f)
-        elif not junked:
-            # read the junk packet out, and call again with junked = True
-            f = partial(self._auth, auth_sent = True, junked = True)
-            self._read_single_packet(f)
-        
-        else:
-            # now read the real response. call _auth_response once it has been
-            # processed
-            self._read_single_packet(self._auth_response)
+        self._read_next_chunk()
 
     def _auth_response(self, response):
         logging.debug("Auth response: %s", repr(response))
@@ -159,9 +276,12 @@ class RconConnection(object):
 
             elif response[0] == self.request_id:
                 self.authed = True
+                self.last_activity = timer()
 
                 logging.debug("Successfully authed")
 
+                self._record_success(self.last_activity - self._connect_time)
+
                 self._process_queue()
 
             else:
@@ -171,163 +291,254 @@ class RconConnection(object):
             self.error = RconAuthError("Expected auth response, got %d" % (
                         response[1]))
 
-    def _exec(self, command, callback = None):
+        if self.error:
+            self._fail_queue()
+            self._record_failure()
+
+            self._stream.close()
+
+    def _exec(self, command):
         """
-        Send a command packet to the server if we are authenticated. When doing
-        this, we send a packet with SERVERDATA_EXEC_COMMAND and the command we
-        want to execute, along with an empty SERVERDATA_COMMAND_RESPONSE, which
-        the server will mirror back at us once it has sent the response to our
-        command (in order, because TCP is ordered). Doing this lets us know
-        exactly when we've received the full response to our command.
+        Send a command packet to the server. When doing this, we send a packet
+        with SERVERDATA_EXEC_COMMAND and the command we want to execute, along
+        with an empty SERVERDATA_COMMAND_RESPONSE, which the server will mirror
+        back at us once it has sent the response to our command (in order,
+        because TCP is ordered). Doing this lets us know exactly when we've 
+        received the full response to our command.
         """
-        if self.authed:
-            self._busy = True
-            # send command packet with no callback, it'll just execute and
-            # and do nothing
-            packet = self._construct_packet(SERVERDATA_EXEC_COMMAND, command)
-            self._send_packet(packet)
+        cmd_packet = self._construct_packet(SERVERDATA_EXEC_COMMAND, 
+                                            command.command)
+        command.cmd_id = self.request_id
 
-            # add empty packet, with callback. this packet is just appended
-            # to the stream's internal write queue
-            packet = self._construct_packet(SERVERDATA_COMMAND_RESPONSE, r'')
+        mirror_packet = self._construct_packet(SERVERDATA_COMMAND_RESPONSE, 
+                                               r'')
+        command.mirror_id = self.request_id
 
-            f = partial(self._command_sent_callback, 
-                        handle_callback = callback)
-            self._send_packet(packet, f)
+        self._in_flight[command.cmd_id] = command
+        self._in_flight[command.mirror_id] = command
 
-    def _command_sent_callback(self, handle_callback = None):
-        """
-        Called when a complete command has been sent (command + mirror packets)
-        This will let us know when we should start reading.
+        # the command and mirror packets are written together
+        command.sent_time = timer()
+        self._send_packets([ cmd_packet, mirror_packet ])
 
-        @param handle_callback The callback to be used once we've read all data
-                               from a response
-        """
-        
-        # begin reading
-        f = partial(self._handle_multi_packet_read, 
-                    complete_callback = handle_callback)
-        self._read_single_packet(f)
-
-    def _handle_multi_packet_read(self, data, previous = None, 
-                                  complete_callback = None):
+    def _handle_packet(self, data):
         # data is a tuple in the form (id, code, message)
+        packet_id, response_code, message = data
 
-        if previous is None:
-            previous = [ data ]
-        else:
-            previous.append(data)
+        if not self.authed:
+            # the server sends an empty response before the auth response,
+            # which we ignore
+            if response_code == SERVERDATA_AUTH_RESPONSE:
+                self._auth_response(data)
 
-        length = len(previous)
-        if length > 0:
+            return
+
+        command = self._in_flight.get(packet_id)
+        if command is None:
+            logging.debug("Received RCON packet with unknown id %d", packet_id)
+
+        elif packet_id == command.cmd_id:
+            command.parts.append(message)
+
+        elif response_code == SERVERDATA_COMMAND_RESPONSE:
             """
             To signify the end of a multi-line response, we'll receive an
             empty packet (which is the mirror of our empty packet), along
             with an additional empty packet whose body consists of solely
-            \x01. So we need to check the last two packets. This means
-            we'll receive a MINIMUM of THREE packets for ANY command response
+            \x01. This means we'll receive a MINIMUM of THREE packets for ANY
+            command response
             """
+            if command.got_mirror and message == '\x01':
+                # our response is complete!
+                self._command_complete(command)
 
-            response_complete = False
-            got_mirror_packet = False
-            empty = previous[length-2:] # last 2 packets in previous list
-            for packet in empty:
-                packet_id = packet[0]
-                response_code = packet[1]
-                message = packet[2]
-                if (response_code == SERVERDATA_COMMAND_RESPONSE and
-                    packet_id == self.request_id):
-
-                    if got_mirror_packet and message == '\x01':
-                        """
-                        Have already gotten mirror packet, so this packet is
-                        the expected packet after the mirror, with body of \x01
-                        Therefore, our response is complete!
-                        """
-
-                        response_complete = True
-                    else:
-                        got_mirror_packet = True
-
-            if response_complete:
-                self._busy = False
-                if complete_callback is not None:
-                    complete = self._compile_multi_packet(previous)
-                    complete_callback(complete)
-                
-                self._process_queue()
+            else:
+                command.got_mirror = True
 
-            elif not response_complete:
-                # response not complete, get the next packet
-                f = partial(self._handle_multi_packet_read, 
-                            previous = previous, 
-                            complete_callback = complete_callback)
+    def _command_complete(self, command):
+        del self._in_flight[command.cmd_id]
+        del self._in_flight[command.mirror_id]
 
-                self._read_single_packet(f)
+        self.last_activity = timer()
+        self._record_success(self.last_activity - command.sent_time)
 
-    def _compile_multi_packet(self, packets):
-        """
-        Compiles a list of packets into a single packet, chopping off the empty
-        packets.
+        self._clear_timeout(command)
 
-        @param packets A list of packet tuples
+        response = (command.cmd_id, SERVERDATA_COMMAND_RESPONSE,
+                    "".join(command.parts))
 
-        @return Complete packet
-        """
+        if command.future is not None and not command.future.done():
+            command.future.set_result(response)
 
-        first = packets[0]
-        response_id = first[0]
-        response_code = first[1]
+        if command.callback is not None:
+            try:
+                command.callback(response)
 
-        message = "".join([ x[2] for x in packets[:-2] ])
+            except:
+                logging.exception("Exception in RCON command callback")
 
-        return (response_id, response_code, message)
+        self._process_queue()
 
-    def send_cmd(self, command, callback = None):
+    def _fail(self, command, error):
+        self._clear_timeout(command)
+
+        if command.future is not None and not command.future.done():
+            command.future.set_exception(error)
+
+    def _fail_queue(self):
+        for command in self._queue:
+            self._fail(command, self.error)
+
+        self._queue.clear()
+
+    def _clear_timeout(self, command):
+        if command.timeout is not None:
+            self._io_loop.remove_timeout(command.timeout)
+            command.timeout = None
+
+    def _command_timeout(self, command):
+        command.timeout = None
+
+        if command.cmd_id is None:
+            # still queued, so it just won't be sent
+            self._queue.remove(command)
+
+            self._fail(command, RconTimeoutError(
+                            "RCON command timed out before being sent"))
+
+            return
+
+        if command.cmd_id not in self._in_flight:
+            return
+
+        # responses arrive in order, so a command that hasn't been answered
+        # blocks every command after it. assume the server is hung, and
+        # re-establish the connection
+        logging.warning("RCON command to %s:%s timed out. Reconnecting", 
+                        self.ip, self.port)
+
+        self._fail(command, RconTimeoutError("RCON command timed out"))
+        self._record_failure()
+
+        # closing the stream fails the other commands in flight and reconnects
+        self._stream.close()
+
+    def _queue_command(self, command, timeout):
         if self.error:
             raise self.error
 
-        if self.busy() or not self.authed:
-            # we're already reading/writing from the socket. this command
-            # should be queued. the queue is processed at the end of a
-            # read cycle
-            logging.debug("Stream is busy. Adding command to queue")
-            self._add_to_queue((command, callback))
+        if timeout is None:
+            timeout = DEFAULT_TIMEOUT
 
-        else:
-            # execute the command!
-            self._exec(command, callback)
+        command.timeout = self._io_loop.call_later(timeout, 
+                                    partial(self._command_timeout, command))
 
-    def _add_to_queue(self, qtuple):
-        self._queue.append(qtuple)
+        # commands are always queued, so that they are sent in order. the 
+        # queue is processed immediately if there is room in the pipeline,
+        # else as responses are completed
+        self._queue.append(command)
+
+        self._process_queue()
+
+    def send_cmd(self, command, callback = None, timeout = None):
+        """
+        Sends a command to the server. If a callback is given, it is called
+        with the response (a tuple in the form (id, code, message)) once the
+        command is complete. Errors are not passed to the callback; use 
+        `execute` to get them.
+        """
+        self._queue_command(RconCommand(command, callback), timeout)
+
+    def execute(self, command, timeout = None):
+        """
+        Sends a command to the server.
+
+        :param timeout (optional) The time in seconds to wait for the command
+                       to complete
+
+        :return Future A Future resolving to the response, a tuple in the form
+                       (id, code, message). Raises RconTimeoutError if the
+                       command timed out, or the connection's error if it 
+                       failed
+        """
+        future = Future()
+        self._queue_command(RconCommand(command, future = future), timeout)
+
+        return future
+
+    def cancel(self, future):
+        """
+        Cancels the command for the given Future (from `execute`). A queued
+        command is not sent. If the command has already been sent, the Future
+        fails straight away and the response is discarded, but the command
+        keeps its place in the pipeline and its deadline until the response
+        arrives. If the server never responds, the deadline still reconnects.
+        """
+        error = RconCancelledError("RCON command cancelled")
+
+        for command in list(self._queue):
+            if command.future is future:
+                self._queue.remove(command)
+                self._fail(command, error)
+                return
+
+        for command in self._in_flight.values():
+            if command.future is future:
+                if not future.done():
+                    future.set_exception(error)
+
+                return
 
     def _process_queue(self):
         """
-        Process any RCON commands in the queue. Called as soon as we are authed
-        and after a command has been completed. Commands are added to the queue
-        if `send_cmd` is called when we are busy (i.e authing or 
-        reading/writing)
+        Send as many queued RCON commands as the pipeline allows. Called as
+        soon as we are authed, when a command is queued, and after a command
+        has been completed.
         """
-        logging.debug("Processing RCON command queue")
-        try:
-            command, callback = self._queue.popleft()
-            logging.debug("QUEUE - command: %s, callback: %s", command, 
-                          callback)
+        if not self.authed or self._stream.closed():
+            return
+
+        while self._queue and len(self._in_flight) // 2 < self.max_pipeline:
+            command = self._queue.popleft()
 
-            self.send_cmd(command, callback)
-        except IndexError:
-            pass
+            # fire-and-forget commands queued behind each other can be sent
+            # as a single command
+            while (command.coalescable and self._queue and 
+                    self._queue[0].coalescable and 
+                    len(command.command) + len(self._queue[0].command) < 
+                        MAX_COMMAND_LENGTH):
+                other = self._queue.popleft()
+                self._clear_timeout(other)
 
-        except:
-            logging.exception("Exception processing queue")
+                command.merge(other)
+
+            self._exec(command)
+
+    def keepalive(self, interval):
+        """
+        Sends an empty command if nothing has been received for `interval`
+        seconds, so that the server doesn't drop the idle connection and so we
+        find out about dead connections before a real command is sent.
+        """
+        if (self.authed and not self.busy() and 
+                timer() - self.last_activity >= interval):
+            self.send_cmd("")
 
     def busy(self):
-        return (self._stream.reading() 
-                or self._stream.writing()
-                or self._busy)
+        return bool(self._in_flight or self._queue)
 
-    @property
-    def closed(self):
-        return self._stream.closed()
+    def close(self):
+        self._closing = True
+
+        error = RconConnectionError("RCON connection closed")
+        for command in set(self._in_flight.values()) | set(self._queue):
+            self._fail(command, error)
 
+        self._queue.clear()
+        self._in_flight.clear()
 
+        self._stream.close()
+
+    @property
+    def closed(self):
+        return self._closing or self.error is not None
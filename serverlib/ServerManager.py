@@ -5,36 +5,174 @@ change maps, etc.
 
 import logging
 
+from collections import deque, OrderedDict
+
 import psycopg2.extras
 
+from tornado import gen
+
 from entities.Server import Server
+from interfaces.executor import run_blocking
+from puglib.flushqueue import WriteChain
 
 class ServerManager(object):
-    def __init__(self, group, db):
+    def __init__(self, group, db, executor = None):
         self.game = "TF2"
         self.group = group
         self.db = db
 
+        # blocking database calls are run on the executor if one is given
+        self.executor = executor
+
         self._late_loaded = True
 
         self._servers = []
+        self._server_index = {}
+
+        # servers which are not in use, by host (ip). servers are checked when
+        # the pool is searched, so the pool may contain servers that have
+        # since been put to use or removed. hosts are kept in the order they
+        # were first seen, so that ties are broken the same way every time
+        self._free = OrderedDict()
+        self._free_set = set()
+
+        # the number of servers in use on each host, kept up to date as
+        # servers are allocated and released
+        self._host_load = {}
+
+        # the version of each server when it was last flushed, so that we
+        # only flush servers which have changed since
+        self._flushed_versions = {}
+
+        # servers are written asynchronously, in order
+        self._writes = WriteChain()
 
         self.__load_servers()
 
     def allocate(self, pug):
-        self.__load_servers() # reload servers, in case any new ones were added
+        """
+        Allocates a free server to the given pug from the free server pool.
+        The servers are not reloaded from the database; new servers are picked
+        up by `reload_servers`, which is run periodically.
 
-        # TODO: Raise an exception if we are unable to connect to the server,
-        # and disable the server so it cannot be used until fixed.
-        for server in self._servers:
-            if not server.in_use:
-                server.reserve(pug)
+        Servers which are quarantined (i.e. recently unreachable) are not
+        allocated. Of the rest, servers on the hosts running the fewest pugs
+        are preferred, followed by the servers with the best health score.
+
+        Only the free servers on the least loaded hosts are searched. Health
+        scores change with every RCON command, so the servers on those hosts
+        are compared when allocating rather than kept in order.
+
+        :return Server The allocated server, or None if there are none free
+        """
+        loads = sorted(set(self._host_load.get(x, 0) for x in self._free))
+
+        for load in loads:
+            best = None
+            for ip in self._free.keys():
+                if self._host_load.get(ip, 0) != load:
+                    continue
+
+                server = self._best_free(ip)
+                if server is not None and (best is None or 
+                        server.health.score < best.health.score):
+                    best = server
+
+            if best is not None:
+                self._take(best)
+                self._host_load[best.ip] = self._host_load.get(best.ip, 0) + 1
+
+                best.reserve(pug)
 
-                return server
+                return best
 
         # if we've reached here, there are no servers available
         return None
 
+    def _best_free(self, ip):
+        """
+        Gets the free server on the given host with the best health score,
+        removing any stale servers from the host's pool
+
+        :return Server The server, or None if none can be allocated
+        """
+        best = None
+        stale = []
+
+        for server in self._free[ip]:
+            if server.in_use or self._server_index.get(server.id) is not server:
+                stale.append(server)
+                continue
+
+            if server.health.quarantined:
+                continue
+
+            if best is None or server.health.score < best.health.score:
+                best = server
+
+        for server in stale:
+            self._take(server)
+
+        return best
+
+    def _take(self, server):
+        """
+        Removes a server from the free server pool
+        """
+        free = self._free[server.ip]
+        free.remove(server)
+        self._free_set.discard(server)
+
+        if not free:
+            del self._free[server.ip]
+
+    def _free_servers(self):
+        for free in self._free.values():
+            for server in free:
+                yield server
+
+    def check_health(self):
+        """
+        Checks the free servers whose quarantine has ended, so that they are
+        either cleared or quarantined again before a pug is given to them
+        """
+        for server in self._free_servers():
+            if server.in_use or not server.health.probe_due:
+                continue
+
+            logging.debug("Checking health of server %d", server.id)
+
+            try:
+                server.rcon("echo health check")
+
+            except:
+                logging.exception("Exception checking health of server %d",
+                                  server.id)
+
+    def _release(self, server):
+        """
+        Returns a server to the free server pool
+        """
+        if server not in self._free_set:
+            self._free.setdefault(server.ip, deque()).append(server)
+            self._free_set.add(server)
+
+            if self._host_load.get(server.ip, 0) > 0:
+                self._host_load[server.ip] -= 1
+
+    def release(self, server):
+        """
+        Returns a server given out by `allocate` to the free server pool,
+        when the pug it was allocated to could not be created. The server has
+        not been prepared, so nothing needs to be done on the server itself.
+        """
+        if server.pug is not None and server.pug.server is server:
+            server.pug.server = None
+
+        server.pug = None
+
+        self._release(server)
+
     def prepare(self, server):
         server.prepare()
 
@@ -48,6 +186,8 @@ class ServerManager(object):
 
         self._flush_server(server)
 
+        self._release(server)
+
     def reset_orphans(self):
         """
         Resets all orphaned servers (servers that have a pug ID, but no
@@ -62,21 +202,47 @@ class ServerManager(object):
 
                 self._flush_server(server)
 
+                self._release(server)
+
     def get_server_by_id(self, sid):
-        for server in self._servers:
-            if server.id == sid:
-                return server
+        return self._server_index.get(sid)
 
-        return None
+    def _flush_server(self, server, async = True):
+        # write server details to database. the server is only marked as
+        # flushed once the write succeeds, so that a failed write is retried
+        # by the next flush_all
+        if async:
+            return self._flush_server_async(server)
+
+        version = server.version
 
-    def _flush_server(self, server):
-        # write server details to database
         self.db.flush_server(server)
 
+        self._server_flushed(server, version)
+
+    @gen.coroutine
+    def _flush_server_async(self, server):
+        version = server.version
+
+        yield self._writes.submit(self.db.flush_server, server, async = True)
+
+        self._server_flushed(server, version)
+
+    def _server_flushed(self, server, version):
+        # servers removed from the group since the write was submitted are no
+        # longer tracked
+        if self._server_index.get(server.id) is server:
+            self._flushed_versions[server] = version
+
+    def _server_changed(self, server):
+        return self._flushed_versions.get(server) != server.version
 
-    def flush_all(self):
+    def flush_all(self, async = False):
+        # only flush servers which have changed since they were last flushed.
+        # the writes must be synchronous when shutting down
         for server in self._servers:
-            self._flush_server(server)
+            if self._server_changed(server):
+                self._flush_server(server, async = async)
 
     def __hydrate_server(self, data):
         logging.debug("HYDRATING SERVER. DB RESULT: %s", data)
@@ -93,15 +259,31 @@ class ServerManager(object):
 
         return server
 
+    @gen.coroutine
+    def reload_servers(self):
+        """
+        Reloads the servers from the database without blocking the IOLoop, so
+        that servers added to or removed from the group are picked up. This is
+        a coroutine.
+        """
+        results = yield run_blocking(self.executor, self.db.get_servers, 
+                                     self.group)
+
+        self.__update_servers(results)
+
     def __load_servers(self):
         """
         Load servers from the database. If a pug is in progress on a server,
         the pug will be assigned to the server object by the PugManager's pug
         loading method. We do not setup object relationships here.
-        """
 
-        results = self.db.get_servers(self.group)
+        This blocks, as the PugManager needs the servers as soon as the server
+        manager is created. Managers are created when the daemon starts,
+        before the IOLoop is running. Reloads are run on the executor.
+        """
+        self.__update_servers(self.db.get_servers(self.group))
 
+    def __update_servers(self, results):
         if not results:
             logging.error("THERE ARE NO CONFIGURED SERVERS FOR GROUP %d!", self.group)
             return
@@ -121,16 +303,46 @@ class ServerManager(object):
                 new_list.append(existing_server)
             
             else:
-                # this is a new server coming into this manager. late loading
-                # is ONLY DONE WHEN THIS DAEMON STARTS!
+                # this is a new server coming into this manager, either on
+                # startup or because it was added to the group since the last
+                # reload
                 new_list.append(new_server)
 
+                # the server is as it is in the database
+                self._flushed_versions[new_server] = new_server.version
+
 
         # we now have a list of all the servers belonging to this manager's
         # server group. if a server was removed from the group in the db,
         # it will be reflected here as well. likewise if a new server was
         # added
         self._servers = new_list
+        self._server_index = dict((x.id, x) for x in new_list)
+
+        for server in self._flushed_versions.keys():
+            if server not in new_list:
+                del self._flushed_versions[server]
+
+        # rebuild the free pool, keeping the order of servers already in it.
+        # a server's ip may have changed, so the servers are put in the pool
+        # of their current host
+        free = [ x for x in self._free_servers() 
+                 if x in new_list and not x.in_use ]
+        free_set = set(free)
+        free.extend(x for x in new_list 
+                    if not x.in_use and x not in free_set)
+
+        self._free = OrderedDict()
+        for server in free:
+            self._free.setdefault(server.ip, deque()).append(server)
+
+        self._free_set = set(free)
+
+        self._host_load = {}
+        for server in new_list:
+            if server.in_use:
+                load = self._host_load.get(server.ip, 0)
+                self._host_load[server.ip] = load + 1
 
     def late_load(self):
         if not self._late_loaded:
@@ -4,19 +4,44 @@ UDPStream (http://kyle.graehl.org/coding/2012/12/07/tornado-udpstream.html)
 as examples
 """
 
+import errno
 import socket
 import logging
 
 from tornado import ioloop
 
+# the maximum size of a single datagram we will read
+MAX_DATAGRAM_SIZE = 4096
+
+# the maximum number of datagrams read per IOLoop read event. any datagrams
+# still pending after this are read on the next event, so that a flood of
+# datagrams cannot starve other handlers on the IOLoop
+READ_BUDGET = 64
+
 class UDPServer(object):
-    def __init__(self, server_address, callback, io_loop = None):
+    """
+    If a batch_callback is given, all datagrams read during a single read event
+    are passed to it as a list. Else, callback is called for each datagram.
+    If include_address is True, each datagram is given as a tuple in the form
+    (data, (source ip, source port)).
+    """
+    def __init__(self, server_address, callback, io_loop = None,
+                 batch_callback = None, read_budget = READ_BUDGET,
+                 include_address = False):
         self.server_address = server_address
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setblocking(False)
         self._server_bind()
 
         self._callback = callback
+        self._batch_callback = batch_callback
+        self.read_budget = max(1, read_budget)
+        self.include_address = include_address
+
+        # datagrams are read into this buffer, rather than allocating a new
+        # one for every read
+        self._buffer = bytearray(MAX_DATAGRAM_SIZE)
+        self._view = memoryview(self._buffer)
 
         self._state = None
         self._stop = False
@@ -35,15 +60,9 @@ class UDPServer(object):
     Start reading
     """
     def start(self):
-        self._read_forever(None, first = True)
-
-    def _read_forever(self, data, first = False):
-        # if this is the first call, we're just starting, so we do nothing
-        # with data. if not, we forward the data to the callback
-        if not first:
-            self._callback(data)
-
+        self._read_forever()
 
+    def _read_forever(self):
         # if we're finished, HALT!
         if self._stop:
             return
@@ -76,6 +95,22 @@ class UDPServer(object):
     def recv(self, size):
         return self.socket.recv(size)
 
+    """
+    Read a single datagram into the preallocated buffer. Returns a tuple in the
+    form (data, address), or None if there are no datagrams pending
+    """
+    def recv_datagram(self):
+        try:
+            nbytes, address = self.socket.recvfrom_into(self._buffer)
+
+        except socket.error as e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return None
+
+            raise
+
+        return (self._view[:nbytes].tobytes(), address)
+
     """
     Remove our socket from the io loop and close it
     """
@@ -92,13 +127,32 @@ class UDPServer(object):
     Called by _handle_events if there is data to read
     """
     def _handle_read(self):
-        # if this method is called, we've received data
+        # if this method is called, we've received data. drain as many
+        # datagrams as we can (up to the read budget) in this event
+        datagrams = []
         try:
-            data = self.recv(4096)
+            while len(datagrams) < self.read_budget:
+                datagram = self.recv_datagram()
+                if datagram is None:
+                    break
+
+                datagrams.append(datagram if self.include_address 
+                                          else datagram[0])
+
         except:
-            data = None
+            logging.exception("Exception reading from socket")
+
+        if not datagrams:
+            return
+
+        if self._batch_callback is not None:
+            self._batch_callback(datagrams)
+
+        else:
+            for data in datagrams:
+                self._callback(data)
 
-        self._read_forever(data)
+        self._read_forever()
 
     def _handle_events(self, fd, events):
         # the socket has data available to read!
@@ -0,0 +1,73 @@
+"""
+Tracks the health of a game server, so that the server manager can prefer
+servers which respond quickly and avoid servers which are unreachable.
+
+Latency is a moving average of RCON round trip times (connect + auth, and
+command responses). Each consecutive failure (failed connect, auth error or
+command timeout) quarantines the server for twice as long as the previous one,
+up to a maximum. A single success clears the failures.
+"""
+
+import time
+
+import settings
+
+# weight given to the newest latency sample in the moving average
+LATENCY_WEIGHT = 0.3
+
+# latency assumed for servers which haven't been measured yet, in seconds
+DEFAULT_LATENCY = 0.1
+
+class ServerHealth(object):
+    def __init__(self, clock = time.time):
+        self._clock = clock
+
+        self.latency = None
+
+        self.failures = 0
+        self.quarantined_until = 0
+
+    def record_success(self, rtt):
+        """
+        Records a successful round trip to the server, taking `rtt` seconds
+        """
+        if self.latency is None:
+            self.latency = rtt
+        else:
+            self.latency += LATENCY_WEIGHT * (rtt - self.latency)
+
+        self.failures = 0
+        self.quarantined_until = 0
+
+    def record_failure(self):
+        """
+        Records a failure to communicate with the server, and quarantines the
+        server with exponential backoff
+        """
+        backoff = min(settings.server_quarantine_base * 2 ** self.failures,
+                      settings.server_quarantine_max)
+
+        self.failures += 1
+        self.quarantined_until = self._clock() + backoff
+
+    @property
+    def quarantined(self):
+        return self._clock() < self.quarantined_until
+
+    @property
+    def probe_due(self):
+        """
+        Whether the server has failed and its quarantine has ended, in which
+        case it should be checked before it is given to a pug
+        """
+        return self.failures > 0 and not self.quarantined
+
+    @property
+    def score(self):
+        """
+        Lower is better. Servers which have failed recently are penalised,
+        even once their quarantine has ended.
+        """
+        latency = DEFAULT_LATENCY if self.latency is None else self.latency
+
+        return latency * (1 + self.failures)
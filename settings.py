@@ -2,6 +2,11 @@ listen_ip = "0.0.0.0"
 listen_port = 51515
 
 logging_listen_ip = listen_ip
+# if set, the logs of all servers are received on this single port, rather
+# than on a separate ephemeral port for each server
+logging_listen_port = None
+# max number of log datagrams read from a server's socket per IOLoop event
+logging_read_budget = 64
 
 db_name = "tf2pug"
 db_user = "tf2pug"
@@ -9,8 +14,48 @@ db_pass = "theapiforme"
 db_host = "127.0.0.1"
 db_port = 5432
 
+# time in seconds to wait before writing queued pug changes to the database
+pug_flush_delay = 1.0
+
+# time in seconds between reloads of the server list from the database. servers
+# can also be reloaded immediately using the /ITF2Pug/Server/Reload/ endpoint
+server_reload_interval = 60
+
+# servers which can't be reached are not allocated for a time, starting at the
+# base time (seconds) and doubling with each consecutive failure up to the max
+server_quarantine_base = 30
+server_quarantine_max = 30*60
+
+# time in seconds an RCON connection can be idle before it is sent a keepalive,
+# and the max number of RCON commands sent to a server before their responses
+# have been read
+rcon_keepalive_interval = 30
+rcon_max_pipeline = 8
+
+# max number of pug changes appended to the pug_events table before they are
+# compacted into the pug's snapshot. pugs are also compacted when their state
+# changes
+pug_compact_events = 100
+
+# number of threads used to run blocking database queries off the IOLoop
+db_executor_workers = 4
+
+# the rating system used to rate pugs (see puglib/ratingsystems.py), and the
+# system used by particular pug groups in the form { pug group: system }
+default_rating_system = "elo"
+rating_systems = {}
+
 indexed_stats = ("kills", "deaths", "assists", "rating")
 
+# max number of players to keep deserialised stats for in memory, and the time
+# in seconds before a cached player's stats are fetched again
+player_stats_cache_size = 10000
+player_stats_cache_ttl = 300
+
+# the time in seconds between refreshes of the player ranks. ranks are also
+# refreshed when the daemon starts
+player_rank_refresh_interval = 300
+
 use_pes_unity = True
 pes_api_address = ""
 pes_api_base_url = ""
@@ -0,0 +1,27 @@
+-- Migrates a database created before the player_ranks table was added. The
+-- player_ranking view is rebuilt on top of player_ranks, and the table is
+-- backfilled with the current ranks so that existing players keep their stats
+-- and ranks. Safe to run more than once.
+BEGIN;
+
+DROP VIEW IF EXISTS player_ranking;
+
+CREATE TABLE IF NOT EXISTS player_ranks (steamid bigint PRIMARY KEY 
+                            references players(steamid) ON UPDATE CASCADE,
+                           rank integer NOT NULL);
+
+DROP INDEX IF EXISTS player_ranks_rank_idx;
+CREATE INDEX player_ranks_rank_idx ON player_ranks (rank);
+
+DELETE FROM player_ranks;
+
+INSERT INTO player_ranks (steamid, rank)
+  SELECT steamid, row_number() OVER (ORDER BY value DESC, steamid)
+  FROM players_index
+  WHERE item = 'rating';
+
+CREATE VIEW player_ranking AS 
+  SELECT r.rank, p.steamid, p.data as stats
+  FROM players p LEFT JOIN player_ranks r ON p.steamid = r.steamid;
+
+COMMIT;
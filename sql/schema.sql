@@ -31,6 +31,16 @@ $_$ LANGUAGE 'plpgsql';
 CREATE TRIGGER update_pugs_modtime BEFORE UPDATE ON pugs
   FOR EACH ROW EXECUTE PROCEDURE update_modified_time();
 
+-- Changes to pugs since their snapshot in pugs.data, as the changed sections
+-- of the pug. They are applied on top of the snapshot in order when loading,
+-- and compacted into the snapshot when the pug changes state or ends
+--DROP TABLE IF EXISTS pug_events;
+CREATE TABLE pug_events (id serial PRIMARY KEY, 
+                         pug_entity_id integer NOT NULL, data text NOT NULL,
+                         created TIMESTAMP DEFAULT current_timestamp);
+
+CREATE INDEX pug_events_pug_idx ON pug_events (pug_entity_id, id);
+
 --DROP TABLE IF EXISTS pugs_index;
 CREATE TABLE pugs_index (id serial, pug_entity_id integer UNIQUE NOT NULL,
                         finished boolean NOT NULL, 
@@ -50,17 +60,22 @@ CREATE TABLE players_index (steamid bigint references players(steamid) ON UPDATE
 CREATE TRIGGER update_players_modtime BEFORE UPDATE ON players
   FOR EACH ROW EXECUTE PROCEDURE update_modified_time();
 
+-- Player ranks by rating. This is refreshed by the daemon periodically, rather
+-- than computed on each lookup, so that getting the rank of a handful of
+-- players doesn't require ranking every player. Existing databases can be
+-- migrated with player_ranks.sql
+-- DROP TABLE IF EXISTS player_ranks CASCADE;
+CREATE TABLE player_ranks (steamid bigint PRIMARY KEY 
+                            references players(steamid) ON UPDATE CASCADE,
+                           rank integer NOT NULL);
+
+CREATE INDEX player_ranks_rank_idx ON player_ranks (rank);
+
+-- Players who have not been ranked yet have a null rank
 -- DROP VIEW IF EXISTS player_ranking;
 CREATE VIEW player_ranking AS 
-  SELECT row_number() OVER (ORDER BY pstats.value desc) as rank, 
-         pstats.steamid, pstats.data as stats
-  FROM (
-        SELECT p.steamid, p.data, pi.value
-        FROM 
-            players p JOIN players_index pi ON p.steamid = pi.steamid 
-        WHERE pi.item = 'rating' 
-        ORDER BY pi.value DESC
-      ) as pstats;
+  SELECT r.rank, p.steamid, p.data as stats
+  FROM players p LEFT JOIN player_ranks r ON p.steamid = r.steamid;
 
 -- Bans. We store ban time as an int (epoch in UTC+0 time), and
 -- duration as an int (ban duration in seconds), so we know the ban is expired
@@ -0,0 +1,68 @@
+"""
+Test case for building the API server application
+"""
+
+import sys
+sys.path.append('..')
+
+import unittest
+
+from tornado import ioloop
+
+import settings
+import apiserver
+
+class AppDB(object):
+    """
+    Stands in for the database interface, with no users or bans
+    """
+    def __init__(self):
+        self.rank_refreshes = 0
+
+    def get_bans(self):
+        return []
+
+    def refresh_player_ranks(self):
+        self.rank_refreshes += 1
+
+    def get_user_info(self, public_key = None):
+        return []
+
+class ApplicationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.io_loop = ioloop.IOLoop()
+        self.io_loop.make_current()
+
+        self.app = apiserver.Application(AppDB())
+
+    def tearDown(self):
+        self.app.close()
+
+        ioloop.IOLoop.clear_current()
+        self.io_loop.close(all_fds = True)
+
+    def test_timers(self):
+        self.assertTrue(self.app.settings["debug"])
+
+        self.assertEquals(self.app._server_reload_timer.callback_time,
+                          settings.server_reload_interval*1000)
+        self.assertTrue(self.app._server_reload_timer.is_running())
+
+    def test_rank_refresh(self):
+        timer = self.app._rank_refresh_timer
+        self.assertEquals(timer.callback_time,
+                          settings.player_rank_refresh_interval*1000)
+        self.assertTrue(timer.is_running())
+
+        self.io_loop.run_sync(self.app._refresh_player_ranks)
+        self.assertEquals(self.app.db.rank_refreshes, 1)
+
+def test_suites():
+    classes = [ ApplicationTestCase ]
+
+    return [ unittest.TestLoader().loadTestsFromTestCase(x) for x in classes ]
+
+if __name__ == "__main__":
+    suites = test_suites()
+    unittest.TestSuite(suites)
+    unittest.main()
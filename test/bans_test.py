@@ -0,0 +1,181 @@
+import sys
+sys.path.append('..')
+
+import time
+import unittest
+
+from tornado import ioloop, gen
+from tornado.concurrent import Future
+
+from puglib.bans import Ban, BanManager, BanAddException
+
+class BanDB(object):
+    """
+    Stands in for the database interface, recording ban writes
+    """
+    def __init__(self, bans = None):
+        self.rows = bans or []
+        self.flushed = []
+
+        # when set, writes wait for this Future, and fail with its error
+        self.pending = None
+
+    def get_bans(self):
+        return list(self.rows)
+
+    @gen.coroutine
+    def flush_ban(self, ban, async = False):
+        if self.pending is not None:
+            yield self.pending
+
+        self.flushed.append(dict(ban))
+
+        if ban.id is None:
+            ban.id = len(self.flushed)
+
+def ban_data(cid, duration):
+    return {
+        "bannee": { "id": cid, "name": str(cid) },
+        "banner": { "id": 1, "name": "admin" },
+        "reason": "test",
+        "duration": duration
+    }
+
+class BanManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.io_loop = ioloop.IOLoop()
+        self.io_loop.make_current()
+
+        now = time.time()
+        self.db = BanDB([
+            # already expired, a permanent ban and a long ban
+            Ban(id = 1, banned_cid = 10, ban_start_time = now - 100,
+                ban_duration = 50),
+            Ban(id = 2, banned_cid = 11, ban_start_time = now,
+                ban_duration = None),
+            Ban(id = 3, banned_cid = 12, ban_start_time = now,
+                ban_duration = 3600),
+        ])
+
+        self.manager = BanManager(self.db)
+
+    def tearDown(self):
+        self.manager.close()
+
+        ioloop.IOLoop.clear_current()
+        self.io_loop.close(all_fds = True)
+
+    def run_for(self, seconds):
+        self.io_loop.call_later(seconds, self.io_loop.stop)
+        self.io_loop.start()
+
+    def test_load(self):
+        self.assertIsNotNone(self.manager.get_player_ban(11))
+        self.assertIsNotNone(self.manager.get_player_ban(12))
+
+        # the ban which expired while we were down is removed by the timer
+        self.assertIsNotNone(self.manager.get_player_ban(10))
+        self.run_for(0.01)
+
+        self.assertIsNone(self.manager.get_player_ban(10))
+        self.assertTrue(self.db.flushed[0]["expired"])
+
+        # the next check is scheduled for the next ban to expire
+        self.assertEquals(self.manager._expiry_deadline,
+                          self.db.rows[2].expiry_time)
+
+    def test_expiry_timer(self):
+        self.io_loop.run_sync(lambda: self.manager.add_ban(ban_data(20, 0.05)))
+        self.assertIsNotNone(self.manager.get_player_ban(20))
+
+        self.run_for(0.1)
+
+        self.assertIsNone(self.manager.get_player_ban(20))
+        self.assertIsNotNone(self.manager.get_player_ban(12))
+
+    def test_update_ban(self):
+        self.io_loop.run_sync(lambda: self.manager.add_ban(ban_data(20, 0.05)))
+
+        # extending the ban leaves the old expiry in the heap, which must not
+        # remove the ban
+        self.io_loop.run_sync(lambda: self.manager.add_ban(ban_data(20, 3600)))
+        self.run_for(0.1)
+
+        ban = self.manager.get_player_ban(20)
+        self.assertIsNotNone(ban)
+        self.assertEquals(ban.duration, 3600)
+        self.assertFalse(ban.expired)
+
+    def test_remove_ban(self):
+        self.io_loop.run_sync(lambda: self.manager.add_ban(ban_data(20, 0.05)))
+        self.io_loop.run_sync(lambda: self.manager.remove_ban(20))
+
+        self.assertIsNone(self.manager.get_player_ban(20))
+
+        # a new ban isn't removed by the expiry of the removed one
+        self.io_loop.run_sync(lambda: self.manager.add_ban(ban_data(20, None)))
+        self.run_for(0.1)
+
+        self.assertIsNotNone(self.manager.get_player_ban(20))
+
+    def test_applies_while_writing(self):
+        self.db.pending = Future()
+
+        added = self.manager.add_ban(ban_data(20, None))
+        self.assertIsNotNone(self.manager.get_player_ban(20))
+
+        self.db.pending.set_result(None)
+        self.io_loop.run_sync(lambda: added)
+
+        self.assertIsNotNone(self.manager.get_player_ban(20).id)
+
+    def test_failed_add(self):
+        self.db.pending = Future()
+        self.db.pending.set_exception(IOError("write failed"))
+
+        with self.assertRaises(BanAddException):
+            self.io_loop.run_sync(
+                lambda: self.manager.add_ban(ban_data(20, 0.05)))
+
+        self.assertIsNone(self.manager.get_player_ban(20))
+
+    def test_failed_update(self):
+        self.db.pending = Future()
+        self.db.pending.set_exception(IOError("write failed"))
+
+        with self.assertRaises(BanAddException):
+            self.io_loop.run_sync(
+                lambda: self.manager.add_ban(ban_data(12, 0.05)))
+
+        # the ban keeps its old duration, and isn't expired by the new one
+        self.run_for(0.1)
+
+        ban = self.manager.get_player_ban(12)
+        self.assertIsNotNone(ban)
+        self.assertEquals(ban.duration, 3600)
+        self.assertFalse(ban.expired)
+
+    def test_concurrent_adds(self):
+        self.db.pending = Future()
+
+        first = self.manager.add_ban(ban_data(20, None))
+        second = self.manager.add_ban(ban_data(20, 3600))
+
+        self.db.pending.set_result(None)
+        bans = self.io_loop.run_sync(lambda: gen.multi([ first, second ]))
+
+        # the second add updates the ban inserted by the first
+        self.assertIs(bans[0], bans[1])
+        writes = [ x for x in self.db.flushed if x["banned_cid"] == 20 ]
+        self.assertEquals([ x["id"] for x in writes ], [ None, bans[0].id ])
+        self.assertEquals(self.manager.get_player_ban(20).duration, 3600)
+
+def test_suites():
+    classes = [ BanManagerTestCase ]
+
+    return [ unittest.TestLoader().loadTestsFromTestCase(x) for x in classes ]
+
+if __name__ == "__main__":
+    suites = test_suites()
+    unittest.TestSuite(suites)
+    unittest.main()
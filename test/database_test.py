@@ -73,6 +73,30 @@ def test_stat_index():
 
     test_flush_player_stats()
 
+def test_refresh_player_ranks():
+    print "Refreshing player ranks:"
+    dbif.refresh_player_ranks()
+
+    print "Top players: %s" % dbif.get_top_players("rating", 5)
+
+def test_import_player_stats():
+    print "Importing stat data:"
+    for cid in player_stats:
+        player_stats[cid]["deaths"] = 5
+
+    dbif.import_player_stats(player_stats)
+
+def test_set_player_ratings():
+    print "Setting player ratings:"
+    ratings = dict((cid, 1600.5) for cid in player_stats)
+
+    print "Updated %d players" % dbif.set_player_ratings(ratings)
+
+def test_iter_finished_pugs():
+    print "Finished pugs:"
+    for pug in dbif.iter_finished_pugs(TFPugJsonInterface()):
+        print pug.id, pug.game_scores
+
 def test_get_pugs():
     print "Getting pugs for API key %s" % api_key
     pugs = dbif.get_pugs(api_key, TFPugJsonInterface())
@@ -86,6 +110,22 @@ def test_flush_pug(end = False):
 
         dbif.flush_pug(api_key, TFPugJsonInterface(), pug)
 
+def test_pug_events():
+    print "Flushing pug changes as events"
+    iface = TFPugJsonInterface()
+
+    pug = Pug.Pug()
+    dbif.flush_pug(api_key, iface, pug)
+
+    # the state hasn't changed, so only the changed sections are written
+    pug.add_player(1L, "1", Pug.PlayerStats())
+    dbif.flush_pug(api_key, iface, pug)
+
+    loaded = [ x for x in dbif.get_pugs(api_key, iface) if x.id == pug.id ]
+    print "Pug replayed with new player? %s" % (1L in loaded[0]._players)
+
+    pugs.append(pug)
+
 def test_get_servers():
     print "Getting servers for group %d" % server_group
     serverdata = dbif.get_servers(server_group)
@@ -117,14 +157,30 @@ def test_all():
     # test the stat index
     test_stat_index()
 
+    print "Refreshing ranks and getting stats again"
+    test_refresh_player_ranks()
+    test_get_player_stats()
+
+    print "Importing player stats and getting them again"
+    test_import_player_stats()
+    test_get_player_stats()
+
+    print "Setting player ratings and getting them again"
+    test_set_player_ratings()
+    test_get_player_stats()
+
     print "Flushing new pug and getting it again"
     # get pugs/flush pugs
     test_flush_pug()
     test_get_pugs()
 
+    print "Flushing pug changes and replaying them"
+    test_pug_events()
+
     print "Flushing ended pug and checking pug listing"
     test_flush_pug(True)
     test_get_pugs()
+    test_iter_finished_pugs()
 
     print "Getting servers & flushing"
     test_get_servers()
@@ -0,0 +1,75 @@
+import sys
+sys.path.append('..')
+
+import time
+import threading
+import unittest
+
+from tornado import ioloop, gen
+
+from interfaces.executor import DatabaseExecutor, run_blocking
+
+class ExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.io_loop = ioloop.IOLoop(make_current = False)
+        self.executor = DatabaseExecutor(1)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        self.io_loop.close()
+
+    def test_off_loop(self):
+        main_thread = threading.current_thread()
+
+        def query():
+            return threading.current_thread()
+
+        thread = self.io_loop.run_sync(lambda: self.executor.submit(query))
+
+        self.assertNotEqual(thread, main_thread)
+
+    def test_metrics(self):
+        @gen.coroutine
+        def run():
+            # with one worker, the second call has to wait for the first
+            first = self.executor.submit(time.sleep, 0.02)
+            second = self.executor.submit(time.sleep, 0)
+
+            self.assertEquals(self.executor.stats()["queued"] + 
+                              self.executor.stats()["running"], 2)
+
+            yield [ first, second ]
+
+        self.io_loop.run_sync(run)
+
+        stats = self.executor.stats()
+        self.assertEquals(stats["queued"], 0)
+        self.assertEquals(stats["running"], 0)
+        self.assertEquals(stats["completed"], 2)
+        self.assertTrue(stats["max_wait"] >= 0.01)
+
+    def test_failure(self):
+        def query():
+            raise ValueError("bad query")
+
+        self.assertRaises(ValueError, self.io_loop.run_sync, 
+                          lambda: self.executor.submit(query))
+
+        self.assertEquals(self.executor.stats()["failed"], 1)
+
+    def test_no_executor(self):
+        future = run_blocking(None, lambda x: x + 1, 1)
+        self.assertEquals(future.result(), 2)
+
+        future = run_blocking(None, lambda: 1 / 0)
+        self.assertRaises(ZeroDivisionError, future.result)
+
+def test_suites():
+    classes = [ ExecutorTestCase ]
+
+    return [ unittest.TestLoader().loadTestsFromTestCase(x) for x in classes ]
+
+if __name__ == "__main__":
+    unittest.TestSuite(test_suites())
+
+    unittest.main()
@@ -45,7 +45,7 @@ def fill():
 
         print "Built stat dict for %s" % cid
 
-    # stats is now full. flush into database
-    db.flush_player_stats(stats)
+    # stats is now full. import into database
+    db.import_player_stats(stats)
 
 fill()
@@ -0,0 +1,169 @@
+import sys
+sys.path.append('..')
+
+import unittest
+
+from tornado import ioloop, gen
+from tornado.concurrent import Future
+
+from puglib.flushqueue import FlushQueue, WriteChain
+
+class Entity(object):
+    pass
+
+class FlushQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.flushed = []
+
+        self.io_loop = ioloop.IOLoop(make_current = False)
+        self.queue = FlushQueue(self.flushed.append, 0.01, 
+                                io_loop = self.io_loop)
+
+    def tearDown(self):
+        self.queue.clear()
+        self.io_loop.close()
+
+    def _run_loop(self):
+        self.io_loop.call_later(0.05, self.io_loop.stop)
+        self.io_loop.start()
+
+    def test_merge(self):
+        a = Entity()
+        b = Entity()
+
+        self.queue.add(a)
+        self.queue.add(b)
+        self.queue.add(a)
+
+        self.assertEquals(len(self.queue), 2)
+        self.assertEquals(self.flushed, [])
+
+        self._run_loop()
+
+        # a single batch, in the order the entities were first queued
+        self.assertEquals(self.flushed, [ [ a, b ] ])
+        self.assertEquals(len(self.queue), 0)
+
+    def test_discard(self):
+        a = Entity()
+        b = Entity()
+
+        self.queue.add(a)
+        self.queue.add(b)
+        self.queue.discard(a)
+
+        self.assertNotIn(a, self.queue)
+
+        self.queue.flush()
+        self.assertEquals(self.flushed, [ [ b ] ])
+
+        # flushing again does nothing, and the timer was cancelled
+        self._run_loop()
+        self.assertEquals(self.flushed, [ [ b ] ])
+
+    def test_clear(self):
+        self.queue.add(Entity())
+        self.queue.clear()
+
+        self._run_loop()
+        self.assertEquals(self.flushed, [])
+
+    def test_take(self):
+        a = Entity()
+
+        self.queue.add(a)
+        self.assertEquals(self.queue.take(), [ a ])
+
+        # the taken entities are the caller's to flush
+        self._run_loop()
+        self.assertEquals(self.flushed, [])
+
+    def test_requeue_failed(self):
+        a = Entity()
+        b = Entity()
+
+        # the first write of the batch fails
+        results = []
+        def flush(entities):
+            self.flushed.append(entities)
+
+            future = Future()
+            if results:
+                future.set_result(None)
+            else:
+                future.set_exception(ValueError("write failed"))
+
+            results.append(future)
+            return future
+
+        self.queue = FlushQueue(flush, 0.01, io_loop = self.io_loop)
+        self.queue.add(a)
+        self.queue.add(b)
+
+        self._run_loop()
+
+        # the failed batch was queued and written again
+        self.assertEquals(self.flushed, [ [ a, b ], [ a, b ] ])
+        self.assertEquals(len(self.queue), 0)
+
+class WriteChainTestCase(unittest.TestCase):
+    def setUp(self):
+        self.written = []
+
+        self.io_loop = ioloop.IOLoop(make_current = False)
+        self.chain = WriteChain()
+
+    def tearDown(self):
+        self.io_loop.close()
+
+    @gen.coroutine
+    def _write(self, value, delay, fail = False):
+        yield gen.sleep(delay)
+
+        if fail:
+            raise ValueError(value)
+
+        self.written.append(value)
+        raise gen.Return(value)
+
+    def test_order(self):
+        @gen.coroutine
+        def run():
+            # the first write takes the longest, but must still be first
+            first = self.chain.submit(self._write, 1, 0.03)
+            second = self.chain.submit(self._write, 2, 0.01)
+            third = self.chain.submit(self._write, 3, 0)
+
+            results = yield [ first, second, third ]
+            raise gen.Return(results)
+
+        results = self.io_loop.run_sync(run)
+
+        self.assertEquals(results, [ 1, 2, 3 ])
+        self.assertEquals(self.written, [ 1, 2, 3 ])
+        self.assertTrue(self.chain.idle)
+
+    def test_failure(self):
+        @gen.coroutine
+        def run():
+            first = self.chain.submit(self._write, 1, 0.01, fail = True)
+            second = self.chain.submit(self._write, 2, 0)
+
+            yield second
+
+            self.assertRaises(ValueError, first.result)
+
+        self.io_loop.run_sync(run)
+
+        # a failed write does not stop the writes after it
+        self.assertEquals(self.written, [ 2 ])
+
+def test_suites():
+    classes = [ FlushQueueTestCase, WriteChainTestCase ]
+
+    return [ unittest.TestLoader().loadTestsFromTestCase(x) for x in classes ]
+
+if __name__ == "__main__":
+    unittest.TestSuite(test_suites())
+
+    unittest.main()
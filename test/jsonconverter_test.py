@@ -0,0 +1,176 @@
+"""
+Test case for pug serialisation, in the compact format, the old format and
+as deltas, and the pug event log written from the deltas.
+"""
+
+import sys
+sys.path.append('..')
+
+import json
+
+from entities import Pug
+from entities.Pug import PlayerStats
+from interfaces import TFPugJsonInterface, PSQLDatabaseInterface
+
+def game_pug():
+    pug = Pug.Pug(pid = 5)
+    for i in xrange(1, 13):
+        pug.add_player(76561197960265728L + i, str(i), PlayerStats())
+
+    pug.begin_map_vote()
+    pug.vote_map(76561197960265729L, "cp_badlands")
+    pug.end_map_vote()
+    pug.shuffle_teams()
+    pug.begin_game()
+
+    pug.update_game_stat(76561197960265729L, "kills", 3)
+    pug.update_score("red", 1)
+
+    return pug
+
+def legacy_dumps(pug):
+    # the old format, a dump of the pug's __dict__
+    obj_dict = pug.__dict__.copy()
+    obj_dict["server"] = None
+    del obj_dict["player_index"]
+
+    return json.dumps(obj_dict, default = lambda x: list(x))
+
+def assert_same(pug, loaded):
+    for key, value in pug.__dict__.iteritems():
+        if key in ("server", "player_index"):
+            continue
+
+        assert getattr(loaded, key) == value, key
+
+def test_roundtrip():
+    iface = TFPugJsonInterface()
+    pug = game_pug()
+
+    # a stat which is only set for some players, and a None stat
+    pug.game_stats[76561197960265730L]["captures"] = 1
+    pug.player_stats[76561197960265731L]["rating"] = None
+
+    data = iface.dumps(pug)
+    assert json.loads(data)["v"] == 2
+
+    loaded = iface.loads(5, data)
+    assert_same(pug, loaded)
+    assert "captures" not in loaded.game_stats[76561197960265729L]
+
+    # the compact format is much smaller than the old one
+    assert len(data) < len(legacy_dumps(pug))/2
+
+def test_legacy():
+    iface = TFPugJsonInterface()
+    pug = game_pug()
+
+    loaded = iface.loads(5, legacy_dumps(pug))
+    assert_same(pug, loaded)
+
+def test_delta():
+    iface = TFPugJsonInterface()
+    pug = game_pug()
+
+    written = {}
+    base = iface.dumps_delta(pug, written)
+    assert iface.dumps_delta(pug, written) is None
+
+    # a change to the version alone isn't written
+    pug.mark_changed()
+    assert iface.dumps_delta(pug, written) is None
+
+    # only the changed player's row is written, along with the version
+    pug.update_game_stat(76561197960265729L, "kills", 1)
+    delta = iface.dumps_delta(pug, written)
+
+    data = json.loads(delta)
+    assert set(data) == set([ "v", "meta", "game_stats" ])
+    assert data["meta"] == { "version": pug.version }
+    assert data["game_stats"]["ids"] == [ 76561197960265729L ]
+    assert data["game_stats"]["removed"] == []
+
+    loaded = iface.loads(5, base)
+    iface.apply_delta(loaded, delta)
+    assert_same(pug, loaded)
+
+    # removed players are listed, and changed meta attributes are written
+    pug.remove_player(76561197960265730L)
+    delta = iface.dumps_delta(pug, written)
+
+    data = json.loads(delta)
+    assert 76561197960265730L in data["player_stats"]["removed"]
+    assert "version" in data["meta"] and len(data["meta"]) > 1
+
+    iface.apply_delta(loaded, delta)
+    assert_same(pug, loaded)
+
+def test_snapshot_delta():
+    iface = TFPugJsonInterface()
+    pug = game_pug()
+
+    # deltas can follow a full snapshot
+    written = {}
+    snapshot = iface.join_sections(iface.dump_sections(pug, written))
+    assert iface.dumps_delta(pug, written) is None
+
+    pug.update_game_stat(76561197960265731L, "deaths", 1)
+
+    loaded = iface.loads(5, snapshot)
+    iface.apply_delta(loaded, iface.dumps_delta(pug, written))
+    assert_same(pug, loaded)
+
+def test_event_log():
+    iface = TFPugJsonInterface()
+    dbif = PSQLDatabaseInterface(None, None, pug_compact_events = 2)
+    pug = game_pug()
+
+    # a pug we haven't written is compacted into a new snapshot
+    statements = dbif._pug_write(iface, pug)
+    assert statements[0][0].startswith("UPDATE pugs SET data")
+    assert "DELETE FROM pug_events" in statements[1][0]
+
+    snapshot = statements[0][1][0]
+
+    # then only changes are written, as events
+    assert dbif._pug_write(iface, pug) == []
+
+    events = []
+    for i in range(2):
+        pug.update_game_stat(76561197960265729L, "kills", 1)
+
+        statements = dbif._pug_write(iface, pug)
+        assert len(statements) == 1
+        assert "INSERT INTO pug_events" in statements[0][0]
+
+        events.append(statements[0][1][1])
+
+    loaded = iface.loads(5, snapshot)
+    for data in events:
+        iface.apply_delta(loaded, data)
+
+    assert_same(pug, loaded)
+
+    # too many events
+    pug.update_game_stat(76561197960265729L, "kills", 1)
+    assert dbif._pug_write(iface, pug)[0][0].startswith("UPDATE pugs")
+
+    # after the compaction, changes are events again
+    pug.update_game_stat(76561197960265729L, "kills", 1)
+    assert "INSERT" in dbif._pug_write(iface, pug)[0][0]
+
+    # the end of the game is a state change, and marks the pug finished
+    pug.end_game()
+    statements = dbif._pug_write(iface, pug)
+    assert statements[0][0].startswith("UPDATE pugs")
+    assert "finished = true" in statements[2][0]
+
+def test():
+    test_roundtrip()
+    test_legacy()
+    test_delta()
+    test_snapshot_delta()
+    test_event_log()
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,198 @@
+"""
+Log parsing throughput benchmark.
+
+Replays the log corpus (test_log.log by default) through
+TFLogInterface.parse, using a stub RCON connection in place of a real game
+server (as in logging_test.py). Reports lines/sec, per-group match counts, the
+miss rate and p50/p99 per-line latency.
+
+Multiple copies of the corpus can be replayed at once (interleaved line by
+line, each with its own server, pug and log interface) to simulate many
+concurrent pugs sharing the IOLoop. The corpus line rate is used to estimate
+how many live pugs a single daemon can ingest logs for.
+
+Usage: python log_benchmark.py [--copies N] [--passes N] [--log FILE]
+"""
+
+import sys
+sys.path.append('..')
+
+import os
+import re
+import time
+import logging
+import argparse
+import datetime
+
+from timeit import default_timer as timer
+
+from tornado.concurrent import Future
+
+from interfaces import get_log_interface, tflogging
+from entities import Server, Pug
+
+DEFAULT_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "test_log.log")
+
+# the header the game server sends with each log datagram
+LOG_HEADER = "\xFF\xFF\xFF\xFFR"
+
+steamid_re = re.compile(r'<(STEAM_\d:\d:\d+|\[U:1:\d+\])>')
+time_re = re.compile(r'^L ([0-9\/]+ - [0-9\:]+):')
+
+class RconConnection(object):
+    def __init__(self, *args):
+        pass
+
+    def send_cmd(self, cmd, cb = None):
+        pass
+
+    def execute(self, cmd, timeout = None):
+        future = Future()
+        future.set_result((0, 0, ""))
+
+        return future
+
+    @property
+    def closed(self):
+        return False
+
+class ReplayTarget(object):
+    """
+    A server, pug and log interface for a single simulated pug. Match counts
+    are recorded per group by wrapping the log interface's dispatch methods.
+    """
+    def __init__(self, steamids, counts):
+        self.server = Server.Server("TF2")
+        self.server.rcon_connection = RconConnection()
+
+        self.pug = Pug.Pug(pid = 1, size = len(steamids))
+        for i, sid in enumerate(steamids):
+            cid = tflogging.steamid_to_64bit(sid)
+            self.pug.add_player(cid, str(i), Pug.PlayerStats())
+
+        self.server.reserve(self.pug)
+
+        self.log_interface = get_log_interface(self.server.game)(self.server)
+
+        dispatch = self.log_interface._dispatch
+        for group in dispatch:
+            dispatch[group] = self._counted(group, dispatch[group], counts)
+
+    def _counted(self, group, method, counts):
+        def f(match, expr):
+            counts[group] = counts.get(group, 0) + 1
+            method(match, expr)
+
+        return f
+
+def load_corpus(path):
+    with open(path) as f:
+        lines = [ x.rstrip("\r\n") for x in f if x.strip() ]
+
+    steamids = sorted(set(sum([ steamid_re.findall(x) for x in lines ], [])))
+
+    return lines, steamids
+
+def corpus_duration(lines):
+    """
+    The time in seconds covered by the corpus, based on the timestamps of the
+    first and last lines
+    """
+    fmt = "%m/%d/%Y - %H:%M:%S"
+    first = time_re.match(lines[0])
+    last = time_re.match(lines[-1])
+    if first is None or last is None:
+        return 0
+
+    delta = (datetime.datetime.strptime(last.group(1), fmt) -
+             datetime.datetime.strptime(first.group(1), fmt))
+
+    return delta.days * 86400 + delta.seconds
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+
+    index = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+def run(lines, steamids, copies = 1, passes = 1):
+    """
+    Replays the corpus `passes` times through `copies` log interfaces, with
+    the copies interleaved line by line.
+
+    :return dict A dict of benchmark results
+    """
+    datagrams = [ LOG_HEADER + x for x in lines ]
+
+    counts = {}
+    latencies = []
+    elapsed = 0.0
+
+    for p in xrange(passes):
+        # new targets each pass, so that every pass starts before the game
+        targets = [ ReplayTarget(steamids, counts) for x in xrange(copies) ]
+        parsers = [ x.log_interface.parse for x in targets ]
+
+        start = timer()
+        for data in datagrams:
+            for parse in parsers:
+                line_start = timer()
+                parse(data)
+                latencies.append(timer() - line_start)
+
+        elapsed += timer() - start
+
+    total = len(datagrams) * copies * passes
+    matched = sum(counts.values())
+    latencies.sort()
+
+    return {
+        "lines": total,
+        "elapsed": elapsed,
+        "lines_per_sec": total / elapsed if elapsed else 0,
+        "counts": counts,
+        "matched": matched,
+        "miss_rate": float(total - matched) / total if total else 0,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+    }
+
+def report(results, corpus_lines, duration, copies):
+    print "Lines parsed:     %d (%d copies)" % (results["lines"], copies)
+    print "Elapsed:          %.3fs" % results["elapsed"]
+    print "Throughput:       %.0f lines/sec" % results["lines_per_sec"]
+    print "Latency p50/p99:  %.1fus / %.1fus" % (results["p50"] * 1e6,
+                                                 results["p99"] * 1e6)
+    print "Miss rate:        %.2f%%" % (results["miss_rate"] * 100)
+    print "Matches per group:"
+    for group in sorted(tflogging.regex):
+        print "    %-20s %d" % (group, results["counts"].get(group, 0))
+
+    if duration > 0:
+        pug_rate = float(corpus_lines) / duration
+        print "Corpus line rate: %.2f lines/sec per pug" % pug_rate
+        print "Estimated pugs:   %d" % (results["lines_per_sec"] / pug_rate)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Log parsing benchmark")
+    parser.add_argument("--log", default = DEFAULT_LOG,
+                        help = "The log file to replay")
+    parser.add_argument("--copies", type = int, default = 1,
+                        help = "Number of concurrent pugs to simulate")
+    parser.add_argument("--passes", type = int, default = 1,
+                        help = "Number of times to replay the corpus")
+    args = parser.parse_args()
+
+    # we don't want to benchmark the logging module
+    logging.basicConfig(level = logging.CRITICAL)
+
+    lines, steamids = load_corpus(args.log)
+
+    results = run(lines, steamids, copies = args.copies, passes = args.passes)
+
+    report(results, len(lines), corpus_duration(lines), args.copies)
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,7 @@ from interfaces import get_log_interface, tflogging
 from entities import Server, Pug
 
 from tornado import ioloop
+from tornado.concurrent import Future
 
 
 class RconConnection(object):
@@ -21,6 +22,12 @@ class RconConnection(object):
     def send_cmd(self, cmd, cb):
         print "SERVER: Command to send: %s" % cmd
 
+    def execute(self, cmd, timeout = None):
+        future = Future()
+        future.set_result((0, 0, ""))
+
+        return future
+
     @property
     def closed(self):
         return False
@@ -163,6 +170,30 @@ class RegexTestCase(unittest.TestCase):
 
         self.check_group_match(strings, "report")
 
+    def test_no_match(self):
+        s1 = 'L 10/01/2012 - 21:38:30: "1<43><[U:1:1]><Blue>" triggered "damage" (damage "4")'
+        s2 = 'L 10/01/2012 - 21:38:27: "1<52><[U:1:1]><Red>" triggered "healed" against "2<48><[U:1:2]><Red>" (healing "19")'
+        s3 = 'L 10/01/2012 - 21:38:48: World triggered "Point_Captured" (cp "2")'
+        s4 = 'L 10/01/2012 - 21:38:17: Log file started (file "logs/L1001005.log")'
+        s5 = '10/01/2012 - 22:20:45: "1<0><[U:1:1]><Blue>" killed "2<2><[U:1:2]><Red>" with "scattergun" (attacker_position "-1803 129 236") (victim_position "-1767 278 218")'
+
+        for s in [ s1, s2, s3, s4, s5 ]:
+            self.assertEquals(tflogging.check_regex_match(s), None)
+
+    def test_tricky_name(self):
+        # player names containing the '>" ' separator and verbs
+        s1 = 'L 10/01/2012 - 21:58:09: "a>" killed <0><[U:1:2]><Red>" say "!teams"'
+        s2 = 'L 10/01/2012 - 22:20:45: "a>" say "<0><[U:1:1]><Blue>" killed "2<2><[U:1:2]><Red>" with "scattergun" (attacker_position "-1803 129 236") (victim_position "-1767 278 218")'
+
+        group, match, expr = tflogging.check_regex_match(s1)
+        self.assertEquals(group, "chat")
+        self.assertEquals(match.group(1), 'a>" killed ')
+
+        group, match, expr = tflogging.check_regex_match(s2)
+        self.assertEquals(group, "player_stat")
+        self.assertIs(expr, tflogging.player_kill)
+        self.assertEquals(match.group(3), "[U:1:1]")
+
 class ConnectTestCase(LoggingTestCase):
     def test_valid_connect(self):
         msg = 'RL 10/01/2012 - 22:07:32: "1<0><[U:1:1]><>" connected, address "1.1.1.1:12345"'
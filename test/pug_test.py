@@ -476,6 +476,64 @@ def test_replace_player_multi():
     assert pug.full == True
     assert pug.state == Pug.states["TEAMS_SHUFFLED"]
 
+def test_player_index():
+    print "Testing player_index"
+    index = {}
+    pug = Pug.Pug()
+    pug.add_player(1L, "1", PlayerStats())
+
+    # existing players are indexed when the index is set
+    pug.set_player_index(index)
+    assert index == { 1L: pug }
+
+    pug.add_player(2L, "2", PlayerStats())
+    assert index[2L] is pug
+
+    pug.remove_player(1L)
+    assert 1L not in index
+
+    # players removed by the disconnect check are removed too
+    pug.add_disconnect(2L, "gone")
+    pug.disconnects[0]["time"] -= Pug.DISCONNECT_TIMEOUT + 1
+    pug.check_disconnects()
+    assert 2L not in index
+
+    # a player in another pug in the group is not removed by this pug
+    other = Pug.Pug()
+    other.set_player_index(index)
+    pug.add_player(3L, "3", PlayerStats())
+    other.add_player(4L, "4", PlayerStats())
+    pug.remove_player(4L)
+    assert index[4L] is other
+
+    pug.set_player_index(None)
+    assert index == { 4L: other }
+
+def test_version():
+    print "Testing version"
+    pug = Pug.Pug()
+
+    version = pug.version
+    pug.add_player(1L, "1", PlayerStats())
+    assert pug.version > version
+
+    # no change, no new version
+    version = pug.version
+    pug.update_game_stat(1L, "kills", 1)
+    pug.vote_map(1L, "cp_badlands")
+    pug.remove_player(2L)
+    assert pug.version == version
+
+    # stat updates from the log interface are changes
+    pug.begin_game()
+    version = pug.version
+    pug.update_game_stat(1L, "kills", 1)
+    assert pug.version > version
+
+    version = pug.version
+    pug.update_score("red", 1)
+    assert pug.version > version
+
 def test():
     test_add_player()
     test_remove_player()
@@ -490,6 +548,8 @@ def test():
     test_shuffle_teams()
     test_replace_player_single()
     test_replace_player_multi()
+    test_player_index()
+    test_version()
 
 if __name__ == "__main__":
     test()
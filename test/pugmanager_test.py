@@ -7,6 +7,9 @@ sys.path.append('..')
 import unittest
 import psycopg2.pool
 
+from tornado import gen
+from tornado.ioloop import IOLoop
+
 import settings
 
 from puglib.PugManager import PugManager
@@ -16,9 +19,12 @@ import puglib.Exceptions as PMEx
 from interfaces import PSQLDatabaseInterface
 from serverlib.ServerManager import ServerManager
 
+def run(method, *args, **kwargs):
+    return IOLoop.current().run_sync(lambda: method(*args, **kwargs))
+
 def fill_pug(m, pug):
     for i in range(2, pug.size+1):
-        m.add_player(i, str(i), pug.id)
+        run(m.add_player, i, str(i), pug.id)
 
 class ManagerTestCase(unittest.TestCase):
     def setUp(self):
@@ -52,26 +58,35 @@ class ManagerTestCase(unittest.TestCase):
     def tearDown(self):
         self.pool.closeall()
 
+    def create_pug(self, *args, **kwargs):
+        return run(self.pm.create_pug, *args, **kwargs)
+
+    def add_player(self, *args, **kwargs):
+        return run(self.pm.add_player, *args, **kwargs)
+
+    def add_ban(self, *args, **kwargs):
+        return run(self.bm.add_ban, *args, **kwargs)
+
     def create_full_pug(self):
-        pug = self.pm.create_pug(1, "1")
+        pug = self.create_pug(1, "1")
         fill_pug(self.pm, pug)
 
         return pug
 
 class CreatePugTest(ManagerTestCase):
     def test_create_pug(self):
-        pug = self.pm.create_pug(1, "1")
+        pug = self.create_pug(1, "1")
         self.assertTrue(isinstance(pug, Pug))
         self.assertListEqual(self.pm._pugs, [ pug ])
 
     def test_end_pug(self):
-        pug = self.pm.create_pug(1, "1")
+        pug = self.create_pug(1, "1")
 
         self.pm._end_pug(pug)
         self.assertListEqual(self.pm._pugs, [])
 
     def test_create_banned_player(self):
-        self.bm.add_ban(
+        self.add_ban(
             {
                 "bannee": {
                     "id": 1,
@@ -87,45 +102,45 @@ class CreatePugTest(ManagerTestCase):
             })
 
         self.assertRaises(PMEx.PlayerBannedException, 
-                          lambda: self.pm.create_pug(1, "1"))
+                          lambda: self.create_pug(1, "1"))
 
     def test_create_player_in_pug(self):
-        pug = self.pm.create_pug(1, "1")
+        pug = self.create_pug(1, "1")
 
         self.assertRaises(PMEx.PlayerInPugException,
-                          lambda: self.pm.create_pug(1, "1"))
+                          lambda: self.create_pug(1, "1"))
 
 
     def test_create_player_restricted(self):
         # get player elo, check restriction either side
-        stats = self.pm._get_player_stats(1)
+        stats = run(self.pm._get_player_stats, 1)
         rating = stats[1]["rating"]
 
         self.assertRaises(PMEx.PlayerRestrictedException, 
-                    lambda: self.pm.create_pug(1, "1", restriction = -rating))
+                    lambda: self.create_pug(1, "1", restriction = -rating))
 
         self.assertRaises(PMEx.PlayerRestrictedException,
-                    lambda: self.pm.create_pug(1, "1", restriction = rating+1))
+                    lambda: self.create_pug(1, "1", restriction = rating+1))
 
     def test_no_servers_available(self):
-        pug = self.pm.create_pug(1, "1")
+        pug = self.create_pug(1, "1")
 
         self.assertRaises(PMEx.NoAvailableServersException,
-                          lambda: self.pm.create_pug(2, "2"))
+                          lambda: self.create_pug(2, "2"))
 
     def test_map_forced(self):
-        pug = self.pm.create_pug(1, "1", pug_map = "cp_badlands")
+        pug = self.create_pug(1, "1", pug_map = "cp_badlands")
         self.assertTrue(pug.map_forced)
         self.assertEquals(pug.map, "cp_badlands")
 
     def test_invalid_map_forced(self):
         self.assertRaises(PMEx.InvalidMapException,
-                          lambda: self.pm.create_pug(1, "1", pug_map = "NO"))
+                          lambda: self.create_pug(1, "1", pug_map = "NO"))
 
 class PlayerAddRemoveTest(ManagerTestCase):
     def test_add_player_no_pug(self):
         self.assertRaises(PMEx.InvalidPugException,
-                          lambda: self.pm.add_player(1, "1", 0))
+                          lambda: self.add_player(1, "1", 0))
 
     def test_remove_player_no_pug(self):
         self.assertRaises(PMEx.PlayerNotInPugException,
@@ -144,16 +159,16 @@ class PlayerAddRemoveTest(ManagerTestCase):
         pass
 
     def test_add_player(self):
-        pug = self.pm.create_pug(1, "1")
+        pug = self.create_pug(1, "1")
         self.assertIn(1, pug.player_list())
 
-        self.pm.add_player(2, "2", pug.id)
+        self.add_player(2, "2", pug.id)
         self.assertIn(2, pug.player_list())
 
     def test_remove_player(self):
-        pug = self.pm.create_pug(1, "1")
+        pug = self.create_pug(1, "1")
 
-        self.pm.add_player(2, "2", pug.id)
+        self.add_player(2, "2", pug.id)
         self.assertIn(2, pug.player_list())
 
         self.pm.remove_player(2)
@@ -162,16 +177,16 @@ class PlayerAddRemoveTest(ManagerTestCase):
     def test_remove_player_pug_empty(self):
         # what we're testing here is automatic pug ending if removing the
         # player empties the pug
-        pug = self.pm.create_pug(1, "1")
+        pug = self.create_pug(1, "1")
         self.assertRaises(PMEx.PugEmptyEndException,
                           lambda: self.pm.remove_player(1))
 
     def test_add_pug_full(self):
-        pug = self.pm.create_pug(1, "1")
+        pug = self.create_pug(1, "1")
         fill_pug(self.pm, pug)
 
         self.assertRaises(PMEx.PugFullException,
-                          lambda: self.pm.add_player(13, "13", pug.id))
+                          lambda: self.add_player(13, "13", pug.id))
 
 class MapVoteTest(ManagerTestCase):
     def test_vote_begin_transition(self):
@@ -208,7 +223,7 @@ class MapVoteTest(ManagerTestCase):
                           lambda: self.pm.vote_map(13, "cp_badlands"))
 
     def test_force_map(self):
-        pug = self.pm.create_pug(1, "1")
+        pug = self.create_pug(1, "1")
 
         self.pm.force_map(1, "cp_badlands")
 
@@ -242,7 +257,7 @@ class MapVoteTest(ManagerTestCase):
         self.assertTrue(pug.teams_done)
 
     def test_map_forced_transition(self):
-        pug = self.pm.create_pug(1, "1")
+        pug = self.create_pug(1, "1")
         self.pm.force_map(pug.id, "cp_granary")
         fill_pug(self.pm, pug)
 
@@ -347,9 +362,278 @@ class UpdateRatingsTestCase(ManagerTestCase):
 
 
 
+class FakeDB(object):
+    """
+    Stands in for the database interface, so that the manager's writes can be
+    tested without a database. Writes fail while `fail` is set.
+    """
+    def __init__(self):
+        self.fail = False
+        self.written = []
+        self.next_id = 100
+
+        self.fail_stats = False
+        self.stat_flushes = 0
+
+    def get_pugs(self, api_key, jsoninterface):
+        return []
+
+    @gen.coroutine
+    def get_player_stats(self, ids, async = False):
+        yield gen.moment
+
+        raise gen.Return({})
+
+    @gen.coroutine
+    def flush_pug(self, api_key, jsoninterface, pug, async = False):
+        yield gen.moment
+
+        if self.fail:
+            raise ValueError("write failed")
+
+        if pug.id is None:
+            pug.id = self.next_id
+            self.next_id += 1
+
+        self.written.append(pug.id)
+
+    @gen.coroutine
+    def flush_pugs(self, api_key, jsoninterface, pugs, async = False):
+        for pug in pugs:
+            yield self.flush_pug(api_key, jsoninterface, pug)
+
+    def flush_player_stats(self, player_stats):
+        self.stat_flushes += 1
+
+        if self.fail_stats:
+            raise ValueError("stats write failed")
+
+class FakeServer(object):
+    def __init__(self):
+        self.pug = None
+
+class FakeServerManager(object):
+    def __init__(self, servers):
+        self.free = [ FakeServer() for x in range(servers) ]
+
+    def allocate(self, pug):
+        if not self.free:
+            return None
+
+        server = self.free.pop()
+        server.pug = pug
+        pug.server = server
+
+        return server
+
+    def prepare(self, server):
+        pass
+
+    def reset(self, server):
+        if server is not None:
+            server.pug = None
+            self.free.append(server)
+
+    def release(self, server):
+        self.reset(server)
+
+    def reset_orphans(self):
+        pass
+
+class FakeBanManager(object):
+    def get_player_ban(self, player_id):
+        return None
+
+class FakeManagerTestCase(unittest.TestCase):
+    """
+    A pug manager using a fake database interface and server manager
+    """
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+
+        self.db = FakeDB()
+        self.sm = FakeServerManager(2)
+
+        self.pm = PugManager(1, "123abc", self.db, self.sm, FakeBanManager())
+
+    def tearDown(self):
+        IOLoop.clear_current()
+        self.io_loop.close()
+
+    def run_for(self, seconds):
+        self.io_loop.call_later(seconds, self.io_loop.stop)
+        self.io_loop.start()
+
+class FlushTestCase(FakeManagerTestCase):
+    def test_failed_flush_stays_dirty(self):
+        pug = run(self.pm.create_pug, 1L, "1")
+        self.assertFalse(self.pm._pug_changed(pug))
+
+        pug.force_map("cp_badlands")
+        self.db.fail = True
+
+        self.pm.flush_all(async = True)
+        self.run_for(0.01)
+
+        # the failed write is queued again, and the pug is still dirty
+        self.assertTrue(self.pm._pug_changed(pug))
+        self.assertIn(pug, self.pm._flush_queue)
+
+        self.db.fail = False
+        self.pm.flush_all(async = True)
+        self.run_for(0.01)
+
+        self.assertFalse(self.pm._pug_changed(pug))
+        self.assertEquals(self.db.written, [ pug.id, pug.id ])
+
+    def test_failed_insert(self):
+        self.db.fail = True
+
+        self.assertRaises(ValueError, run, self.pm.create_pug, 1L, "1")
+        self.assertEquals(self.pm.get_pugs(), [])
+
+        # the player and the server are released
+        self.assertFalse(self.pm._player_in_pug(1L))
+        self.assertEquals(len(self.sm.free), 2)
+
+class EndPugTestCase(FakeManagerTestCase):
+    def test_failed_stats_flush(self):
+        pug = run(self.pm.create_pug, 1L, "1")
+        self.db.fail_stats = True
+
+        self.pm._PugManager__flush_pug_stats(pug)
+
+        # the failed write is retried, and the pug isn't ended meanwhile
+        self.assertFalse(self.pm._stats_flushed(pug))
+        self.assertEquals(self.db.stat_flushes, 2)
+
+        self.db.fail_stats = False
+        self.assertFalse(self.pm._stats_flushed(pug))
+        self.assertEquals(self.db.stat_flushes, 3)
+
+        self.assertTrue(self.pm._stats_flushed(pug))
+
+    def test_end_pug(self):
+        pug = run(self.pm.create_pug, 1L, "1")
+
+        run(self.pm.end_pug, pug.id)
+
+        self.assertEquals(self.pm.get_pugs(), [])
+        self.assertEquals(self.db.written, [ pug.id, pug.id ])
+        self.assertEquals(len(self.sm.free), 2)
+
+    def test_failed_end(self):
+        pug = run(self.pm.create_pug, 1L, "1")
+        self.db.fail = True
+
+        self.assertRaises(ValueError, run, self.pm.end_pug, pug.id)
+
+        # the pug is still ended, and its last write is queued again
+        self.assertEquals(self.pm.get_pugs(), [])
+        self.assertEquals(len(self.sm.free), 2)
+        self.assertIn(pug, self.pm._flush_queue)
+
+        self.db.fail = False
+        self.pm.flush_all(async = True)
+        self.run_for(0.01)
+
+        self.assertEquals(self.db.written, [ pug.id, pug.id ])
+
+    def test_status_check_waits(self):
+        pug = run(self.pm.create_pug, 1L, "1")
+
+        # the pug has been gathering players for too long
+        checked = self.pm.status_check(pug.start_time + 1201)
+
+        # the server isn't released until the pug has been written
+        self.assertEquals(self.pm.get_pugs(), [])
+        self.assertEquals(len(self.sm.free), 1)
+
+        run(lambda: checked)
+        self.assertEquals(len(self.sm.free), 2)
+        self.assertEquals(self.db.written, [ pug.id, pug.id ])
+
+    def test_status_check_failed_end(self):
+        pugs = [ run(self.pm.create_pug, 1L, "1"),
+                 run(self.pm.create_pug, 2L, "2") ]
+
+        self.db.fail = True
+
+        # a failed write doesn't stop the other pugs being checked
+        run(self.pm.status_check, pugs[1].start_time + 1201)
+
+        self.assertEquals(self.pm.get_pugs(), [])
+        for pug in pugs:
+            self.assertIn(pug, self.pm._flush_queue)
+
+class ConcurrentAddTestCase(FakeManagerTestCase):
+    def run_together(self, *calls):
+        """
+        Runs the calls at the same time, returning their results or exceptions
+        """
+        @gen.coroutine
+        def wait(call):
+            try:
+                result = yield call()
+            except Exception as e:
+                result = e
+
+            raise gen.Return(result)
+
+        return run(lambda: gen.multi([ wait(x) for x in calls ]))
+
+    def test_create_twice(self):
+        first, second = self.run_together(
+                lambda: self.pm.create_pug(1L, "1"),
+                lambda: self.pm.create_pug(1L, "1"))
+
+        self.assertIsInstance(second, PMEx.PlayerInPugException)
+        self.assertEquals(self.pm.get_pugs(), [ first ])
+
+        # only one server was allocated
+        self.assertEquals(len(self.sm.free), 1)
+        self.assertIs(self.pm.get_player_pug(1L), first)
+
+    def test_add_to_two_pugs(self):
+        a = run(self.pm.create_pug, 1L, "1")
+        b = run(self.pm.create_pug, 2L, "2")
+
+        first, second = self.run_together(
+                lambda: self.pm.add_player(3L, "3", a.id),
+                lambda: self.pm.add_player(3L, "3", b.id))
+
+        self.assertIs(first, a)
+        self.assertIsInstance(second, PMEx.PlayerInPugException)
+
+        self.assertTrue(a.has_player(3L))
+        self.assertFalse(b.has_player(3L))
+        self.assertIs(self.pm.get_player_pug(3L), a)
+
+    def test_last_slot(self):
+        pug = run(self.pm.create_pug, 1L, "1", size = 2)
+
+        first, second = self.run_together(
+                lambda: self.pm.add_player(2L, "2", pug.id),
+                lambda: self.pm.add_player(3L, "3", pug.id))
+
+        # the pug filled while the second player's stats were being fetched
+        self.assertIs(first, pug)
+        self.assertIsInstance(second, PMEx.PugFullException)
+        self.assertFalse(self.pm._player_in_pug(3L))
+
+    def test_no_servers(self):
+        run(self.pm.create_pug, 1L, "1")
+        run(self.pm.create_pug, 2L, "2")
+
+        self.assertRaises(PMEx.NoAvailableServersException, run,
+                          self.pm.create_pug, 3L, "3")
+        self.assertFalse(self.pm._player_in_pug(3L))
+
 def test_suites():
     classes = [ CreatePugTest, PlayerAddRemoveTest, MapVoteTest,
-                UpdateRatingsTestCase ]
+                UpdateRatingsTestCase, FlushTestCase, EndPugTestCase,
+                ConcurrentAddTestCase ]
 
     return [ unittest.TestLoader().loadTestsFromTestCase(x) for x in classes ]
 
@@ -0,0 +1,184 @@
+"""
+Rating system benchmark.
+
+Replays a history of games through each rating system (see
+puglib/ratingsystems.py), predicting the result of each game from the ratings
+before it is rated. Reports the update cost per game, and the prediction
+accuracy, Brier score and log loss of each system. Draws are scored as half a
+win in the Brier score and log loss, and are left out of the accuracy.
+
+By default the history is synthetic: players are given a hidden skill, and
+the result of each game is drawn from the difference in the teams' skill.
+With --db, the finished pugs in the database are replayed instead.
+
+Usage: python rating_benchmark.py [--games N] [--players N] [--db]
+                                  [--batch-size N] [--systems elo,glicko2]
+"""
+
+import sys
+sys.path.append('..')
+sys.path.append('../puglib')
+
+import math
+import random
+import logging
+import argparse
+
+from timeit import default_timer as timer
+
+import rating
+import ratingsystems
+
+def synthetic_history(games, players, seed = 1):
+    """
+    Generates games between random players. The rank of each game is drawn
+    from the difference in the teams' hidden skill.
+
+    :return list A list of games in the form (team1, team2, rank)
+    """
+    rand = random.Random(seed)
+
+    skill = [ rand.gauss(rating.BASE, 200) for x in range(players) ]
+
+    history = []
+    for x in range(games):
+        size = rand.choice([ 6, 6, 6, 4 ])
+        chosen = rand.sample(xrange(players), size*2)
+
+        team1 = chosen[:size]
+        team2 = chosen[size:]
+
+        diff = sum(skill[p] for p in team1) - sum(skill[p] for p in team2)
+        p_win = 1/(1 + math.pow(10, -diff/(400*size)))
+
+        result = rand.random()
+        if result < 0.05:
+            rank = [0, 0]
+        elif result < 0.05 + 0.95*p_win:
+            rank = [0, 1]
+        else:
+            rank = [1, 0]
+
+        history.append((team1, team2, rank))
+
+    return history
+
+def db_history():
+    """
+    Loads the finished pugs from the database, as for replay_ratings.py
+    """
+    import psycopg2.pool
+
+    import settings
+    import replay_ratings
+
+    from interfaces import get_db_interface, TFPugJsonInterface
+
+    dsn = "dbname=%s user=%s password=%s host=%s port=%s" % (
+                settings.db_name, settings.db_user, settings.db_pass,
+                settings.db_host, settings.db_port
+            )
+
+    pool = psycopg2.pool.SimpleConnectionPool(minconn = 1, maxconn = 1,
+                                              dsn = dsn)
+    db = get_db_interface("PGSQL")(pool, None)
+
+    counts = { "rated": 0, "skipped": 0 }
+    history = list(replay_ratings.pug_games(
+                        db.iter_finished_pugs(TFPugJsonInterface()), counts))
+
+    pool.closeall()
+
+    return history
+
+def replay(system, history, batch_size):
+    """
+    Rates the history with the given system
+
+    :return dict A dict of the results
+    """
+    stats = {}
+    new_player = {}
+
+    team_stats = lambda team: [ stats.get(x, new_player) for x in team ]
+
+    predicted = correct = decided = 0
+    brier = log_loss = 0.0
+    rate_time = 0.0
+
+    for batch in rating.independent_batches(history, batch_size):
+        games = [ (team_stats(team1), team_stats(team2), rank)
+                  for team1, team2, rank in batch ]
+
+        probabilities = system.predict_batch([ (x[0], x[1]) for x in games ])
+
+        for p, (team1, team2, rank) in zip(probabilities, batch):
+            actual = rating._actual_score(rank, 0, 1)
+
+            brier += (p - actual)**2
+
+            p = min(max(p, 1e-15), 1 - 1e-15)
+            log_loss -= actual*math.log(p) + (1 - actual)*math.log(1 - p)
+
+            if actual != rating.DRAW:
+                decided += 1
+                if (p > 0.5) == (actual == rating.WIN):
+                    correct += 1
+
+            predicted += 1
+
+        start = timer()
+        new_stats = system.rate_batch(games)
+        rate_time += timer() - start
+
+        for (team1, team2, rank), (new1, new2) in zip(batch, new_stats):
+            stats.update(zip(team1, new1))
+            stats.update(zip(team2, new2))
+
+    return {
+        "games": predicted,
+        "us_per_game": rate_time/max(predicted, 1)*1e6,
+        "accuracy": float(correct)/max(decided, 1),
+        "brier": brier/max(predicted, 1),
+        "log_loss": log_loss/max(predicted, 1)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description = "Rating system benchmark")
+    parser.add_argument("--games", type = int, default = 20000,
+                        help = "Number of synthetic games")
+    parser.add_argument("--players", type = int, default = 1000,
+                        help = "Number of synthetic players")
+    parser.add_argument("--db", action = "store_true",
+                        help = "Replay the finished pugs in the database")
+    parser.add_argument("--batch-size", type = int, default = 512,
+                        help = "Max number of games rated together")
+    parser.add_argument("--systems",
+                        default = ",".join(sorted(ratingsystems.RATING_SYSTEMS)),
+                        help = "Comma separated rating systems to compare")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+
+    if args.db:
+        history = db_history()
+    else:
+        history = synthetic_history(args.games, args.players)
+
+    print "Replaying %d games (batch size %d)" % (len(history), args.batch_size)
+    print "%-10s %12s %10s %8s %9s" % ("system", "us/game", "accuracy",
+                                       "brier", "log loss")
+
+    for name in args.systems.split(","):
+        system = ratingsystems.get_rating_system(name)()
+
+        results = replay(system, history, args.batch_size)
+
+        print "%-10s %12.1f %9.1f%% %8.4f %9.4f" % (name,
+                    results["us_per_game"], results["accuracy"]*100,
+                    results["brier"], results["log_loss"])
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,7 @@ import sys
 sys.path.append('../puglib')
 
 from rating import *
+from ratingsystems import get_rating_system, RATING_SYSTEMS
 
 import random
 from pprint import pprint
@@ -158,6 +159,116 @@ def rate_1v1_cross_tier():
             (Rating(rating = 1751.401),)
         ]
 
+def test_batch_matches_duels():
+    # the batch engine must give exactly the same ratings as calculate_rating,
+    # including uneven teams, draws and cross-tier K-factors
+    rand = random.Random(1)
+
+    games = []
+    for x in range(500):
+        size1 = rand.choice([ 1, 4, 5, 6, 6, 6 ])
+        size2 = rand.choice([ size1, size1, size1 - 1, size1 + 1 ]) or 1
+
+        team1 = [ rand.uniform(1300, 2100) for y in range(size1) ]
+        team2 = [ rand.uniform(1300, 2100) for y in range(size2) ]
+        rank = rand.choice([ [0, 1], [1, 0], [0, 0] ])
+
+        games.append((team1, team2, rank))
+
+    # some games with equal ratings, so that draws compare equal ratings
+    games.append(([ 1500 ] * 6, [ 1500, 1520, 1480, 1500, 1500, 1490 ], [0, 0]))
+
+    batch = calculate_ratings_batch(games)
+
+    for (team1, team2, rank), new in zip(games, batch):
+        expected = calculate_rating([ [ Rating(x) for x in team1 ], 
+                                      [ Rating(x) for x in team2 ] ], rank)
+
+        assert [ tuple(x.rating for x in team) for team in expected ] == \
+                list(new)
+
+def test_recompute_ratings():
+    history = [
+        ([ 1, 2 ], [ 3, 4 ], [0, 1]),
+        ([ 5, 6 ], [ 7, 8 ], [1, 0]),
+        ([ 1, 3 ], [ 5, 7 ], [0, 0]),
+        ([ 2, 4 ], [ 6, 8 ], [0, 1]),
+    ]
+
+    # rate the games one by one
+    expected = {}
+    for team1, team2, rank in history:
+        new = calculate_rating([ [ Rating(expected.get(x, BASE)) for x in team1 ],
+                                 [ Rating(expected.get(x, BASE)) for x in team2 ] ],
+                               rank)
+
+        for cid, r in zip(team1 + team2, new[0] + new[1]):
+            expected[cid] = r.rating
+
+    assert recompute_ratings(iter(history)) == expected
+    assert recompute_ratings(iter(history), batch_size = 1) == expected
+
+def test_rating_systems():
+    rand = random.Random(2)
+
+    for name in RATING_SYSTEMS:
+        system = get_rating_system(name)()
+
+        team1 = [ { "rating": 1600 } for x in range(6) ]
+        team2 = [ { "rating": 1500 } for x in range(6) ]
+
+        assert system.win_probability(team1, team2) > 0.5
+        assert abs(system.win_probability(team1, team2) +
+                   system.win_probability(team2, team1) - 1) < 1e-9
+
+        # winners gain rating, losers lose it. players without a stat start
+        # at the system's default
+        new1, new2 = system.rate(team1, team2, [1, 0])
+        assert all(x["rating"] < 1600 for x in new1)
+        assert all(x["rating"] > 1500 for x in new2)
+        assert set(new1[0]) == set(system.stats)
+
+        new1, new2 = system.rate(team1, team2, [0, 1])
+        assert all(x["rating"] > 1600 for x in new1)
+        assert all(x["rating"] < 1500 for x in new2)
+
+        # rating games in a batch gives the same result as one by one
+        games = []
+        for x in range(50):
+            size = rand.choice([ 4, 5, 6 ])
+            games.append(([ { "rating": rand.uniform(1300, 1800) }
+                                for y in range(size) ],
+                          [ { "rating": rand.uniform(1300, 1800) }
+                                for y in range(rand.choice([ size, size - 1 ])) ],
+                          rand.choice([ [0, 1], [1, 0], [0, 0] ])))
+
+        assert system.rate_batch(games) == [ system.rate(*x) for x in games ]
+
+def test_elo_system_matches_duels():
+    # as in rate_1v1_cross_tier
+    new1, new2 = get_rating_system("elo")().rate([ { "rating": 1850 } ],
+                                                 [ { "rating": 1750 } ], [1, 0])
+
+    assert (new1[0]["rating"], new2[0]["rating"]) == (1843.599, 1756.401)
+
+def test_uncertainty():
+    # a player's uncertainty shrinks as they play
+    for name, stat in (("glicko2", "rating_rd"), ("trueskill", "rating_sigma")):
+        system = get_rating_system(name)()
+
+        new1, new2 = system.rate([ {} ] * 6, [ {} ] * 6, [0, 1])
+
+        assert new1[0][stat] < system.stats[stat]
+        assert new1[0]["rating"] > BASE > new2[0]["rating"]
+
+def test_unknown_system():
+    try:
+        get_rating_system("chess")
+    except ValueError as e:
+        assert "elo" in str(e)
+    else:
+        assert False, "no error for an unknown system"
+
 def test():
     test_rating()
     rate_4v4_1500()
@@ -165,6 +276,12 @@ def test():
     rate_5v6_random()
     rate_5v6_equal()
     rate_5v6_nonequal_draw()
+    test_batch_matches_duels()
+    test_recompute_ratings()
+    test_rating_systems()
+    test_elo_system_matches_duels()
+    test_uncertainty()
+    test_unknown_system()
 
 if __name__ == "__main__":
     test()
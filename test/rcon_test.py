@@ -0,0 +1,310 @@
+import sys
+sys.path.append('..')
+
+import struct
+import unittest
+
+from tornado import ioloop, gen
+from tornado.tcpserver import TCPServer
+from tornado.iostream import StreamClosedError
+
+from serverlib import RconStream, RconPool, RconPacket
+from serverlib.health import ServerHealth
+
+def packet(pid, code, body):
+    data = struct.pack('<ll', pid, code) + body + '\x00\x00'
+    return struct.pack('<l', len(data)) + data
+
+class FakeRconServer(TCPServer):
+    """
+    A game server which answers RCON auth and commands. The response to a
+    command is the command itself.
+    """
+    def __init__(self, password = "rcon"):
+        TCPServer.__init__(self)
+
+        self.password = password
+
+        self.commands = []
+        self.connections = 0
+
+        # if set, commands are not answered
+        self.hung = False
+
+        self.streams = []
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        self.connections += 1
+        self.streams.append(stream)
+
+        try:
+            while True:
+                size = struct.unpack('<l', (yield stream.read_bytes(4)))[0]
+                data = yield stream.read_bytes(size)
+
+                pid, code = struct.unpack('<ll', data[:8])
+                body = data[8:].rstrip('\x00')
+
+                if code == RconStream.SERVERDATA_AUTH:
+                    if body != self.password:
+                        pid = -1
+
+                    stream.write(packet(pid, 0, "") +
+                        packet(pid, RconStream.SERVERDATA_AUTH_RESPONSE, ""))
+
+                elif self.hung:
+                    continue
+
+                elif code == RconStream.SERVERDATA_EXEC_COMMAND:
+                    self.commands.append(body)
+
+                    stream.write(packet(pid, 0, "response " + body))
+
+                else:
+                    stream.write(packet(pid, 0, "") + packet(pid, 0, "\x01"))
+
+        except StreamClosedError:
+            pass
+
+class RconPacketTestCase(unittest.TestCase):
+    def test_pack(self):
+        buffer, length = RconPacket.pack([ (1, 2, "status"), (2, 0, "") ])
+
+        self.assertEquals(str(buffer[:length]), 
+                          packet(1, 2, "status") + packet(2, 0, ""))
+
+        # a large enough buffer is reused
+        reused, length = RconPacket.pack([ (3, 2, "echo") ], buffer)
+        self.assertIs(reused, buffer)
+        self.assertEquals(str(buffer[:length]), packet(3, 2, "echo"))
+
+    def test_read_chunks(self):
+        reader = RconPacket.PacketReader()
+
+        data = packet(1, 0, "a" * 100) + packet(1, 0, "") + packet(1, 0, "\x01")
+
+        # several packets in one chunk, and packets split across chunks
+        self.assertEquals(reader.feed(data[:20]), [])
+        self.assertEquals(reader.feed(data[20:-5]), [ (1, 0, "a" * 100), 
+                                                      (1, 0, "") ])
+        self.assertEquals(reader.feed(data[-5:]), [ (1, 0, "\x01") ])
+        self.assertEquals(len(reader), 0)
+
+    def test_invalid_size(self):
+        reader = RconPacket.PacketReader()
+
+        self.assertRaises(ValueError, reader.feed, 
+                          struct.pack('<lll', 5, 1, 0) + "\x00\x00")
+
+class RconTestCase(unittest.TestCase):
+    def setUp(self):
+        self.io_loop = ioloop.IOLoop()
+        self.io_loop.make_current()
+
+        self.server = FakeRconServer()
+        self.server.listen(0, "127.0.0.1")
+
+        self.port = self.server._sockets.values()[0].getsockname()[1]
+
+        self.health = ServerHealth()
+        self.connection = RconStream.RconConnection("127.0.0.1", self.port,
+                                "rcon", health = self.health)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.stop()
+
+        ioloop.IOLoop.clear_current()
+        self.io_loop.close(all_fds = True)
+
+    def send(self, commands):
+        responses = []
+
+        for command in commands:
+            self.connection.send_cmd(command, responses.append)
+
+        self.wait(responses, len(commands))
+
+        return responses
+
+    def wait(self, responses, count):
+        self.run_until(lambda: len(responses) == count)
+
+    def run_until(self, condition):
+        def check():
+            if condition():
+                self.io_loop.stop()
+
+        timer = ioloop.PeriodicCallback(check, 5)
+        timer.start()
+        self.io_loop.call_later(2, self.io_loop.stop)
+        self.io_loop.start()
+        timer.stop()
+
+    def test_pipelined(self):
+        # auth first
+        self.send([ "status" ])
+
+        commands = [ "say %d" % x for x in range(20) ]
+
+        responses = []
+        for command in commands:
+            self.connection.send_cmd(command, responses.append)
+
+        # commands are sent without waiting for earlier responses, up to the
+        # pipeline limit
+        self.assertEquals(len(self.connection._in_flight) // 2, 
+                          self.connection.max_pipeline)
+
+        self.wait(responses, len(commands))
+
+        self.assertEquals([ x[2] for x in responses ],
+                          [ "response " + x for x in commands ])
+        self.assertEquals(self.server.commands, [ "status" ] + commands)
+
+        self.assertTrue(self.connection.authed)
+        self.assertIsNotNone(self.health.latency)
+
+        # only one connection is used for all commands
+        self.assertEquals(self.server.connections, 1)
+
+    def test_reconnect(self):
+        self.assertEquals(len(self.send([ "status" ])), 1)
+
+        # the server drops the connection, and we reconnect
+        self.server.streams[0].close()
+        self.run_until(lambda: self.server.connections == 2 and 
+                               self.connection.authed)
+
+        responses = self.send([ "status" ])
+
+        self.assertEquals([ x[2] for x in responses ], [ "response status" ])
+        self.assertEquals(self.server.connections, 2)
+        self.assertFalse(self.connection.closed)
+
+    def test_bad_password(self):
+        self.connection.close()
+        self.connection = RconStream.RconConnection("127.0.0.1", self.port,
+                                "wrong", health = self.health)
+
+        self.connection.send_cmd("status")
+        self.run_until(lambda: self.connection.closed)
+
+        self.assertTrue(self.connection.closed)
+        self.assertIsInstance(self.connection.error, RconStream.RconAuthError)
+        self.assertTrue(self.health.quarantined)
+
+    def test_execute(self):
+        future = self.connection.execute("status")
+        self.run_until(future.done)
+
+        self.assertEquals(future.result()[2], "response status")
+
+    def test_timeout(self):
+        self.send([ "status" ])
+
+        self.server.hung = True
+        future = self.connection.execute("status", timeout = 0.05)
+        self.run_until(future.done)
+
+        self.assertRaises(RconStream.RconTimeoutError, future.result)
+        self.assertTrue(self.health.failures > 0)
+
+        # the connection is re-established, and the next command isn't blocked
+        # behind the hung one
+        self.server.hung = False
+        future = self.connection.execute("status")
+        self.run_until(future.done)
+
+        self.assertEquals(future.result()[2], "response status")
+        self.assertEquals(self.server.connections, 2)
+
+    def test_cancel(self):
+        # commands are queued until we've authed
+        future = self.connection.execute("status")
+        self.connection.cancel(future)
+
+        self.assertRaises(RconStream.RconCancelledError, future.result)
+
+        self.send([ "echo" ])
+        self.assertEquals(self.server.commands, [ "echo" ])
+
+    def test_cancel_in_flight(self):
+        self.send([ "status" ])
+
+        self.server.hung = True
+        future = self.connection.execute("status", timeout = 0.05)
+        self.connection.cancel(future)
+
+        self.assertRaises(RconStream.RconCancelledError, future.result)
+
+        # the command is still waiting for its response, so it holds its slot
+        # until its deadline reconnects the hung connection
+        self.assertEquals(len(self.connection._in_flight), 2)
+
+        self.server.hung = False
+        self.run_until(lambda: self.server.connections == 2 and 
+                               self.connection.authed)
+
+        self.assertFalse(self.connection._in_flight)
+
+        future = self.connection.execute("status")
+        self.run_until(future.done)
+
+        self.assertEquals(future.result()[2], "response status")
+
+    def test_auth_error(self):
+        self.connection.close()
+        self.connection = RconStream.RconConnection("127.0.0.1", self.port,
+                                "wrong")
+
+        future = self.connection.execute("status")
+        self.run_until(future.done)
+
+        self.assertRaises(RconStream.RconAuthError, future.result)
+
+    def test_coalesce(self):
+        # fire-and-forget commands queued together are sent as one command
+        for i in range(3):
+            self.connection.send_cmd("say %d" % i)
+
+        self.send([ "status" ])
+
+        self.assertEquals(self.server.commands, [ "say 0;say 1;say 2", 
+                                                  "status" ])
+
+        # but not beyond the max command length
+        long_command = "say " + "a" * (RconStream.MAX_COMMAND_LENGTH // 2)
+        self.connection.max_pipeline = 0
+        for i in range(3):
+            self.connection.send_cmd(long_command)
+
+        self.connection.max_pipeline = 8
+        self.send([ "status" ])
+
+        self.assertEquals(len(self.server.commands), 6)
+
+    def test_pool(self):
+        pool = RconPool.RconPool(30)
+
+        connection = pool.get("127.0.0.1", self.port, "rcon")
+        self.assertIs(pool.get("127.0.0.1", self.port, "rcon"), connection)
+
+        # a new password means a new connection
+        other = pool.get("127.0.0.1", self.port, "new")
+        self.assertIsNot(other, connection)
+        self.assertTrue(connection.closed)
+
+        pool.close()
+        self.assertEquals(len(pool), 0)
+
+def test_suites():
+    classes = [ RconPacketTestCase, RconTestCase ]
+
+    return [ unittest.TestLoader().loadTestsFromTestCase(x) for x in classes ]
+
+if __name__ == "__main__":
+    suites = test_suites()
+    unittest.TestSuite(suites)
+    unittest.main()
@@ -0,0 +1,61 @@
+"""
+Test case for the encoded (cached) pug status responses
+"""
+
+import sys
+sys.path.append('..')
+
+import json
+
+from entities import Pug
+from entities.Pug import PlayerStats
+from handlers import ResponseHandler
+
+def new_pug(pid):
+    pug = Pug.Pug(pid = pid)
+    pug.add_player(1L, "1", PlayerStats())
+
+    return pug
+
+def test_status_encoded():
+    handler = ResponseHandler.ResponseHandler()
+    pug = new_pug(1)
+
+    # the same as the unencoded response
+    encoded = handler.pug_status_encoded(pug)
+    assert json.loads(encoded) == json.loads(json.dumps(handler.pug_status(pug)))
+
+    # the packet is cached until the pug changes
+    assert handler._encoded_status_packet(pug) is \
+            handler._encoded_status_packet(pug)
+
+    pug.add_player(2L, "2", PlayerStats())
+    assert len(json.loads(handler.pug_status_encoded(pug))["pug"]["players"]) == 2
+
+    assert json.loads(handler.pug_status_encoded(None)) == \
+            handler.pug_status(None)
+
+    # internal fields aren't sent
+    assert "version" not in handler.pug_status(pug)["pug"]
+    assert "player_index" not in handler.pug_status(pug)["pug"]
+
+def test_listing_encoded():
+    handler = ResponseHandler.ResponseHandler(status_cache_size = 2)
+    pugs = [ new_pug(x) for x in range(1, 4) ]
+
+    listing = json.loads(handler.pug_listing_encoded(pugs))
+    assert listing["response"] == ResponseHandler.Response_PugListing
+    assert [ x["id"] for x in listing["pugs"] ] == [ 1, 2, 3 ]
+
+    # only the most recently used pugs are kept
+    assert handler._status_cache.keys() == [ 2, 3 ]
+
+    assert handler.pug_listing_encoded([]) == \
+            '{"response":%d,"pugs":[]}' % ResponseHandler.Response_PugListing
+
+def test():
+    test_status_encoded()
+    test_listing_encoded()
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,228 @@
+import sys
+sys.path.append('..')
+
+import unittest
+
+from tornado import ioloop, gen
+
+import settings
+
+from serverlib.ServerManager import ServerManager
+from serverlib.health import ServerHealth
+from entities import Pug
+
+def server_row(sid, pug_id = -1, ip = "127.0.0.1"):
+    return {
+        "id": sid,
+        "ip": ip,
+        "port": 27015 + sid,
+        "rcon_password": "rcon",
+        "password": "",
+        "pug_id": pug_id,
+        "log_port": 0,
+        "server_group": 1,
+    }
+
+class ServerDB(object):
+    """
+    Stands in for the database interface, counting server list loads
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.loads = 0
+
+        self.fail_flushes = False
+        self.flushed = []
+
+    def get_servers(self, group):
+        self.loads += 1
+
+        return list(self.rows)
+
+    def flush_server(self, server, async = False):
+        if self.fail_flushes:
+            raise ValueError("write failed")
+
+        self.flushed.append(server.id)
+
+        return gen.maybe_future(None)
+
+class ServerPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = ServerDB([ server_row(1), server_row(2, pug_id = 5),
+                             server_row(3) ])
+        self.manager = ServerManager(1, self.db)
+
+    def test_allocate_from_pool(self):
+        first = self.manager.allocate(Pug.Pug())
+        second = self.manager.allocate(Pug.Pug())
+
+        # server 2 is in use by a pug in the database
+        self.assertEquals(first.id, 1)
+        self.assertEquals(second.id, 3)
+        self.assertIsNone(self.manager.allocate(Pug.Pug()))
+
+        # allocation doesn't go to the database
+        self.assertEquals(self.db.loads, 1)
+
+    def test_release(self):
+        server = self.manager.allocate(Pug.Pug())
+        self.manager.allocate(Pug.Pug())
+
+        server.pug = None
+        server.pug_id = -1
+        self.manager._release(server)
+        self.manager._release(server)
+
+        self.assertIs(self.manager.allocate(Pug.Pug()), server)
+        self.assertIsNone(self.manager.allocate(Pug.Pug()))
+
+    def test_release_unprepared(self):
+        pug = Pug.Pug()
+        server = self.manager.allocate(pug)
+
+        # the pug could not be created
+        self.manager.release(server)
+
+        self.assertIsNone(server.pug)
+        self.assertIsNone(pug.server)
+
+        allocated = [ self.manager.allocate(Pug.Pug()) for x in range(2) ]
+        self.assertIn(server, allocated)
+
+    def test_reload(self):
+        io_loop = ioloop.IOLoop(make_current = False)
+
+        # server 3 is removed and server 4 is added
+        self.db.rows = [ server_row(1), server_row(2, pug_id = 5),
+                         server_row(4) ]
+        io_loop.run_sync(self.manager.reload_servers)
+        io_loop.close()
+
+        self.assertIsNone(self.manager.get_server_by_id(3))
+        self.assertEquals([ self.manager.allocate(Pug.Pug()).id,
+                            self.manager.allocate(Pug.Pug()).id ], [ 1, 4 ])
+        self.assertIsNone(self.manager.allocate(Pug.Pug()))
+
+    def test_failed_flush(self):
+        io_loop = ioloop.IOLoop(make_current = False)
+
+        server = self.manager.get_server_by_id(1)
+        server.mark_changed()
+
+        # a failed write leaves the server to be written by the next flush
+        self.db.fail_flushes = True
+        self.assertRaises(ValueError, io_loop.run_sync, 
+                          lambda: self.manager._flush_server(server))
+        self.assertTrue(self.manager._server_changed(server))
+
+        self.db.fail_flushes = False
+        io_loop.run_sync(lambda: self.manager._flush_server(server))
+        io_loop.close()
+
+        self.assertFalse(self.manager._server_changed(server))
+        self.assertEquals(self.db.flushed, [ 1 ])
+
+class ServerHealthTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.health = ServerHealth(clock = lambda: self.now)
+
+    def test_latency(self):
+        self.health.record_success(0.2)
+        self.assertAlmostEqual(self.health.latency, 0.2)
+
+        self.health.record_success(0.1)
+        self.assertTrue(0.1 < self.health.latency < 0.2)
+
+    def test_backoff(self):
+        base = settings.server_quarantine_base
+
+        self.health.record_failure()
+        self.assertTrue(self.health.quarantined)
+        self.assertEquals(self.health.quarantined_until, self.now + base)
+
+        self.now += base
+        self.assertFalse(self.health.quarantined)
+        self.assertTrue(self.health.probe_due)
+
+        # each consecutive failure doubles the quarantine
+        self.health.record_failure()
+        self.assertEquals(self.health.quarantined_until, self.now + base * 2)
+
+        for i in range(20):
+            self.health.record_failure()
+
+        self.assertEquals(self.health.quarantined_until, 
+                          self.now + settings.server_quarantine_max)
+
+        # one success clears the quarantine
+        self.health.record_success(0.1)
+        self.assertFalse(self.health.quarantined)
+        self.assertFalse(self.health.probe_due)
+
+class ServerSchedulingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = ServerDB([ server_row(1, ip = "10.0.0.1"), 
+                             server_row(2, ip = "10.0.0.1"),
+                             server_row(3, ip = "10.0.0.2"),
+                             server_row(4, ip = "10.0.0.2") ])
+        self.manager = ServerManager(1, self.db)
+
+    def server(self, sid):
+        return self.manager.get_server_by_id(sid)
+
+    def test_skip_quarantined(self):
+        self.server(1).health.record_failure()
+        self.server(3).health.record_failure()
+
+        self.assertEquals(self.manager.allocate(Pug.Pug()).id, 2)
+        self.assertEquals(self.manager.allocate(Pug.Pug()).id, 4)
+        self.assertIsNone(self.manager.allocate(Pug.Pug()))
+
+    def test_prefer_low_latency(self):
+        self.server(1).health.record_success(0.2)
+        self.server(2).health.record_success(0.05)
+
+        self.assertEquals(self.manager.allocate(Pug.Pug()).id, 2)
+
+    def test_spread_hosts(self):
+        for sid in (1, 2, 3, 4):
+            self.server(sid).health.record_success(0.01 * sid)
+
+        # the second pug goes to the other host, even though server 2 is
+        # faster than server 3
+        allocated = [ self.manager.allocate(Pug.Pug()).id for x in range(4) ]
+        self.assertEquals(allocated, [ 1, 3, 2, 4 ])
+
+    def test_host_load(self):
+        first = self.manager.allocate(Pug.Pug())
+        second = self.manager.allocate(Pug.Pug())
+
+        self.assertEquals(self.manager._host_load, 
+                          { "10.0.0.1": 1, "10.0.0.2": 1 })
+
+        # releasing a server takes it off its host's load, so the next pug
+        # goes back to that host
+        self.manager.release(first)
+        self.assertEquals(self.manager._host_load[first.ip], 0)
+        self.assertEquals(self.manager.allocate(Pug.Pug()).ip, first.ip)
+
+        # reloading counts the servers in use again
+        io_loop = ioloop.IOLoop(make_current = False)
+        io_loop.run_sync(self.manager.reload_servers)
+        io_loop.close()
+
+        self.assertEquals(self.manager._host_load, 
+                          { "10.0.0.1": 1, "10.0.0.2": 1 })
+
+def test_suites():
+    classes = [ ServerPoolTestCase, ServerHealthTestCase, 
+                ServerSchedulingTestCase ]
+
+    return [ unittest.TestLoader().loadTestsFromTestCase(x) for x in classes ]
+
+if __name__ == "__main__":
+    suites = test_suites()
+    unittest.TestSuite(suites)
+    unittest.main()
@@ -0,0 +1,89 @@
+import sys
+sys.path.append('..')
+
+import unittest
+
+from interfaces.statcache import PlayerStatsCache
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+class StatsCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = PlayerStatsCache(2, 10, clock = self.clock)
+
+    def test_hit_miss(self):
+        self.cache.put(1, { "rating": 1500 })
+        self.cache.put(2, None)
+
+        stats, missing = self.cache.get([ 1, 2, 3 ])
+
+        self.assertEquals(stats, { 1: { "rating": 1500 } })
+        self.assertEquals(missing, [ 3 ])
+        self.assertEquals(self.cache.hits, 2)
+        self.assertEquals(self.cache.misses, 1)
+
+    def test_copy(self):
+        self.cache.put(1, { "rating": 1500 })
+
+        stats, missing = self.cache.get([ 1 ])
+        stats[1]["rating"] = 2000
+
+        stats, missing = self.cache.get([ 1 ])
+        self.assertEquals(stats[1]["rating"], 1500)
+
+    def test_ttl(self):
+        self.cache.put(1, { "rating": 1500 })
+
+        self.clock.now = 10
+        stats, missing = self.cache.get([ 1 ])
+
+        self.assertEquals(stats, {})
+        self.assertEquals(missing, [ 1 ])
+        self.assertFalse(1 in self.cache)
+
+    def test_contains_expired(self):
+        self.cache.put(1, { "rating": 1500 })
+        self.assertTrue(1 in self.cache)
+
+        # an expired entry isn't cached, even before it is looked up
+        self.clock.now = 10
+        self.assertFalse(1 in self.cache)
+        self.assertEquals(self.cache.misses, 0)
+
+    def test_lru(self):
+        self.cache.put(1, { "rating": 1500 })
+        self.cache.put(2, { "rating": 1600 })
+
+        # 1 is now the most recently used, so 2 should be evicted
+        self.cache.get([ 1 ])
+        self.cache.put(3, { "rating": 1700 })
+
+        self.assertTrue(1 in self.cache)
+        self.assertFalse(2 in self.cache)
+        self.assertTrue(3 in self.cache)
+
+    def test_invalidate(self):
+        self.cache.put(1, { "rating": 1500 })
+        self.cache.put(2, { "rating": 1600 })
+
+        self.cache.invalidate([ 1 ])
+        self.assertEquals(len(self.cache), 1)
+
+        self.cache.invalidate()
+        self.assertEquals(len(self.cache), 0)
+
+def test_suites():
+    classes = [ StatsCacheTestCase ]
+
+    return [ unittest.TestLoader().loadTestsFromTestCase(x) for x in classes ]
+
+if __name__ == "__main__":
+    unittest.TestSuite(test_suites())
+
+    unittest.main()
@@ -0,0 +1,135 @@
+import sys
+sys.path.append('..')
+
+import time
+import socket
+import unittest
+
+from tornado import ioloop
+
+from serverlib import UDPServer, LogListener
+
+class DrainTestCase(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.received = []
+
+        self.io_loop = ioloop.IOLoop(make_current = False)
+
+    def tearDown(self):
+        self.listener.close()
+        self.io_loop.close()
+
+    def _listen(self, **kwargs):
+        self.listener = UDPServer.UDPServer(("127.0.0.1", 0), 
+                                            self.received.append,
+                                            io_loop = self.io_loop, **kwargs)
+        self.listener.start()
+
+    def _send(self, count):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in xrange(count):
+            s.sendto("RL datagram %d" % i, self.listener.server_address)
+        s.close()
+
+        # give the datagrams a moment to arrive
+        time.sleep(0.05)
+
+    def test_batch_read(self):
+        self._listen(batch_callback = self.batches.append, read_budget = 8)
+        self._send(10)
+
+        self.listener._handle_read()
+        self.listener._handle_read()
+        self.listener._handle_read()
+
+        self.assertEquals([ len(x) for x in self.batches ], [ 8, 2 ])
+        self.assertEquals(self.batches[0][0], "RL datagram 0")
+        self.assertEquals(self.batches[1][1], "RL datagram 9")
+
+    def test_single_callback(self):
+        self._listen(read_budget = 8)
+        self._send(3)
+
+        self.listener._handle_read()
+
+        self.assertEquals(self.received, [ "RL datagram %d" % x 
+                                            for x in xrange(3) ])
+
+class FakeServer(object):
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+
+class FakeLogInterface(object):
+    def __init__(self):
+        self.parsed = []
+
+    def parse(self, data):
+        self.parsed.append(data)
+
+class SharedListenerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.io_loop = ioloop.IOLoop(make_current = False)
+        self.listener = LogListener.SharedLogListener(("127.0.0.1", 0),
+                                                      io_loop = self.io_loop)
+
+        self.server1 = FakeServer("10.0.0.1", 27015)
+        self.server2 = FakeServer("10.0.0.2", 27015)
+        self.iface1 = FakeLogInterface()
+        self.iface2 = FakeLogInterface()
+
+        self.secret1 = self.listener.register(self.server1, self.iface1)
+        self.secret2 = self.listener.register(self.server2, self.iface2)
+
+    def tearDown(self):
+        self.listener.close()
+        self.io_loop.close()
+
+    def test_route_by_address(self):
+        self.listener._route_batch([
+                ("\xFF\xFF\xFF\xFFRL 1", ("10.0.0.1", 27015)),
+                ("\xFF\xFF\xFF\xFFRL 2", ("10.0.0.2", 27015)),
+                ("\xFF\xFF\xFF\xFFRL 3", ("10.0.0.3", 27015)),
+            ])
+
+        self.assertEquals(self.iface1.parsed, [ "\xFF\xFF\xFF\xFFRL 1" ])
+        self.assertEquals(self.iface2.parsed, [ "\xFF\xFF\xFF\xFFRL 2" ])
+
+    def test_route_by_secret(self):
+        # the secret takes precedence over the source address (i.e. NAT)
+        data = "\xFF\xFF\xFF\xFFS%sL 1" % self.secret2
+        self.listener._route_batch([ (data, ("10.0.0.1", 27015)) ])
+
+        self.assertEquals(self.iface1.parsed, [])
+        self.assertEquals(self.iface2.parsed, [ data ])
+
+    def test_unregister(self):
+        self.listener.unregister(self.server1)
+
+        self.listener._route_batch([
+                ("\xFF\xFF\xFF\xFFRL 1", ("10.0.0.1", 27015)),
+                ("\xFF\xFF\xFF\xFFS%sL 1" % self.secret1, ("1.1.1.1", 1)),
+            ])
+
+        self.assertEquals(self.iface1.parsed, [])
+
+    def test_socket_route(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.sendto("S%sL 1" % self.secret1, self.listener.server_address)
+        s.close()
+        time.sleep(0.05)
+
+        self.listener._listener._handle_read()
+
+        self.assertEquals(self.iface1.parsed, [ "S%sL 1" % self.secret1 ])
+
+def test_suites():
+    classes = [ DrainTestCase, SharedListenerTestCase ]
+
+    return [ unittest.TestLoader().loadTestsFromTestCase(x) for x in classes ]
+
+if __name__ == "__main__":
+    unittest.TestSuite(test_suites())
+
+    unittest.main()
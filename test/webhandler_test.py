@@ -0,0 +1,138 @@
+"""
+Test case for the ETags sent by the polled web handlers
+"""
+
+import sys
+sys.path.append('..')
+
+import json
+import unittest
+
+import tornado.web
+
+from tornado import gen
+from tornado.testing import AsyncHTTPTestCase
+
+from entities import Pug
+from entities.Pug import PlayerStats
+from handlers import ResponseHandler, WebHandler
+
+class User(object):
+    private_key = "private"
+
+class PugManager(object):
+    def __init__(self, pugs):
+        self.pugs = pugs
+
+    def get_pugs(self):
+        return self.pugs
+
+class StatDB(object):
+    """
+    Stands in for the database interface, counting stat queries
+    """
+    def __init__(self):
+        self.stats_version = 0
+        self.queries = 0
+
+    def get_player_stats(self, ids = None, async = False):
+        self.queries += 1
+
+        return gen.maybe_future({})
+
+class Application(tornado.web.Application):
+    def __init__(self, pugs, db):
+        tornado.web.Application.__init__(self, [
+            (r"/ITF2Pug/List/", WebHandler.PugListHandler),
+            (r"/ITF2Pug/Stat/(.*)/", WebHandler.StatHandler),
+        ])
+
+        self.response_handler = ResponseHandler.ResponseHandler()
+        self.manager = PugManager(pugs)
+        self.db = db
+
+    def get_pug_manager(self, private_key):
+        return self.manager
+
+    def get_user_info(self, public_key):
+        return User()
+
+class ETagTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        self.pug = Pug.Pug(pid = 1)
+        self.pug.add_player(1L, "1", PlayerStats())
+
+        self.db = StatDB()
+
+        return Application([ self.pug ], self.db)
+
+    def get(self, path, etag = None):
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+
+        return self.fetch(path, headers = headers)
+
+    def test_list(self):
+        response = self.get("/ITF2Pug/List/?key=public")
+        self.assertEquals(response.code, 200)
+        self.assertEquals(len(json.loads(response.body)["pugs"]), 1)
+
+        etag = response.headers["Etag"]
+
+        response = self.get("/ITF2Pug/List/?key=public", etag)
+        self.assertEquals(response.code, 304)
+        self.assertEquals(response.headers["Etag"], etag)
+
+        # the pug changing changes the tag
+        self.pug.add_player(2L, "2", PlayerStats())
+
+        response = self.get("/ITF2Pug/List/?key=public", etag)
+        self.assertEquals(response.code, 200)
+        self.assertNotEquals(response.headers["Etag"], etag)
+
+    def test_stats(self):
+        response = self.get("/ITF2Pug/Stat/All/")
+        self.assertEquals(response.code, 200)
+        self.assertEquals(self.db.queries, 1)
+
+        etag = response.headers["Etag"]
+
+        # a 304 doesn't query the database
+        response = self.get("/ITF2Pug/Stat/All/", etag)
+        self.assertEquals(response.code, 304)
+        self.assertEquals(self.db.queries, 1)
+
+        self.db.stats_version += 1
+
+        response = self.get("/ITF2Pug/Stat/All/", etag)
+        self.assertEquals(response.code, 200)
+        self.assertEquals(self.db.queries, 2)
+
+    def test_stats_arguments(self):
+        response = self.get("/ITF2Pug/Stat/Select/?ids=[1]")
+        self.assertEquals(response.code, 200)
+
+        etag = response.headers["Etag"]
+
+        response = self.get("/ITF2Pug/Stat/Select/?ids=[1]", etag)
+        self.assertEquals(response.code, 304)
+
+        # other players, or another slug, aren't the same response
+        response = self.get("/ITF2Pug/Stat/Select/?ids=[2]", etag)
+        self.assertEquals(response.code, 200)
+        self.assertNotEquals(response.headers["Etag"], etag)
+
+        response = self.get("/ITF2Pug/Stat/All/", etag)
+        self.assertEquals(response.code, 200)
+        self.assertEquals(self.db.queries, 3)
+
+def test_suites():
+    classes = [ ETagTestCase ]
+
+    return [ unittest.TestLoader().loadTestsFromTestCase(x) for x in classes ]
+
+if __name__ == "__main__":
+    suites = test_suites()
+    unittest.TestSuite(suites)
+    unittest.main()